@@ -3,39 +3,67 @@ from tkinter import scrolledtext, messagebox, simpledialog, Menu, ttk, filedialo
 import pyperclip
 import webbrowser
 import json
+import argparse
+import hashlib
 import os
 from pystray import MenuItem as TrayMenuItem, Icon
 from PIL import Image, ImageTk
 import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import re
 import qrcode
-from io import BytesIO
+import qrcode.image.svg
+import csv
+import heapq
+import itertools
+import pickle
+import zipfile
+import zlib
+import codecs
+from io import BytesIO, StringIO
 import chardet
 import subprocess
-from pydub import AudioSegment
-from collections import Counter
+import socket
+import secrets
+import hmac
+import http.server
+import urllib.error
+import urllib.parse
+import urllib.request
+import stat
+from array import array
+from collections import Counter, OrderedDict, deque
 import sys
-import win32clipboard
-import win32con
-import win32gui
 import keyboard
 import time
+import queue
 from datetime import datetime
 import shutil
 import tempfile
 import mimetypes
-import imageio
-from moviepy.editor import VideoFileClip
 import math
+import random
+import ast
+import bisect
+import contextlib
+import cProfile
+import operator
 import ctypes
 from ctypes import cast, POINTER
 from comtypes import CLSCTX_ALL
 from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume
 
 try:
-    from moviepy.editor import VideoFileClip
+    import numpy as np
 except ImportError:
-    VideoFileClip = None
+    np = None
+
+try:
+    import win32clipboard
+    import win32con
+    import win32gui
+except ImportError:
+    win32clipboard = win32con = win32gui = None
 
 
 class VolumeControl:
@@ -63,50 +91,4395 @@ class VolumeControl:
         return new_level
 
 
+class ConversionCache:
+    """Кэш результатов конвертации по хэшу содержимого исходного файла"""
+
+    CHUNK_SIZE = 1024 * 1024
+    MAX_SOURCES = 1000
+
+    def __init__(self, cache_dir="conversion_cache", max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock = threading.Lock()
+        # Индекс пишется вне self.lock; запись файла индекса - по одному потоку
+        self.index_lock = threading.Lock()
+        self.index_dirty = False
+        self.hits = 0
+        self.misses = 0
+
+        # key -> {"file", "size", "last_used"}; порядок = порядок LRU (в конце самые свежие)
+        self.entries = OrderedDict()
+        # абсолютный путь -> {"mtime", "size", "hash"} для быстрой проверки без чтения файла
+        self.sources = OrderedDict()
+        self.load_index()
+
+    def load_index(self):
+        """Загружаем индекс кэша с диска"""
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            entries = sorted(data.get("entries", {}).items(), key=lambda kv: kv[1]["last_used"])
+            for key, entry in entries:
+                if os.path.exists(os.path.join(self.cache_dir, entry["file"])):
+                    self.entries[key] = entry
+            self.sources.update(data.get("sources", {}))
+        except Exception as e:
+            print(f"Не удалось загрузить индекс кэша конвертации: {e}")
+
+    def save_index(self):
+        """Сохраняем индекс кэша на диск, если он менялся (вызывается без блокировки)"""
+        with self.index_lock:
+            with self.lock:
+                if not self.index_dirty:
+                    return
+                data = json.dumps({"entries": self.entries, "sources": self.sources})
+                self.index_dirty = False
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = self.index_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(tmp_path, self.index_path)
+            except Exception as e:
+                print(f"Не удалось сохранить индекс кэша конвертации: {e}")
+
+    def source_hash(self, path):
+        """Хэш содержимого файла; повторно читаем файл только если изменились mtime или размер"""
+        abs_path = os.path.abspath(path)
+        st = os.stat(abs_path)
+
+        with self.lock:
+            known = self.sources.get(abs_path)
+            if known and known["mtime"] == st.st_mtime_ns and known["size"] == st.st_size:
+                self.sources.move_to_end(abs_path)
+                return known["hash"]
+
+        digest = hashlib.sha256()
+        with open(abs_path, "rb") as f:
+            for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b""):
+                digest.update(chunk)
+        file_hash = digest.hexdigest()
+
+        with self.lock:
+            self.sources[abs_path] = {"mtime": st.st_mtime_ns, "size": st.st_size, "hash": file_hash}
+            self.index_dirty = True
+            self.sources.move_to_end(abs_path)
+            while len(self.sources) > self.MAX_SOURCES:
+                self.sources.popitem(last=False)
+        return file_hash
+
+    def make_key(self, source, conversion_type, params=None):
+        """Ключ кэша: хэш содержимого + тип конвертации + параметры"""
+        payload = json.dumps([self.source_hash(source), conversion_type, params or {}], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def copy_file(src, dst):
+        """Копируем через временный файл: dst не бывает недописанным и не остается ссылкой на запись кэша"""
+        if os.path.abspath(src) == os.path.abspath(dst):
+            return
+        tmp_path = f"{dst}.{threading.get_ident()}.tmp"
+        try:
+            shutil.copy2(src, tmp_path)
+            os.replace(tmp_path, dst)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    def fetch(self, key, output_path):
+        """Отдаем результат из кэша в output_path. Возвращает True при попадании"""
+        with self.lock:
+            entry = self.entries.get(key)
+            cached_path = os.path.join(self.cache_dir, entry["file"]) if entry else None
+
+        # Копия, а не жесткая ссылка: правка результата на месте не должна портить запись кэша.
+        # Копируем вне блокировки, чтобы не выстраивать потоки пакетной конвертации в очередь
+        try:
+            if not entry:
+                raise FileNotFoundError(key)
+            self.copy_file(cached_path, output_path)
+        except FileNotFoundError:
+            with self.lock:
+                # Файл записи пропал (вытеснен другим потоком или удален)
+                if entry and self.entries.get(key) is entry:
+                    del self.entries[key]
+                    self.index_dirty = True
+                self.misses += 1
+            return False
+
+        with self.lock:
+            entry["last_used"] = time.time()
+            if self.entries.get(key) is entry:
+                self.entries.move_to_end(key)
+            self.hits += 1
+            self.index_dirty = True
+        return True
+
+    def store(self, key, output_path):
+        """Кладем результат конвертации в кэш и вытесняем старые записи"""
+        ext = os.path.splitext(output_path)[1]
+        file_name = f"{key}{ext}"
+        cached_path = os.path.join(self.cache_dir, file_name)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Копируем, а не связываем: пользователь может менять свой файл на месте
+        self.copy_file(output_path, cached_path)
+        with self.lock:
+            self.entries[key] = {
+                "file": file_name,
+                "size": os.path.getsize(cached_path),
+                "last_used": time.time()
+            }
+            self.entries.move_to_end(key)
+            evicted = self.evict()
+            self.index_dirty = True
+        for path in evicted:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+    def evict(self):
+        """Вытесняем наименее используемые записи, пока кэш превышает лимит (под блокировкой).
+        Возвращаем пути файлов, которые нужно удалить"""
+        total = sum(entry["size"] for entry in self.entries.values())
+        evicted = []
+        while total > self.max_bytes and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            total -= entry["size"]
+            evicted.append(os.path.join(self.cache_dir, entry["file"]))
+        return evicted
+
+    def run(self, source, output_path, conversion_type, params, convert, save_index=True):
+        """Выполняем convert(source, output_path) только если результата нет в кэше.
+
+        Возвращает True, если результат взят из кэша. В пакете save_index=False:
+        индекс пишется один раз после пакета.
+        """
+        key = self.make_key(source, conversion_type, params)
+        if self.fetch(key, output_path):
+            from_cache = True
+        else:
+            # Файл назначения может быть жесткой ссылкой на запись кэша (от старых версий) - не пишем в нее поверх
+            if os.path.exists(output_path) and os.stat(output_path).st_nlink > 1:
+                os.remove(output_path)
+            convert(source, output_path)
+            self.store(key, output_path)
+            from_cache = False
+        if save_index:
+            self.save_index()
+        return from_cache
+
+    def clear(self):
+        """Полностью очищаем кэш"""
+        with self.lock:
+            for entry in self.entries.values():
+                try:
+                    os.remove(os.path.join(self.cache_dir, entry["file"]))
+                except OSError:
+                    pass
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.index_dirty = True
+        self.save_index()
+
+    def get_stats(self):
+        """Счетчики попаданий/промахов и текущий размер кэша"""
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "bytes": sum(entry["size"] for entry in self.entries.values())
+            }
+
+    def format_stats(self):
+        """Строка состояния кэша для интерфейса"""
+        stats = self.get_stats()
+        return (
+            f"Кэш: попаданий {stats['hits']}, промахов {stats['misses']}, "
+            f"файлов {stats['entries']} ({stats['bytes'] / (1024 * 1024):.1f} МБ)"
+        )
+
+
+class ImageConverter:
+    """Движок конвертации изображений с пакетной обработкой в пуле потоков"""
+
+    # Расширение -> формат Pillow
+    FORMATS = {
+        ".png": "PNG",
+        ".jpg": "JPEG",
+        ".jpeg": "JPEG",
+        ".webp": "WEBP"
+    }
+
+    def __init__(self, max_workers=None, quality=85, cache=None):
+        # Pillow отпускает GIL при декодировании/кодировании, поэтому потоки дают реальный выигрыш
+        self.max_workers = max_workers or min(8, (os.cpu_count() or 2))
+        self.quality = quality
+        self.cache = cache
+
+    def get_format(self, output_path):
+        """Определяем формат Pillow по расширению выходного файла"""
+        ext = os.path.splitext(output_path)[1].lower()
+        if ext not in self.FORMATS:
+            raise ValueError(f"Неподдерживаемый формат: {ext or 'без расширения'}")
+        return self.FORMATS[ext]
+
+    def convert(self, input_path, output_path, max_size=None, quality=None):
+        """Конвертируем одно изображение, возвращаем размеры исходного и итогового файлов"""
+        fmt = self.get_format(output_path)
+        quality = quality or self.quality
+
+        with Image.open(input_path) as img:
+            # Для JPEG при уменьшении декодируем сразу в уменьшенном масштабе (DCT scaling)
+            if max_size and img.format == "JPEG":
+                img.draft("RGB", (max_size, max_size))
+
+            # Сохраняем метаданные до любых преобразований
+            exif = img.info.get("exif")
+            icc_profile = img.info.get("icc_profile")
+
+            if max_size and max(img.size) > max_size:
+                img.thumbnail((max_size, max_size), Image.LANCZOS)
+
+            # Приводим цветовую модель к поддерживаемой форматом
+            if fmt == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+                img = img.convert("RGB")
+            elif fmt == "WEBP" and img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "A" in img.getbands() or img.mode == "P" else "RGB")
+
+            save_kwargs = {}
+            if exif:
+                save_kwargs["exif"] = exif
+            if icc_profile:
+                save_kwargs["icc_profile"] = icc_profile
+
+            if fmt == "JPEG":
+                save_kwargs.update(quality=quality, optimize=True, progressive=True)
+            elif fmt == "WEBP":
+                save_kwargs.update(quality=quality, method=4)
+            elif fmt == "PNG":
+                save_kwargs.update(optimize=True)
+
+            img.save(output_path, format=fmt, **save_kwargs)
+
+        return os.path.getsize(input_path), os.path.getsize(output_path)
+
+    def convert_cached(self, input_path, output_path, max_size=None, quality=None, save_index=True):
+        """Конвертируем с учетом кэша. Возвращает (размер исходного, размер итогового, из кэша)"""
+        if not self.cache:
+            return (*self.convert(input_path, output_path, max_size, quality), False)
+
+        params = {"max_size": max_size, "quality": quality or self.quality}
+        from_cache = self.cache.run(
+            input_path, output_path, "image_" + self.get_format(output_path), params,
+            lambda src, dst: self.convert(src, dst, max_size, quality), save_index
+        )
+        return os.path.getsize(input_path), os.path.getsize(output_path), from_cache
+
+    def convert_batch(self, jobs, max_size=None, quality=None, progress_callback=None):
+        """Конвертируем набор пар (исходный, итоговый) в пуле потоков.
+
+        progress_callback(done, total) вызывается из рабочих потоков.
+        """
+        started = time.perf_counter()
+        stats = {
+            "converted": 0,
+            "cached": 0,
+            "failed": [],
+            "bytes_in": 0,
+            "bytes_out": 0
+        }
+        total = len(jobs)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.convert_cached, src, dst, max_size, quality, False): src
+                for src, dst in jobs
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                try:
+                    size_in, size_out, from_cache = future.result()
+                    stats["converted"] += 1
+                    stats["cached"] += from_cache
+                    stats["bytes_in"] += size_in
+                    stats["bytes_out"] += size_out
+                except Exception as e:
+                    stats["failed"].append((futures[future], str(e)))
+                if progress_callback:
+                    progress_callback(done, total)
+        # Индекс кэша - один раз на пакет
+        if self.cache:
+            self.cache.save_index()
+
+        elapsed = time.perf_counter() - started
+        stats["elapsed"] = elapsed
+        stats["images_per_sec"] = stats["converted"] / elapsed if elapsed > 0 else 0.0
+        stats["bytes_saved"] = stats["bytes_in"] - stats["bytes_out"]
+        return stats
+
+    @staticmethod
+    def format_stats(stats):
+        """Формируем строку с итогами пакетной конвертации"""
+        saved_kb = stats["bytes_saved"] / 1024
+        message = (
+            f"Готово: {stats['converted']} изобр. за {stats['elapsed']:.2f} с "
+            f"({stats['images_per_sec']:.1f} изобр./с), сэкономлено {saved_kb:.1f} КБ"
+        )
+        if stats.get("cached"):
+            message += f", из кэша: {stats['cached']}"
+        if stats["failed"]:
+            message += f", ошибок: {len(stats['failed'])}"
+        return message
+
+
+class QRRenderer:
+    """Генерация QR-кодов с разбиением длинного текста на серию и кэшем изображений"""
+
+    ERROR_LEVELS = {
+        "L": qrcode.constants.ERROR_CORRECT_L,
+        "M": qrcode.constants.ERROR_CORRECT_M,
+        "Q": qrcode.constants.ERROR_CORRECT_Q,
+        "H": qrcode.constants.ERROR_CORRECT_H
+    }
+
+    # Емкость QR-кода версии 40 в байтовом режиме для каждого уровня коррекции
+    CAPACITY = {"L": 2953, "M": 2331, "Q": 1663, "H": 1273}
+
+    # Запас под заголовок серии вида "ATE:12/34:0123abcd|"
+    HEADER_RESERVE = 32
+
+    def __init__(self, cache_size=64):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_header(index, total, digest):
+        """Заголовок для сборки серии: номер части, количество частей и хэш всего текста"""
+        return f"ATE:{index}/{total}:{digest}|"
+
+    @staticmethod
+    def parse_chunks(chunks):
+        """Собираем исходный текст из распознанных частей серии (в любом порядке)"""
+        parts = {}
+        for chunk in chunks:
+            match = re.match(r"ATE:(\d+)/(\d+):([0-9a-f]{8})\|", chunk)
+            if not match:
+                return chunk
+            parts[int(match.group(1))] = chunk[match.end():]
+        return "".join(parts[i] for i in sorted(parts))
+
+    def split_text(self, text, error_level="L"):
+        """Разбиваем текст на части, каждая из которых помещается в один QR-код"""
+        data = text.encode("utf-8")
+        capacity = self.CAPACITY[error_level]
+        if len(data) <= capacity:
+            return [text]
+
+        limit = capacity - self.HEADER_RESERVE
+        pieces = []
+        start = 0
+        while start < len(data):
+            end = min(start + limit, len(data))
+            # Не разрываем многобайтовый символ UTF-8
+            while end < len(data) and (data[end] & 0xC0) == 0x80:
+                end -= 1
+            pieces.append(data[start:end].decode("utf-8"))
+            start = end
+
+        digest = hashlib.sha256(data).hexdigest()[:8]
+        total = len(pieces)
+        return [self.make_header(i, total, digest) + piece for i, piece in enumerate(pieces, 1)]
+
+    def render(self, data, error_level="L", box_size=10, border=4):
+        """Рендерим один QR-код, повторно используя готовое изображение из LRU-кэша"""
+        key = (hashlib.sha256(data.encode("utf-8")).hexdigest(), error_level, box_size, border)
+        img = self.cache.get(key)
+        if img is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return img
+
+        self.misses += 1
+        qr = qrcode.QRCode(
+            version=None,
+            error_correction=self.ERROR_LEVELS[error_level],
+            box_size=box_size,
+            border=border,
+        )
+        qr.add_data(data)
+        qr.make(fit=True)
+        img = qr.make_image(fill_color="black", back_color="white").get_image()
+
+        self.cache[key] = img
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return img
+
+
+def render_qr_bytes(job):
+    """Рендерим один QR-код в байты PNG/SVG (выполняется в дочернем процессе)"""
+    data, fmt, error_level, box_size, border = job
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=QRRenderer.ERROR_LEVELS[error_level],
+        box_size=box_size,
+        border=border,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+
+    output = BytesIO()
+    if fmt == "svg":
+        img = qr.make_image(image_factory=qrcode.image.svg.SvgPathImage)
+        img.save(output)
+    else:
+        img = qr.make_image(fill_color="black", back_color="white")
+        img.save(output, format="PNG")
+    return output.getvalue()
+
+
+class QRBulkExporter:
+    """Массовый экспорт QR-кодов: по одному на строку текста или строку CSV"""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or (os.cpu_count() or 2)
+
+    @staticmethod
+    def items_from_lines(text):
+        """Один элемент на каждую непустую строку"""
+        return [{"data": line, "fields": {}} for line in text.splitlines() if line.strip()]
+
+    @staticmethod
+    def items_from_csv(text, column=""):
+        """Один элемент на строку CSV; column - имя или номер столбца, иначе кодируется вся строка"""
+        sample = text[:64 * 1024]
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel
+        # Если заголовок не распознан, считаем первую строку данными, а не теряем ее
+        try:
+            has_header = csv.Sniffer().has_header(sample)
+        except csv.Error:
+            has_header = False
+
+        # StringIO, а не splitlines(): поля в кавычках могут содержать переводы строк
+        rows = list(csv.reader(StringIO(text), dialect))
+        if not rows:
+            return []
+        # Единственная строка - это данные, а не заголовок без данных
+        has_header = has_header and len(rows) > 1
+        header = rows[0] if has_header else [str(i) for i in range(len(rows[0]))]
+        body = rows[1:] if has_header else rows
+
+        column = column.strip()
+        col_index = None
+        if column:
+            if column in header:
+                col_index = header.index(column)
+            elif column.isdigit() and int(column) < len(header):
+                col_index = int(column)
+            else:
+                raise ValueError(f"Столбец не найден: {column}")
+
+        items = []
+        for row in body:
+            if not any(cell.strip() for cell in row):
+                continue
+            data = row[col_index] if col_index is not None and col_index < len(row) else dialect.delimiter.join(row)
+            items.append({"data": data, "fields": dict(zip(header, row))})
+        return items
+
+    @staticmethod
+    def make_filename(template, n, item, ext, used):
+        """Имя файла по шаблону: {n}, {text}, {hash} и имена столбцов CSV"""
+        fields = dict(item["fields"])
+        fields.update(
+            n=n,
+            text=item["data"][:40],
+            hash=hashlib.sha256(item["data"].encode("utf-8")).hexdigest()[:8]
+        )
+        try:
+            name = template.format(**fields)
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"Ошибка в шаблоне имени файла: {e}")
+
+        name = re.sub(r'[\\/:*?"<>|\r\n\t]+', "_", name).strip(" .")[:120] or str(n)
+        # Одинаковые имена получают номер элемента (и счетчик, если такое имя тоже занято)
+        if name in used:
+            base, suffix = f"{name}_{n}", 1
+            name = base
+            while name in used:
+                suffix += 1
+                name = f"{base}_{suffix}"
+        used.add(name)
+        return f"{name}.{ext}"
+
+    def export(self, items, folder, template="qr_{n:04d}", fmt="png", error_level="M",
+               box_size=10, border=4, as_zip=False, progress_callback=None):
+        """Генерируем QR-коды в пуле процессов и пишем их в папку или ZIP-архив.
+
+        progress_callback(done, total, rate) вызывается из потока, выполняющего экспорт.
+        """
+        started = time.perf_counter()
+        total = len(items)
+
+        # Имена считаем заранее, чтобы ошибка в шаблоне проявилась до запуска пула
+        used = set()
+        names = [self.make_filename(template, n, item, fmt, used) for n, item in enumerate(items, 1)]
+        jobs = [(item["data"], fmt, error_level, box_size, border) for item in items]
+
+        archive = None
+        if as_zip:
+            output_path = os.path.join(folder, "qrcodes.zip")
+            # PNG уже сжат, SVG хорошо сжимается
+            compression = zipfile.ZIP_DEFLATED if fmt == "svg" else zipfile.ZIP_STORED
+            archive = zipfile.ZipFile(output_path, "w", compression)
+        else:
+            output_path = folder
+
+        try:
+            chunksize = max(1, total // (self.max_workers * 8))
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                for done, (name, data) in enumerate(zip(names, executor.map(render_qr_bytes, jobs,
+                                                                             chunksize=chunksize)), 1):
+                    if archive:
+                        archive.writestr(name, data)
+                    else:
+                        with open(os.path.join(folder, name), "wb") as f:
+                            f.write(data)
+
+                    if progress_callback:
+                        elapsed = time.perf_counter() - started
+                        progress_callback(done, total, done / elapsed if elapsed > 0 else 0.0)
+        finally:
+            if archive:
+                archive.close()
+
+        elapsed = time.perf_counter() - started
+        return {
+            "count": total,
+            "elapsed": elapsed,
+            "per_sec": total / elapsed if elapsed > 0 else 0.0,
+            "path": output_path
+        }
+
+
+class CompiledExpression:
+    """Разобранное и проверенное выражение, готовое к многократному вычислению"""
+
+    def __init__(self, func, names, operations):
+        self.func = func
+        self.names = names
+        self.operations = operations
+
+
+class ExpressionEvaluator:
+    """Безопасный вычислитель выражений: белый список узлов AST вместо eval"""
+
+    MAX_LENGTH = 1000
+    MAX_OPERATIONS = 200
+    MAX_INT_BITS = 8192
+    MAX_FACTORIAL = 1000
+    # round(x, -n) строит 10**n: без ограничения это секунды и гигабайты
+    MAX_ROUND_DIGITS = 308
+
+    BIN_OPS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.Pow: operator.pow
+    }
+
+    UNARY_OPS = {
+        ast.UAdd: operator.pos,
+        ast.USub: operator.neg
+    }
+
+    CONSTANTS = {
+        "pi": math.pi,
+        "e": math.e,
+        "tau": math.tau
+    }
+
+    FUNCTION_NAMES = (
+        "sin", "cos", "tan", "asin", "acos", "atan", "atan2", "sinh", "cosh", "tanh",
+        "exp", "log", "log10", "log2", "sqrt", "ceil", "floor", "fabs", "factorial",
+        "degrees", "radians", "hypot", "gcd", "trunc"
+    )
+
+    def __init__(self, cache_size=256):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.functions = {name: getattr(math, name) for name in self.FUNCTION_NAMES}
+        self.functions.update(abs=abs, round=self.safe_round, min=min, max=max, factorial=self.safe_factorial)
+
+    @staticmethod
+    def normalize(expression):
+        """Приводим запись к синтаксису Python: ^, π, ×, ÷, постфиксный процент, '=' в конце"""
+        expr = expression.strip().rstrip("=").strip()
+        expr = expr.replace("^", "**").replace("π", "pi").replace("×", "*").replace("÷", "/")
+        # "50%" - это процент (/100), а "7 % 3" - остаток от деления
+        return re.sub(r"%(?!\s*[\w.(])", "/100", expr)
+
+    def compile(self, expression):
+        """Разбираем выражение и кэшируем результат (включая ошибки разбора)"""
+        expr = self.normalize(expression)
+        with self.lock:
+            compiled = self.cache.get(expr)
+            if compiled is not None:
+                self.cache.move_to_end(expr)
+        if compiled is None:
+            try:
+                compiled = self.build_expression(expr)
+            except ValueError as e:
+                compiled = e
+            with self.lock:
+                self.cache[expr] = compiled
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        if isinstance(compiled, ValueError):
+            raise compiled
+        return compiled
+
+    def build_expression(self, expr):
+        """Проверяем дерево разбора и собираем из него функцию вычисления"""
+        if not expr:
+            raise ValueError("Пустое выражение")
+        if len(expr) > self.MAX_LENGTH:
+            raise ValueError("Слишком длинное выражение")
+        try:
+            tree = ast.parse(expr, mode="eval")
+        except (SyntaxError, RecursionError, MemoryError):
+            raise ValueError("Синтаксическая ошибка")
+
+        names = set()
+        counter = {"operations": 0}
+        func = self.build_node(tree.body, names, counter)
+        return CompiledExpression(func, frozenset(names), counter["operations"])
+
+    def build_node(self, node, names, counter):
+        """Рекурсивно превращаем разрешенный узел AST в замыкание"""
+        if isinstance(node, ast.Constant):
+            value = node.value
+            if type(value) not in (int, float):
+                raise ValueError(f"Недопустимое значение: {value!r}")
+            return lambda env: value
+
+        if isinstance(node, ast.Name):
+            name = node.id
+            names.add(name)
+
+            def load(env):
+                if name not in env:
+                    raise ValueError(f"Неизвестная переменная: {name}")
+                return env[name]
+            return load
+
+        self.count_operation(counter)
+
+        if isinstance(node, ast.BinOp) and type(node.op) in self.BIN_OPS:
+            op = self.BIN_OPS[type(node.op)]
+            left = self.build_node(node.left, names, counter)
+            right = self.build_node(node.right, names, counter)
+            if op is operator.pow:
+                return lambda env: self.check_result(self.safe_pow(left(env), right(env)))
+            return lambda env: self.check_result(op(left(env), right(env)))
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in self.UNARY_OPS:
+            op = self.UNARY_OPS[type(node.op)]
+            operand = self.build_node(node.operand, names, counter)
+            return lambda env: op(operand(env))
+
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in self.functions:
+                raise ValueError("Недопустимая функция")
+            if node.keywords or any(isinstance(arg, ast.Starred) for arg in node.args):
+                raise ValueError("Недопустимые аргументы функции")
+            function = self.functions[node.func.id]
+            args = [self.build_node(arg, names, counter) for arg in node.args]
+            return lambda env: self.check_result(function(*(arg(env) for arg in args)))
+
+        raise ValueError(f"Недопустимая конструкция: {type(node).__name__}")
+
+    def count_operation(self, counter):
+        """Ограничиваем количество операций в выражении"""
+        counter["operations"] += 1
+        if counter["operations"] > self.MAX_OPERATIONS:
+            raise ValueError("Слишком много операций в выражении")
+
+    def safe_pow(self, base, exponent):
+        """Возведение в степень с оценкой размера результата до вычисления"""
+        if isinstance(base, int) and isinstance(exponent, int) and exponent > 0 and abs(base) > 1:
+            if exponent * math.log2(abs(base)) > self.MAX_INT_BITS:
+                raise ValueError("Слишком большая степень")
+        elif isinstance(exponent, (int, float)) and abs(exponent) > 1e6 and abs(base) != 1:
+            raise ValueError("Слишком большая степень")
+        return base ** exponent
+
+    def safe_factorial(self, value):
+        """Факториал с ограничением аргумента"""
+        if value > self.MAX_FACTORIAL:
+            raise ValueError("Слишком большой аргумент факториала")
+        return math.factorial(value)
+
+    def safe_round(self, value, ndigits=None):
+        """Округление с ограничением числа знаков"""
+        if ndigits is None:
+            return round(value)
+        if not isinstance(ndigits, int):
+            raise ValueError("Число знаков округления должно быть целым")
+        if abs(ndigits) > self.MAX_ROUND_DIGITS:
+            raise ValueError("Слишком большое число знаков округления")
+        return round(value, ndigits)
+
+    def check_result(self, value):
+        """Отсекаем комплексные результаты и слишком большие целые числа"""
+        if isinstance(value, complex):
+            raise ValueError("Комплексный результат")
+        if isinstance(value, int) and value.bit_length() > self.MAX_INT_BITS:
+            raise ValueError("Слишком большое число")
+        return value
+
+    def evaluate(self, expression, variables=None):
+        """Вычисляем выражение; переменные дополняют встроенные константы"""
+        compiled = self.compile(expression)
+        env = dict(self.CONSTANTS)
+        if variables:
+            env.update(variables)
+        try:
+            return compiled.func(env)
+        except ValueError:
+            raise
+        except (ArithmeticError, TypeError) as e:
+            raise ValueError(str(e))
+
+    def is_expression(self, text, variables=None):
+        """Выражение с хотя бы одной операцией и только известными именами"""
+        try:
+            compiled = self.compile(text)
+        except ValueError:
+            return False
+        known = set(self.CONSTANTS)
+        if variables:
+            known.update(variables)
+        return compiled.operations > 0 and compiled.names <= known
+
+
+class DocumentCalculator:
+    """Пакетное вычисление выражений в документе и итоги по числам"""
+
+    # Выражение - хвост строки перед "=" в ее конце: "Итого: 12*4.5 =".
+    # Строка делится на лексемы за один проход (без возвратов): числа, операторы, пробелы
+    # и слова из букв; выражение начинается после последней недопустимой лексемы
+    EXPRESSION_TOKEN = re.compile(r"\d+(?:\.\d*)?|\.\d+|[-+*/^%()×÷π,]|[ \t]+|(?P<word>[^\W\d_π]+)|(?P<other>.)")
+    WORD_CHAR = re.compile(r"\w")
+    EXPRESSION_WORDS = frozenset(ExpressionEvaluator.FUNCTION_NAMES + ("abs", "round", "min", "max")
+                                 + tuple(ExpressionEvaluator.CONSTANTS))
+
+    # Число; минус считается знаком только если перед ним нет буквы/цифры ("2024-01" - два числа).
+    # Десятичная запятая ("3,5") - одно число; перечисление через запятую ("1,2,3") - несколько
+    NUMBER_PATTERN = re.compile(r"(?:(?<![\w.])-)?(?:(?<!\d,)\d+,\d+(?![,\d])|\d+(?:\.\d+)?|\.\d+)"
+                                r"(?:[eE][-+]?\d+)?")
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+
+    @staticmethod
+    def format_number(value):
+        """Форматируем результат: округляем дробные, убираем лишний .0"""
+        if isinstance(value, float):
+            value = round(value, 4)
+            if value.is_integer():
+                return str(int(value))
+        return str(value)
+
+    def evaluate_all(self, text):
+        """Вычисляем все выражения вида "выражение =" и дописываем результаты.
+
+        Возвращает (новый текст, количество вычисленных, количество ошибок).
+        """
+        pieces = []
+        evaluated = 0
+        errors = 0
+
+        for line in text.splitlines(keepends=True):
+            body = line.rstrip("\r\n")
+            stripped = body.rstrip(" \t")
+            if not stripped.endswith("="):
+                pieces.append(line)
+                continue
+            expr = self.trailing_expression(stripped[:-1]).strip()
+            if not self.evaluator.is_expression(expr):
+                pieces.append(line)
+                continue
+            try:
+                result = self.evaluator.evaluate(expr)
+            except ValueError:
+                errors += 1
+                pieces.append(line)
+                continue
+
+            pieces.append(body)
+            if not body.endswith((" ", "\t")):
+                pieces.append(" ")
+            pieces.append(self.format_number(result))
+            pieces.append(line[len(body):])
+            evaluated += 1
+
+        return "".join(pieces), evaluated, errors
+
+    @classmethod
+    def trailing_expression(cls, text):
+        """Самый длинный хвост text из чисел, операторов, пробелов и известных функций и констант"""
+        start = 0
+        for match in cls.EXPRESSION_TOKEN.finditer(text):
+            if match.group("other") is not None:
+                start = match.end()
+            elif match.group("word") is not None:
+                # Имя допустимо только целым словом: "sin2" и "2pi" - не функция и не константа
+                begin, end = match.span()
+                if (match.group("word") not in cls.EXPRESSION_WORDS
+                        or (begin and cls.WORD_CHAR.match(text, begin - 1))
+                        or cls.WORD_CHAR.match(text, end)):
+                    start = end
+        return text[start:]
+
+    @staticmethod
+    def split_column(text, column):
+        """Берем столбец (с 1) из строк; разделитель определяем по первой непустой строке"""
+        lines = [line for line in text.splitlines() if line.strip()]
+        if not lines:
+            return ""
+        delimiter = next((d for d in ("\t", ";", ",", "|") if d in lines[0]), None)
+        index = column - 1
+        cells = []
+        for line in lines:
+            parts = line.split(delimiter) if delimiter else line.split()
+            if index < len(parts):
+                cells.append(parts[index])
+        return "\n".join(cells)
+
+    def extract_numbers(self, text, column=None):
+        """Находим все числа в тексте или в указанном столбце (десятичная запятая заменяется точкой)"""
+        if column:
+            text = self.split_column(text, column)
+        return [number.replace(",", ".") for number in self.NUMBER_PATTERN.findall(text)]
+
+    def aggregate(self, text, column=None):
+        """Сумма, среднее, минимум, максимум и медиана по всем числам (NumPy, если доступен)"""
+        found = self.extract_numbers(text, column)
+        if not found:
+            return None
+
+        if np is not None:
+            values = np.array(found, dtype=np.float64)
+            return {
+                "count": int(values.size),
+                "sum": float(values.sum()),
+                "avg": float(values.mean()),
+                "min": float(values.min()),
+                "max": float(values.max()),
+                "median": float(np.median(values))
+            }
+
+        values = sorted(map(float, found))
+        count = len(values)
+        middle = count // 2
+        median = values[middle] if count % 2 else (values[middle - 1] + values[middle]) / 2
+        total = math.fsum(values)
+        return {
+            "count": count,
+            "sum": total,
+            "avg": total / count,
+            "min": values[0],
+            "max": values[-1],
+            "median": median
+        }
+
+
+class Win32ClipboardBackend:
+    """Доступ к буферу обмена Windows через Win32 API"""
+
+    OPEN_ATTEMPTS = 20
+
+    def open_clipboard(self):
+        """Открываем буфер обмена, повторяя попытки, если его держит другое приложение"""
+        for _ in range(self.OPEN_ATTEMPTS):
+            try:
+                win32clipboard.OpenClipboard()
+                return
+            except Exception:
+                time.sleep(0.005)
+        raise RuntimeError("Буфер обмена занят другим приложением")
+
+    def get_sequence_number(self):
+        """Номер версии буфера обмена, увеличивается при каждом изменении"""
+        return win32clipboard.GetClipboardSequenceNumber()
+
+    def get_text(self):
+        """Текст из буфера обмена или None, если там не текст"""
+        self.open_clipboard()
+        try:
+            return win32clipboard.GetClipboardData(win32con.CF_UNICODETEXT)
+        except TypeError:
+            return None
+        finally:
+            win32clipboard.CloseClipboard()
+
+    def set_text(self, text):
+        """Помещаем текст в буфер обмена"""
+        self.open_clipboard()
+        try:
+            win32clipboard.EmptyClipboard()
+            win32clipboard.SetClipboardText(text, win32con.CF_UNICODETEXT)
+        finally:
+            win32clipboard.CloseClipboard()
+
+    def request_copy(self):
+        """Просим активное окно скопировать выделение (без имитации клавиш)"""
+        hwnd = win32gui.GetForegroundWindow()
+        win32gui.SendMessage(hwnd, win32con.WM_COPY, 0, 0)
+
+
+class FakeClipboardBackend:
+    """Буфер обмена в памяти: для тестов и систем без Win32"""
+
+    def __init__(self, selection=None, copy_delay=0.0):
+        # selection - текст, выделенный в "активном окне" (None - ничего не выделено)
+        self.selection = selection
+        self.copy_delay = copy_delay
+        self.text = None
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def get_sequence_number(self):
+        with self.lock:
+            return self.sequence
+
+    def get_text(self):
+        with self.lock:
+            return self.text
+
+    def set_text(self, text):
+        with self.lock:
+            self.text = text
+            self.sequence += 1
+
+    def request_copy(self):
+        if self.selection is None:
+            return
+        if self.copy_delay:
+            # Имитируем приложение, которое копирует асинхронно
+            threading.Timer(self.copy_delay, self.set_text, [self.selection]).start()
+        else:
+            self.set_text(self.selection)
+
+
+class SelectionCapture:
+    """Получение выделенного текста активного окна через буфер обмена"""
+
+    def __init__(self, backend, timeout=0.3, poll_interval=0.002):
+        self.backend = backend
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def capture(self):
+        """Копируем выделение, ждем смены номера версии буфера и восстанавливаем исходный текст.
+
+        Возвращает выделенный текст или пустую строку, если за timeout ничего не скопировалось.
+        """
+        original = self.backend.get_text()
+        sequence = self.backend.get_sequence_number()
+        self.backend.request_copy()
+
+        # Вместо фиксированной паузы ждем ровно до момента, когда приложение положит текст в буфер
+        deadline = time.perf_counter() + self.timeout
+        while self.backend.get_sequence_number() == sequence:
+            if time.perf_counter() >= deadline:
+                return ""
+            time.sleep(self.poll_interval)
+
+        selected_text = self.backend.get_text() or ""
+        # Нетекстовое содержимое восстановить нельзя - оставляем скопированное
+        if original is not None and original != selected_text:
+            self.backend.set_text(original)
+        return selected_text
+
+
+class BlobStore:
+    """Хранилище текстов по хэшу содержимого: одинаковый текст хранится один раз"""
+
+    def __init__(self, directory="blobs", writer=None):
+        self.directory = directory
+        # Фоновая запись (PersistenceWriter); без нее файлы пишутся сразу
+        self.writer = writer
+        self.texts = {}  # хэш -> текст (загруженные в память)
+        self.refs = Counter()  # хэш -> количество записей истории/избранного, ссылающихся на текст
+
+    @staticmethod
+    def hash_text(text):
+        """Хэш содержимого, по которому текст хранится и сравнивается"""
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.txt")
+
+    def add(self, text, key=None):
+        """Добавляем ссылку на текст; на диск текст пишется только при первом появлении"""
+        key = key or self.hash_text(text)
+        self.texts[key] = text
+        self.refs[key] += 1
+
+        path = self.path(key)
+        if self.writer:
+            # Файл мог стоять в очереди на удаление: новая запись заменит удаление
+            if self.refs[key] == 1:
+                self.writer.write_text(path, text)
+        elif not os.path.exists(path):
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+                    f.write(text)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Не удалось сохранить текст в хранилище: {e}")
+        return key
+
+    def retain(self, key):
+        """Учитываем ссылку на уже сохраненный текст (при загрузке истории)"""
+        self.refs[key] += 1
+
+    def release(self, key):
+        """Снимаем ссылку; текст без ссылок удаляется из памяти и с диска"""
+        self.refs[key] -= 1
+        if self.refs[key] > 0:
+            return
+        del self.refs[key]
+        self.texts.pop(key, None)
+        if self.writer:
+            self.writer.remove(self.path(key))
+            return
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        """Текст по хэшу (с диска читается один раз)"""
+        text = self.texts.get(key)
+        if text is None:
+            text = self.load(self.path(key))
+            self.texts[key] = text
+        return text
+
+    @staticmethod
+    def load(path):
+        """Читаем файл текста (без кэша - можно вызывать из фонового потока)"""
+        try:
+            with open(path, "r", encoding="utf-8", newline="") as f:
+                return f.read()
+        except OSError:
+            return ""
+
+    def collect_garbage(self):
+        """Удаляем с диска тексты, на которые больше никто не ссылается"""
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext == ".tmp" or (ext == ".txt" and key not in self.refs):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+class PersistenceWriter:
+    """Единственный поток записи файлов: поток Tk только ставит запись в очередь и не ждет диска.
+
+    Повторные записи одного файла в пределах окна склеиваются - пишется последняя версия.
+    Запись атомарная: во временный файл рядом, затем замена. Удаление файла идет через ту же
+    очередь, поэтому порядок "записать, затем удалить" для одного пути сохраняется.
+    """
+
+    COALESCE_SECONDS = 0.3
+    LATENCY_SAMPLES = 200
+
+    def __init__(self, coalesce_seconds=None, on_error=None):
+        self.coalesce_seconds = self.COALESCE_SECONDS if coalesce_seconds is None else coalesce_seconds
+        self.on_error = on_error
+        # путь -> (операция, данные, срок записи); срок задает первая запись в окне
+        self.pending = {}
+        self.active = None
+        self.active_entry = None  # (операция, данные) записи, которая выполняется сейчас
+        self.closed = False
+        self.condition = threading.Condition()
+        self.latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self.writes = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.bytes_written = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write_json(self, path, data):
+        """Ставим в очередь запись JSON. Записи истории не меняются после создания,
+        поэтому достаточно поверхностной копии списка/словаря"""
+        self.submit(path, "json", data.copy())
+
+    def write_text(self, path, text):
+        self.submit(path, "text", text)
+
+    def write_bytes(self, path, data):
+        self.submit(path, "bytes", data)
+
+    def remove(self, path):
+        self.submit(path, "remove", None)
+
+    def submit(self, path, kind, payload):
+        if self.closed:
+            self.write(path, kind, payload)
+            return
+        with self.condition:
+            previous = self.pending.get(path)
+            if previous:
+                self.coalesced += 1
+                deadline = previous[2]
+            else:
+                deadline = time.monotonic() + self.coalesce_seconds
+            self.pending[path] = (kind, payload, deadline)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.pending:
+                        path = min(self.pending, key=lambda key: self.pending[key][2])
+                        delay = self.pending[path][2] - time.monotonic()
+                        if delay <= 0:
+                            break
+                        self.condition.wait(delay)
+                    elif self.closed:
+                        return
+                    else:
+                        self.condition.wait()
+                kind, payload, _ = self.pending.pop(path)
+                self.active = path
+                self.active_entry = (kind, payload)
+
+            started = time.perf_counter()
+            try:
+                self.write(path, kind, payload)
+            except Exception as e:
+                self.errors += 1
+                if self.on_error:
+                    self.on_error(path, e)
+                else:
+                    print(f"Не удалось записать {path}: {e}")
+            self.latencies.append(time.perf_counter() - started)
+
+            with self.condition:
+                self.active = self.active_entry = None
+                self.writes += 1
+                self.condition.notify_all()
+
+    def write(self, path, kind, payload):
+        """Выполняем одну операцию записи"""
+        if kind == "remove":
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        if kind == "bytes":
+            f = open(tmp_path, "wb")
+        else:
+            f = open(tmp_path, "w", encoding="utf-8", newline="" if kind == "text" else None)
+        with f:
+            if kind == "json":
+                json.dump(payload, f, ensure_ascii=False, indent=2)
+            else:
+                f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        self.bytes_written += os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+    def pending_payload(self, path):
+        """Еще не записанная на диск операция для path: (операция, данные) или None, если файл актуален"""
+        with self.condition:
+            if path in self.pending:
+                return self.pending[path][:2]
+            if path == self.active:
+                return self.active_entry
+            return None
+
+    def flush(self, timeout=None):
+        """Пишем все отложенное сразу и ждем окончания; False, если не успели за timeout"""
+        with self.condition:
+            for path, (kind, payload, _) in self.pending.items():
+                self.pending[path] = (kind, payload, 0)
+            self.condition.notify_all()
+            return self.condition.wait_for(lambda: not self.pending and self.active is None, timeout)
+
+    def close(self, timeout=5.0):
+        """Дописываем очередь и останавливаем поток (при выходе из приложения)"""
+        flushed = self.flush(timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        return flushed
+
+    def stats(self):
+        """Метрики: глубина очереди, число записей, склеенные записи, ошибки, задержка записи"""
+        with self.condition:
+            queued = len(self.pending) + (self.active is not None)
+        latencies = sorted(self.latencies)
+        return {
+            "queued": queued,
+            "writes": self.writes,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "bytes": self.bytes_written,
+            "p50": Instrumentation.percentile(latencies, 0.5) if latencies else 0.0,
+            "p95": Instrumentation.percentile(latencies, 0.95) if latencies else 0.0,
+        }
+
+
+class HistoryArchive:
+    """Холодный уровень истории: старые записи лежат в сжатых сегментах.
+
+    Сегмент N - два файла: NNNNNN.json (индекс: время, размер и превью каждой записи)
+    и NNNNNN.zlib (тексты записей, сжатый zlib JSON-список в том же порядке).
+    При запуске архив не читается: индексы читаются при просмотре старых записей,
+    тексты распаковываются только при восстановлении записи или поиске.
+    """
+
+    SEGMENT_ENTRIES = 50
+    PREVIEW_CHARS = 100
+    CACHE_SEGMENTS = 2
+    COMPRESSION_LEVEL = 6
+
+    def __init__(self, writer, directory="history_archive"):
+        self.writer = writer
+        self.directory = directory
+        self.numbers = None  # номера сегментов по возрастанию; каталог читается при первом обращении
+        self.cache = OrderedDict()  # номер -> тексты распакованного сегмента
+        # Архивирование и поиск идут в фоне, удаление - в потоке Tk
+        self.lock = threading.RLock()
+
+    @classmethod
+    def make_preview(cls, text):
+        """Строка превью для списка истории"""
+        return text[:cls.PREVIEW_CHARS] + "..." if len(text) > cls.PREVIEW_CHARS else text
+
+    def index_path(self, number):
+        return os.path.join(self.directory, f"{number:06d}.json")
+
+    def segment_path(self, number):
+        return os.path.join(self.directory, f"{number:06d}.zlib")
+
+    def segments(self):
+        """Номера сегментов по возрастанию (копия)"""
+        with self.lock:
+            if self.numbers is None:
+                self.numbers = []
+                if os.path.isdir(self.directory):
+                    for name in os.listdir(self.directory):
+                        stem, ext = os.path.splitext(name)
+                        if ext == ".zlib" and stem.isdigit():
+                            self.numbers.append(int(stem))
+                    self.numbers.sort()
+            return list(self.numbers)
+
+    def append(self, entries):
+        """Пишем новый сегмент из записей [(время, текст)] от старых к новым; возвращаем его номер"""
+        with self.lock:
+            numbers = self.segments()
+            number = numbers[-1] + 1 if numbers else 1
+            texts = [text for _, text in entries]
+            index = [{"timestamp": timestamp, "size": len(text), "preview": self.make_preview(text)}
+                     for timestamp, text in entries]
+            self.store(number, index, texts)
+            self.numbers.append(number)
+            return number
+
+    def store(self, number, index, texts):
+        data = zlib.compress(json.dumps(texts, ensure_ascii=False).encode("utf-8"), self.COMPRESSION_LEVEL)
+        # Сегмент ставится в очередь раньше индекса и пишется раньше него
+        self.writer.write_bytes(self.segment_path(number), data)
+        self.writer.write_json(self.index_path(number), index)
+        self.cache[number] = texts
+        self.trim_cache()
+
+    def trim_cache(self):
+        while len(self.cache) > self.CACHE_SEGMENTS:
+            self.cache.popitem(last=False)
+
+    def pending_data(self, path):
+        """Данные файла сегмента, еще стоящие в очереди записи (None - читаем с диска).
+        Очередь не сбрасываем: чтение идет и из потока Tk"""
+        entry = self.writer.pending_payload(path)
+        if entry is None:
+            return None
+        kind, payload = entry
+        if kind == "remove":
+            raise FileNotFoundError(path)
+        return payload
+
+    def read_index(self, number):
+        """Индекс сегмента (без распаковки текстов)"""
+        index = self.pending_data(self.index_path(number))
+        if index is not None:
+            return list(index)
+        with open(self.index_path(number), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def read_texts(self, number, cache=True):
+        """Тексты сегмента (распаковываются при первом обращении)"""
+        with self.lock:
+            texts = self.cache.get(number)
+            if texts is not None:
+                self.cache.move_to_end(number)
+                return texts
+        data = self.pending_data(self.segment_path(number))
+        if data is None:
+            with open(self.segment_path(number), "rb") as f:
+                data = f.read()
+        texts = json.loads(zlib.decompress(data).decode("utf-8"))
+        if cache:
+            with self.lock:
+                self.cache[number] = texts
+                self.trim_cache()
+        return texts
+
+    def text(self, number, position):
+        return self.read_texts(number)[position]
+
+    def remove(self, number, position):
+        """Удаляем запись; пустой сегмент удаляется целиком. Возвращаем число оставшихся в сегменте записей"""
+        with self.lock:
+            index = self.read_index(number)
+            texts = list(self.read_texts(number))
+            del index[position]
+            del texts[position]
+            if index:
+                self.store(number, index, texts)
+                return len(index)
+            self.writer.remove(self.segment_path(number))
+            self.writer.remove(self.index_path(number))
+            self.cache.pop(number, None)
+            self.numbers.remove(number)
+            return 0
+
+    def search(self, query, cancelled=None):
+        """Записи, содержащие query (без учета регистра), от новых к старым: [(номер, позиция, запись индекса)].
+        Сегменты распаковываются по одному и не задерживаются в кэше; None - поиск отменен"""
+        query = query.lower()
+        matches = []
+        for number in reversed(self.segments()):
+            if cancelled and cancelled():
+                return None
+            try:
+                texts = self.read_texts(number, cache=False)
+            except OSError:
+                continue  # сегмент удален во время поиска
+            index = None
+            for position in range(len(texts) - 1, -1, -1):
+                if query in texts[position].lower():
+                    index = index or self.read_index(number)
+                    matches.append((number, position, index[position]))
+        return matches
+
+
+class FuzzySearchIndex:
+    """Нечеткий поиск с опечатками: триграммный индекс и проверка кандидатов алгоритмом bitap.
+
+    Кандидаты берутся из списков самых редких триграмм запроса: k правок (замена, вставка,
+    удаление, перестановка соседних символов) разрушают не больше 4k триграмм, поэтому
+    совпадение содержит хотя бы одну из (n - порог + 1) самых редких.
+    Кандидат проверяется точным поиском, затем bitap (Wu-Manber) с k ошибками в окнах
+    вокруг всех вхождений этих триграмм. Ранжирование: меньше ошибок, затем свежее (позже добавлено).
+    Удаление ленивое: id пропадает из docs, списки триграмм чистятся при перестройке.
+    """
+
+    INDEX_CHARS = 10000
+    SNIPPET_CONTEXT = 30
+    TIME_BUDGET = 0.04
+
+    def __init__(self):
+        self.docs = {}  # id -> [ключ, данные записи, текст (первые INDEX_CHARS символов), он же в нижнем регистре]
+        self.ids = {}  # ключ -> id
+        self.postings = {}  # триграмма -> array id по возрастанию
+        self.next_id = 0
+        self.stale = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    @staticmethod
+    def trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @staticmethod
+    def allowed_errors(length):
+        """Допустимое число опечаток для запроса длины length"""
+        if length <= 3:
+            return 0
+        return 1 if length <= 7 else 2
+
+    def add(self, key, info, text):
+        """Индексируем запись; id растут, поэтому больший id - более свежая запись"""
+        if key in self.ids:
+            self.remove(key)
+        sample = text[:self.INDEX_CHARS]
+        lowered = sample.lower()
+        doc_id = self.next_id
+        self.next_id += 1
+        # Нижний регистр храним, если он отличается: проверка кандидата не тратит время на lower()
+        self.docs[doc_id] = [key, info, sample, lowered if lowered != sample else sample]
+        self.ids[key] = doc_id
+        for gram in self.trigrams(lowered):
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array('I')
+            posting.append(doc_id)
+
+    def remove(self, key):
+        doc_id = self.ids.pop(key, None)
+        if doc_id is None:
+            return
+        del self.docs[doc_id]
+        self.stale += 1
+        if self.stale > len(self.docs) and self.stale > 1000:
+            self.compact()
+
+    def rekey(self, old_key, new_key, info=None):
+        """Запись сменила ключ (перенесена в архив, сдвинулась в сегменте); текст не переиндексируется"""
+        doc_id = self.ids.pop(old_key, None)
+        if doc_id is None:
+            return
+        self.ids[new_key] = doc_id
+        doc = self.docs[doc_id]
+        doc[0] = new_key
+        if info is not None:
+            doc[1] = info
+
+    def info(self, key):
+        doc_id = self.ids.get(key)
+        return None if doc_id is None else self.docs[doc_id][1]
+
+    def compact(self):
+        """Убираем удаленные id из списков триграмм"""
+        for gram, posting in list(self.postings.items()):
+            alive = array('I', (doc_id for doc_id in posting if doc_id in self.docs))
+            if alive:
+                self.postings[gram] = alive
+            else:
+                del self.postings[gram]
+        self.stale = 0
+
+    def candidates(self, query, errors):
+        """id записей, которые могут содержать query с errors ошибками, от новых к старым.
+
+        Генератор: списки триграмм отсортированы, поэтому они сливаются лениво и поиск,
+        остановленный по времени, не платит за объединение всех списков.
+        """
+        grams = sorted(self.trigrams(query), key=lambda gram: len(self.postings.get(gram, ())))
+        if not grams:
+            # Запрос короче триграммы - проверяем все записи (id добавляются по возрастанию)
+            yield from reversed(self.docs)
+            return
+        # Для коротких запросов с опечатками гарантии нет: требуем хотя бы одну общую триграмму
+        threshold = max(1, len(grams) - 4 * errors)
+        postings = [self.postings[gram] for gram in grams[:len(grams) - threshold + 1] if gram in self.postings]
+        last = None
+        for doc_id in heapq.merge(*(reversed(posting) for posting in postings), reverse=True):
+            if doc_id != last:
+                last = doc_id
+                yield doc_id
+
+    @staticmethod
+    def bitap(pattern, text, errors):
+        """Wu-Manber: (ошибок, конец совпадения) для лучшего вхождения pattern в text или None.
+
+        Расстояние - optimal string alignment: перестановка двух соседних символов ("histroy")
+        считается одной ошибкой, как замена, вставка или удаление.
+        """
+        masks = {}
+        for i, char in enumerate(pattern):
+            masks[char] = masks.get(char, 0) | (1 << i)
+        found = 1 << (len(pattern) - 1)
+        rows = [(1 << d) - 1 for d in range(errors + 1)]
+        older = rows[:]  # строки на позицию раньше предыдущей - для перестановки
+        last_mask = 0
+        best = None
+        for position, char in enumerate(text):
+            mask = masks.get(char, 0)
+            # Перестановка: pattern[i - 1] == char, pattern[i] == предыдущий символ текста
+            swapped = (mask << 1) & last_mask
+            before = rows[:]
+            previous = rows[0]
+            rows[0] = ((previous << 1) | 1) & mask
+            for d in range(1, errors + 1):
+                old = rows[d]
+                # совпадение | замена | лишний символ текста | пропущенный символ шаблона | перестановка
+                rows[d] = ((((old << 1) | 1) & mask) | ((previous << 1) | 1) | previous |
+                           ((rows[d - 1] << 1) | 1) | (((older[d - 1] << 2) | 2) & swapped))
+                previous = old
+            older = before
+            last_mask = mask
+            for d in range(errors + 1 if best is None else best[0]):
+                if rows[d] & found:
+                    best = (d, position + 1)
+                    break
+            if best and best[0] == 0:
+                break
+        return best
+
+    def verify(self, query, positional, threshold, text, errors):
+        """Лучшее совпадение query в тексте: (ошибок, начало, конец) или None"""
+        start = text.find(query)
+        if start >= 0:
+            return 0, start, start + len(query)
+        if not errors:
+            return None
+        # Дешевый отсев до bitap: в тексте должно найтись достаточно триграмм запроса
+        if sum(gram in text for _, gram in positional) < threshold:
+            return None
+
+        # Совпадение сохраняет хотя бы одну из (n - порог + 1) самых редких триграмм, но не обязательно
+        # первое ее вхождение: окна строим вокруг каждого вхождения, пересекающиеся склеиваем
+        windows = []
+        for offset, gram in positional[:len(positional) - threshold + 1]:
+            anchor = text.find(gram)
+            while anchor >= 0:
+                windows.append((max(0, anchor - offset - errors), anchor - offset + len(query) + 2 * errors))
+                anchor = text.find(gram, anchor + 1)
+        windows.sort()
+
+        best = None
+        merged = []
+        for begin, end in windows:
+            if merged and begin <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([begin, end])
+        for begin, end in merged:
+            result = self.bitap(query, text[begin:end], errors)
+            if result and (best is None or result[0] < best[0]):
+                end = begin + result[1]
+                best = (result[0], max(0, end - len(query)), end)
+                if best[0] == 1:
+                    break
+        return best
+
+    def snippet(self, text, start, end):
+        """Фрагмент вокруг совпадения, само совпадение выделено «»"""
+        before = text[max(0, start - self.SNIPPET_CONTEXT):start]
+        after = text[end:end + self.SNIPPET_CONTEXT]
+        snippet = f"{before}«{text[start:end]}»{after}"
+        snippet = " ".join(snippet.split())
+        if start > self.SNIPPET_CONTEXT:
+            snippet = "…" + snippet
+        if end + self.SNIPPET_CONTEXT < len(text):
+            snippet += "…"
+        return snippet
+
+    def search(self, query, limit=20):
+        """Лучшие limit записей: [(ключ, данные записи, ошибок, фрагмент)]; второй элемент - проверены ли все кандидаты"""
+        # Бюджет времени включает и подбор кандидатов
+        deadline = time.perf_counter() + self.TIME_BUDGET
+        query = query.lower()
+        if not query:
+            return [], True
+        errors = self.allowed_errors(len(query))
+        positional = [(i, query[i:i + 3]) for i in range(len(query) - 2)]
+        threshold = max(1, len(positional) - 4 * errors)
+        # Редкие триграммы лучше как якоря
+        positional.sort(key=lambda item: len(self.postings.get(item[1], ())))
+
+        candidates = self.candidates(query, errors)
+        matches = []
+        exact = 0
+        complete = True
+        for checked, doc_id in enumerate(candidates):
+            # Кандидаты идут от новых к старым: набрав limit точных, лучше уже не найти
+            if exact >= limit:
+                break
+            if checked % 64 == 0 and time.perf_counter() > deadline:
+                complete = False
+                break
+            doc = self.docs.get(doc_id)
+            if doc is None:
+                continue
+            result = self.verify(query, positional, threshold, doc[3], errors)
+            if result:
+                matches.append((result[0], -doc_id, doc, result))
+                exact += result[0] == 0
+
+        matches.sort(key=lambda match: match[:2])
+        return [(doc[0], doc[1], found[0], self.snippet(doc[2], found[1], found[2]))
+                for _, _, doc, found in matches[:limit]], complete
+
+
+class TextDiff:
+    """Построчное сравнение двух текстов с подсветкой измененных слов.
+
+    Строки сопоставляются алгоритмом patience: общие начало и конец отбрасываются,
+    участок делится строками, которые встречаются ровно один раз в обоих текстах.
+    Участки без таких строк сравниваются алгоритмом Майерса. Результат - фрагменты
+    с контекстом, как в unified diff; сравнения кэшируются по паре хэшей текстов.
+    """
+
+    CONTEXT_LINES = 3
+    # Дальше Майерс не ищет: участок считается замененным целиком (память растет как квадрат)
+    MAX_EDIT_COST = 1000
+    # Пословная подсветка только для замен не длиннее (символов с обеих сторон)
+    WORD_DIFF_CHARS = 20000
+    TOKEN_PATTERN = re.compile(r"\w+|\n|[^\S\n]+|[^\w\s]")
+
+    def __init__(self, cache_size=16):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # (хэш старого, хэш нового) -> результат
+        self.lock = threading.Lock()  # сравнения идут в фоновых потоках
+        self.hits = 0
+        self.misses = 0
+
+    def compare(self, old, new):
+        """Сравниваем тексты: {"hunks": [...], "added": n, "removed": n}.
+
+        Фрагмент - {"header": "@@ -a,b +c,d @@", "lines": [(вид, строка, [(начало, конец)])]},
+        где вид - " ", "-" или "+", а пары - измененные слова внутри строки.
+        """
+        key = (BlobStore.hash_text(old), BlobStore.hash_text(new))
+        with self.lock:
+            result = self.cache.get(key)
+            if result is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        result = self.build(old.splitlines(), new.splitlines())
+        with self.lock:
+            self.cache[key] = result
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def build(self, old_lines, new_lines):
+        ops = self.opcodes(old_lines, new_lines)
+        hunks = []
+        for group in self.group_opcodes(ops):
+            lines = []
+            for tag, i1, i2, j1, j2 in group:
+                if tag == "equal":
+                    lines.extend((" ", line, ()) for line in old_lines[i1:i2])
+                    continue
+                old_spans, new_spans = {}, {}
+                if tag == "replace":
+                    old_spans, new_spans = self.word_changes(old_lines[i1:i2], new_lines[j1:j2])
+                lines.extend(("-", old_lines[i], old_spans.get(i - i1, ())) for i in range(i1, i2))
+                lines.extend(("+", new_lines[j], new_spans.get(j - j1, ())) for j in range(j1, j2))
+            first, last = group[0], group[-1]
+            header = (f"@@ -{first[1] + 1},{last[2] - first[1]} "
+                      f"+{first[3] + 1},{last[4] - first[3]} @@")
+            hunks.append({"header": header, "lines": lines})
+
+        removed = sum(i2 - i1 for tag, i1, i2, _, _ in ops if tag != "equal")
+        added = sum(j2 - j1 for tag, _, _, j1, j2 in ops if tag != "equal")
+        return {"hunks": hunks, "added": added, "removed": removed}
+
+    def opcodes(self, a, b):
+        """Операции ("equal" | "delete" | "insert" | "replace", i1, i2, j1, j2), как у difflib"""
+        blocks = []
+        # Явный стек вместо рекурсии: глубина деления может быть большой
+        stack = [(0, len(a), 0, len(b))]
+        while stack:
+            a_lo, a_hi, b_lo, b_hi = stack.pop()
+            start = a_lo
+            while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+                a_lo += 1
+                b_lo += 1
+            if a_lo > start:
+                blocks.append((start, b_lo - (a_lo - start), a_lo - start))
+            end = a_hi
+            while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+                a_hi -= 1
+                b_hi -= 1
+            if end > a_hi:
+                blocks.append((a_hi, b_hi, end - a_hi))
+            if a_lo == a_hi or b_lo == b_hi:
+                continue
+
+            anchors = self.unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi)
+            if not anchors:
+                self.myers(a, a_lo, a_hi, b, b_lo, b_hi, blocks)
+                continue
+            for i, j in anchors:
+                if i > a_lo or j > b_lo:
+                    stack.append((a_lo, i, b_lo, j))
+                    blocks.append((i, j, 1))
+                else:
+                    # Соседние опорные строки - один общий блок (первая опора не соседняя: начало обрезано)
+                    block_i, block_j, size = blocks[-1]
+                    blocks[-1] = (block_i, block_j, size + 1)
+                a_lo, b_lo = i + 1, j + 1
+            stack.append((a_lo, a_hi, b_lo, b_hi))
+
+        ops = []
+        i = j = 0
+        for block_i, block_j, size in sorted(blocks) + [(len(a), len(b), 0)]:
+            if i < block_i and j < block_j:
+                ops.append(("replace", i, block_i, j, block_j))
+            elif i < block_i:
+                ops.append(("delete", i, block_i, j, j))
+            elif j < block_j:
+                ops.append(("insert", i, i, j, block_j))
+            if size:
+                if ops and ops[-1][0] == "equal" and ops[-1][2] == block_i and ops[-1][4] == block_j:
+                    ops[-1] = ("equal", ops[-1][1], block_i + size, ops[-1][3], block_j + size)
+                else:
+                    ops.append(("equal", block_i, block_i + size, block_j, block_j + size))
+            i, j = block_i + size, block_j + size
+        return ops
+
+    @staticmethod
+    def unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi):
+        """Пары (i, j) строк, уникальных в обоих участках: наибольшая цепочка, идущая по порядку в обоих"""
+        a_positions = {}
+        for i in range(a_lo, a_hi):
+            line = a[i]
+            a_positions[line] = -1 if line in a_positions else i
+        b_positions = {}
+        for j in range(b_lo, b_hi):
+            line = b[j]
+            b_positions[line] = -1 if line in b_positions else j
+        # Порядок словаря - порядок первого появления, для уникальных строк это порядок в a
+        pairs = [(i, b_positions[line]) for line, i in a_positions.items()
+                 if i >= 0 and b_positions.get(line, -1) >= 0]
+
+        # Наибольшая возрастающая подпоследовательность по j (раскладка пасьянса)
+        tails, tail_values = [], []
+        previous = [None] * len(pairs)
+        for k, (_, j) in enumerate(pairs):
+            position = bisect.bisect_left(tail_values, j)
+            previous[k] = tails[position - 1] if position else None
+            if position == len(tails):
+                tails.append(k)
+                tail_values.append(j)
+            else:
+                tails[position] = k
+                tail_values[position] = j
+        chain = []
+        k = tails[-1] if tails else None
+        while k is not None:
+            chain.append(pairs[k])
+            k = previous[k]
+        chain.reverse()
+        return chain
+
+    def myers(self, a, a_lo, a_hi, b, b_lo, b_hi, blocks):
+        """Кратчайшее редакционное предписание (Майерс, O(ND)); совпадения дописываются в blocks"""
+        n, m = a_hi - a_lo, b_hi - b_lo
+        limit = min(n + m, self.MAX_EDIT_COST)
+        offset = limit + 1
+        v = [0] * (2 * limit + 3)
+        trace = []  # состояние диагоналей -d..d после шага d
+        for d in range(limit + 1):
+            for k in range(-d, d + 1, 2):
+                if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                    x = v[offset + k + 1]
+                else:
+                    x = v[offset + k - 1] + 1
+                y = x - k
+                while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                    x += 1
+                    y += 1
+                v[offset + k] = x
+                if x >= n and y >= m:
+                    break
+            else:
+                trace.append(v[offset - d:offset + d + 1])
+                continue
+            break
+        else:
+            return  # слишком много правок: участок заменен целиком
+
+        # Обратный проход: от конца к началу восстанавливаем диагональные участки
+        x, y = n, m
+        for d in range(len(trace), 0, -1):
+            state = trace[d - 1]  # диагонали -(d-1)..(d-1)
+            k = x - y
+            if k == -d or (k != d and state[k - 1 + d - 1] < state[k + 1 + d - 1]):
+                previous_k = k + 1
+                start_x = state[previous_k + d - 1]
+            else:
+                previous_k = k - 1
+                start_x = state[previous_k + d - 1] + 1
+            if x > start_x:
+                blocks.append((a_lo + start_x, b_lo + start_x - k, x - start_x))
+            x = state[previous_k + d - 1]
+            y = x - previous_k
+        if x:
+            blocks.append((a_lo, b_lo, x))
+
+    def group_opcodes(self, ops):
+        """Группы операций с CONTEXT_LINES строками контекста вокруг изменений"""
+        context = self.CONTEXT_LINES
+        groups, group = [], []
+        for position, op in enumerate(ops):
+            tag, i1, i2, j1, j2 = op
+            if tag != "equal":
+                group.append(op)
+                continue
+            last = position == len(ops) - 1
+            if group:
+                if i2 - i1 <= 2 * context and not last:
+                    group.append(op)
+                    continue
+                if context:
+                    group.append(("equal", i1, min(i2, i1 + context), j1, min(j2, j1 + context)))
+                groups.append(group)
+                group = []
+            if not last and context:
+                group.append(("equal", max(i1, i2 - context), i2, max(j1, j2 - context), j2))
+        if group:
+            groups.append(group)
+        return groups
+
+    def word_changes(self, old_lines, new_lines):
+        """Измененные слова внутри замененных строк: {номер строки: [(начало, конец)]} для каждой стороны"""
+        if sum(map(len, old_lines)) + sum(map(len, new_lines)) > self.WORD_DIFF_CHARS:
+            return {}, {}
+        old_tokens = self.TOKEN_PATTERN.findall("\n".join(old_lines))
+        new_tokens = self.TOKEN_PATTERN.findall("\n".join(new_lines))
+        old_spans, new_spans = {}, {}
+        old_marked, new_marked = [], []
+        for tag, i1, i2, j1, j2 in self.opcodes(old_tokens, new_tokens):
+            if tag != "equal":
+                old_marked.append((i1, i2))
+                new_marked.append((j1, j2))
+        self.mark_tokens(old_tokens, old_marked, old_spans)
+        self.mark_tokens(new_tokens, new_marked, new_spans)
+        return old_spans, new_spans
+
+    @staticmethod
+    def mark_tokens(tokens, ranges, spans):
+        """Переводим диапазоны лексем в участки строк; участки, разделенные только пробелами, сливаются"""
+        line = column = 0
+        joinable = False  # между последним участком и текущей лексемой только пробелы
+        ranges = iter(ranges)
+        current = next(ranges, None)
+        for position, token in enumerate(tokens):
+            while current and position >= current[1]:
+                current = next(ranges, None)
+            if token == "\n":
+                line += 1
+                column = 0
+                joinable = False
+                continue
+            if current and current[0] <= position and not token.isspace():
+                line_spans = spans.setdefault(line, [])
+                if joinable:
+                    line_spans[-1] = (line_spans[-1][0], column + len(token))
+                else:
+                    line_spans.append((column, column + len(token)))
+                joinable = True
+            elif not token.isspace():
+                joinable = False
+            column += len(token)
+
+    def stats(self):
+        with self.lock:
+            return {"cached": len(self.cache), "hits": self.hits, "misses": self.misses}
+
+
+class TranslationError(Exception):
+    """Ошибка сервиса перевода: сервер недоступен или вернул некорректный ответ"""
+
+
+class HttpTranslationBackend:
+    """Перевод через HTTP API, совместимый с LibreTranslate.
+
+    POST на url с JSON {"q": [строки], "source": ..., "target": ..., "format": "text"},
+    ответ {"translatedText": [строки]}. Другой сервис подключается объектом
+    с тем же методом translate(segments, source, target) и атрибутом name.
+    """
+
+    def __init__(self, url, api_key="", timeout=30):
+        self.url = url
+        self.api_key = api_key
+        self.timeout = timeout
+        # Часть ключа кэша: переводы разных серверов не смешиваются
+        self.name = url
+
+    def translate(self, segments, source, target):
+        """Переводим список строк одним запросом"""
+        payload = {"q": segments, "source": source, "target": target, "format": "text"}
+        if self.api_key:
+            payload["api_key"] = self.api_key
+        try:
+            request = urllib.request.Request(
+                self.url,
+                data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+                headers={"Content-Type": "application/json"}
+            )
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                data = json.loads(response.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            detail = e.read().decode("utf-8", "replace")[:200]
+            raise TranslationError(f"Сервер перевода вернул {e.code}: {detail}") from e
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            raise TranslationError(f"Сервер перевода недоступен: {e}") from e
+
+        translated = data.get("translatedText") if isinstance(data, dict) else None
+        if isinstance(translated, str) and len(segments) == 1:
+            translated = [translated]
+        if not isinstance(translated, list) or len(translated) != len(segments):
+            raise TranslationError("Некорректный ответ сервера перевода")
+        return translated
+
+
+class StubTranslationServer:
+    """Локальный сервер с API LibreTranslate: для тестов и замеров без сети.
+
+    "Переводит" строку в "[target] строка" и считает запросы и присланные строки.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.requests = 0
+        self.segments = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        """Запускаем сервер на свободном порту; возвращаем адрес для HttpTranslationBackend"""
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                segments = payload["q"] if isinstance(payload["q"], list) else [payload["q"]]
+                with stub.lock:
+                    stub.requests += 1
+                    stub.segments += len(segments)
+                if stub.delay:
+                    time.sleep(stub.delay)
+                body = json.dumps({"translatedText": [f"[{payload['target']}] {segment}" for segment in segments]},
+                                  ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}/translate"
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class TranslationCache:
+    """Переведенные предложения на диске с вытеснением давно не использованных (LRU).
+
+    Ключ - хэш сервера, языков и текста предложения. Кэш - один JSON-файл
+    (пары от старых к новым), читается при первом обращении, пишется через PersistenceWriter.
+    """
+
+    MAX_ENTRIES = 20000
+
+    def __init__(self, writer, path="translation_cache.json", max_entries=None):
+        self.writer = writer
+        self.path = path
+        self.max_entries = max_entries or self.MAX_ENTRIES
+        self.entries = None  # ключ -> перевод; порядок = порядок LRU
+        # Пакеты переводятся в нескольких потоках
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(backend, source, target, segment):
+        return hashlib.sha256(f"{backend}\0{source}\0{target}\0{segment}".encode("utf-8")).hexdigest()
+
+    def load(self):
+        """Читаем кэш с диска (вызывается под блокировкой)"""
+        if self.entries is not None:
+            return
+        self.entries = OrderedDict()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.entries.update(json.load(f))
+            except Exception as e:
+                print(f"Не удалось загрузить кэш переводов: {e}")
+
+    def get(self, key):
+        with self.lock:
+            self.load()
+            translation = self.entries.get(key)
+            if translation is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return translation
+
+    def put(self, translations):
+        """Добавляем переводы {ключ: перевод}; лишние старые записи вытесняются"""
+        with self.lock:
+            self.load()
+            for key, translation in translations.items():
+                self.entries[key] = translation
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self):
+        with self.lock:
+            if self.entries is not None:
+                self.writer.write_json(self.path, list(self.entries.items()))
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries or ()), "hits": self.hits, "misses": self.misses}
+
+
+class TranslationService:
+    """Перевод текста по предложениям с кэшем и параллельной отправкой пакетов.
+
+    Текст делится на предложения и пробелы между ними. На сервер уходят только предложения
+    с буквами, которых нет в кэше, каждое один раз; пробелы и переводы строк остаются как есть,
+    поэтому после правки документа переводятся только измененные предложения.
+    """
+
+    BATCH_CHARS = 2000
+    BATCH_SEGMENTS = 50
+    MAX_WORKERS = 4
+    WORD_PATTERN = re.compile(r"\S+")
+    SENTENCE_END = ".!?…"
+    CLOSING_MARKS = ")]\"'»”"
+    LETTER_PATTERN = re.compile(r"[^\W\d_]")
+
+    def __init__(self, backend, cache=None, max_workers=None):
+        self.backend = backend
+        self.cache = cache
+        self.max_workers = max_workers or self.MAX_WORKERS
+
+    @classmethod
+    def split_sentences(cls, text):
+        """Предложения и промежутки между ними; "".join(результат) == text.
+
+        Предложение кончается словом со знаком конца (за ним могут идти закрывающие скобки
+        и кавычки) или последним словом строки. Текст проходится по словам один раз:
+        длинные серии "!!!!" или "....." не вызывают возвратов регулярного выражения.
+        """
+        segments = []
+        words = [match.span() for match in cls.WORD_PATTERN.finditer(text)]
+        position = 0  # конец последнего сегмента
+        start = None  # начало текущего предложения
+        for i, (begin, end) in enumerate(words):
+            if start is None:
+                if begin > position:
+                    segments.append(text[position:begin])
+                start = begin
+            core = text[begin:end].rstrip(cls.CLOSING_MARKS)
+            # Первый символ предложения не может быть его концом: ". Далее" - одно предложение
+            terminated = core and core[-1] in cls.SENTENCE_END and (begin > start or len(core) > 1)
+            next_begin = words[i + 1][0] if i + 1 < len(words) else len(text)
+            if terminated or next_begin == len(text) or text.find("\n", end, next_begin) != -1:
+                segments.append(text[start:end])
+                position = end
+                start = None
+        if position < len(text):
+            segments.append(text[position:])
+        return segments
+
+    def make_batches(self, segments):
+        """Пакеты не больше BATCH_CHARS символов и BATCH_SEGMENTS строк (длинное предложение - отдельно)"""
+        batches, batch, size = [], [], 0
+        for segment in segments:
+            if batch and (size + len(segment) > self.BATCH_CHARS or len(batch) >= self.BATCH_SEGMENTS):
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append(segment)
+            size += len(segment)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def translate(self, text, source="auto", target="en", progress=None):
+        """Переводим текст; возвращаем (перевод, статистика). progress(готово, всего) - по пакетам"""
+        started = time.perf_counter()
+        segments = self.split_sentences(text)
+        keys = {}  # предложение -> ключ кэша (повторы переводятся один раз)
+        translations = {}
+        for segment in segments:
+            if segment in keys or not self.LETTER_PATTERN.search(segment):
+                continue
+            keys[segment] = TranslationCache.make_key(self.backend.name, source, target, segment)
+            cached = self.cache.get(keys[segment]) if self.cache else None
+            if cached is not None:
+                translations[segment] = cached
+
+        missing = [segment for segment in keys if segment not in translations]
+        batches = self.make_batches(missing)
+        try:
+            if batches:
+                with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+                    futures = {executor.submit(self.backend.translate, batch, source, target): batch
+                               for batch in batches}
+                    for done, future in enumerate(as_completed(futures), 1):
+                        try:
+                            result = future.result()
+                        except Exception:
+                            # Не ждем оставшиеся пакеты; уже переведенные остаются в кэше
+                            for other in futures:
+                                other.cancel()
+                            raise
+                        batch = futures[future]
+                        translations.update(zip(batch, result))
+                        if self.cache:
+                            self.cache.put({keys[segment]: translated for segment, translated in zip(batch, result)})
+                        if progress:
+                            progress(done, len(batches))
+        finally:
+            if self.cache:
+                self.cache.save()
+
+        translated_text = "".join(translations.get(segment, segment) for segment in segments)
+        stats = {
+            "segments": len(keys),
+            "cached": len(keys) - len(missing),
+            "sent": len(missing),
+            "batches": len(batches),
+            "elapsed": time.perf_counter() - started
+        }
+        return translated_text, stats
+
+
+# Символы вне BMP (эмодзи): в Tk 8.6 они занимают в индексах две позиции
+NON_BMP_PATTERN = re.compile("[\U00010000-\U0010FFFF]")
+
+
+def common_affix_lengths(old, new):
+    """Длины общего начала и общего конца двух строк (конец не пересекается с началом)"""
+    limit = min(len(old), len(new))
+
+    # Бинарный поиск с посимвольным сравнением срезов на стороне C
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[:middle] == new[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    prefix = low
+
+    low, high = 0, limit - prefix
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[len(old) - middle:] == new[len(new) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return prefix, low
+
+
+class CsvTable:
+    """CSV-файл на диске: индекс смещений записей, постраничное чтение, сортировка и фильтр.
+
+    В памяти держатся только смещения (8 байт на запись) и несколько страниц строк.
+    """
+    SAMPLE_SIZE = 64 * 1024
+    PAGE_ROWS = 200
+    CACHE_PAGES = 64
+    SORT_CHUNK_ROWS = 100000
+    SORT_BATCH = 1000
+    PROGRESS_EVERY = 50000
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.offsets = array("q")
+        self.indexed = False
+        self.cancelled = False
+        self.pages = OrderedDict()
+        self.sniff()
+
+    def sniff(self):
+        """Определяем кодировку, диалект и заголовок по началу файла"""
+        with open(self.path, "rb") as f:
+            sample = f.read(self.SAMPLE_SIZE)
+        if len(sample) == self.SAMPLE_SIZE and b"\n" in sample:
+            sample = sample[:sample.rfind(b"\n") + 1]
+        try:
+            text = sample.decode("utf-8")
+            self.encoding = "utf-8-sig" if text.startswith("\ufeff") else "utf-8"
+        except UnicodeDecodeError:
+            self.encoding = chardet.detect(sample)["encoding"] or "cp1251"
+            text = sample.decode(self.encoding, errors="replace")
+        text = text.lstrip("\ufeff")
+
+        sniffer = csv.Sniffer()
+        try:
+            self.dialect = sniffer.sniff(text, delimiters=",;\t|")
+        except csv.Error:
+            self.dialect = csv.excel
+        try:
+            has_header = sniffer.has_header(text)
+        except csv.Error:
+            has_header = False
+
+        sample_rows = list(itertools.islice(csv.reader(StringIO(text), self.dialect), 50))
+        self.width = max((len(row) for row in sample_rows), default=1)
+        # Sniffer не считает числами значения с десятичной запятой (частый случай для ';')
+        has_header = has_header or self.looks_like_header(sample_rows)
+        self.first_row = sample_rows[0] if sample_rows else []
+        self.has_header = has_header and bool(sample_rows)
+        self.header = self.make_header()
+
+    @classmethod
+    def looks_like_header(cls, rows):
+        """Первая строка - заголовок, если в какой-то колонке она не число, а все следующие - числа"""
+        if len(rows) < 2:
+            return False
+        for column, value in enumerate(rows[0]):
+            values = [row[column] for row in rows[1:] if column < len(row) and row[column].strip()]
+            if values and value.strip() and cls.parse_number(value) is None \
+                    and all(cls.parse_number(item) is not None for item in values):
+                return True
+        return False
+
+    def make_header(self):
+        """Названия колонок: первая запись файла или номера"""
+        names = self.first_row if self.has_header else []
+        return names + [str(i + 1) for i in range(len(names), self.width)]
+
+    def set_header(self, has_header):
+        """Переключаем заголовок после индексации: первая запись становится заголовком или данными"""
+        if has_header == self.has_header or not self.first_row:
+            return
+        if has_header:
+            del self.offsets[0]
+        else:
+            self.offsets.insert(0, 0)
+        self.has_header = has_header
+        self.header = self.make_header()
+        self.pages.clear()
+
+    def iter_records(self, offset=0, positions=None):
+        """Читаем записи начиная с байтового смещения.
+
+        Если передан список positions, в него добавляется смещение начала каждой следующей записи
+        (csv.reader забирает ровно строки своей записи, с учетом переводов строк в кавычках).
+        """
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            position = offset
+
+            def lines():
+                nonlocal position
+                for raw in f:
+                    position += len(raw)
+                    yield raw.decode(self.encoding, errors="replace")
+
+            reader = csv.reader(lines(), self.dialect)
+            start = offset
+            for row in reader:
+                if positions is not None:
+                    positions.append(start)
+                yield row
+                start = position
+
+    def build_index(self, progress=None):
+        """Индексируем смещения записей (выполняется в фоновом потоке)"""
+        positions = []
+        skip_header = self.has_header
+        for row in self.iter_records(0, positions):
+            if self.cancelled:
+                return
+            if skip_header:
+                skip_header = False
+                positions.clear()
+                continue
+            self.offsets.append(positions.pop())
+            if progress and len(self.offsets) % self.PROGRESS_EVERY == 0:
+                progress(len(self.offsets))
+        self.indexed = True
+        if progress:
+            progress(len(self.offsets))
+
+    @property
+    def row_count(self):
+        return len(self.offsets)
+
+    def get_row(self, number):
+        """Строка по номеру; читается и кэшируется целой страницей"""
+        page_number = number // self.PAGE_ROWS
+        first = page_number * self.PAGE_ROWS
+        count = min(self.PAGE_ROWS, len(self.offsets) - first)
+        page = self.pages.get(page_number)
+        # Страницу, прочитанную до окончания индексации, дочитываем
+        if page is None or len(page) < count:
+            page = list(itertools.islice(self.iter_records(self.offsets[first]), count))
+            self.pages[page_number] = page
+            if len(self.pages) > self.CACHE_PAGES:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(page_number)
+        return page[number - page_number * self.PAGE_ROWS]
+
+    def iter_rows(self):
+        """Все строки данных по порядку"""
+        if not self.offsets:
+            return iter(())
+        return itertools.islice(self.iter_records(self.offsets[0]), len(self.offsets))
+
+    @staticmethod
+    def parse_number(value):
+        """Число из ячейки (допускаются десятичная запятая и пробелы) или None"""
+        try:
+            number = float(value.replace(",", ".").replace(" ", ""))
+        except ValueError:
+            return None
+        return None if math.isnan(number) else number
+
+    @classmethod
+    def sort_key(cls, row, column, number, descending=False):
+        """Числа сортируются как числа (в т.ч. с запятой), остальное - как строки без учета регистра.
+
+        Строки и пустые значения идут после чисел в обоих направлениях, равные - в порядке файла;
+        ключ для убывания рассчитан на sort(reverse=True).
+        """
+        value = row[column] if column < len(row) else ""
+        parsed = cls.parse_number(value)
+        if parsed is not None:
+            group, key = 0, (parsed, "")
+        elif value.strip():
+            group, key = 1, (0.0, value.casefold())
+        else:
+            group, key = 2, (0.0, "")
+        if descending:
+            return (-group,) + key + (-number,)
+        return (group,) + key + (number,)
+
+    def write_run(self, chunk, directory, descending):
+        """Сортируем кусок в памяти и сбрасываем его на диск пачками"""
+        chunk.sort(reverse=descending)
+        fd, path = tempfile.mkstemp(dir=directory, suffix=".run")
+        with os.fdopen(fd, "wb") as f:
+            for i in range(0, len(chunk), self.SORT_BATCH):
+                pickle.dump(chunk[i:i + self.SORT_BATCH], f, pickle.HIGHEST_PROTOCOL)
+        return path
+
+    @staticmethod
+    def read_run(path):
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    yield from pickle.load(f)
+                except EOFError:
+                    return
+
+    def sort_order(self, column, descending=False, progress=None):
+        """Внешняя сортировка слиянием: возвращает номера строк в порядке сортировки"""
+        with tempfile.TemporaryDirectory() as directory:
+            runs = []
+            chunk = []
+            for number, row in enumerate(self.iter_rows()):
+                if self.cancelled:
+                    return None
+                chunk.append((self.sort_key(row, column, number, descending), number))
+                if len(chunk) >= self.SORT_CHUNK_ROWS:
+                    runs.append(self.write_run(chunk, directory, descending))
+                    chunk = []
+                    if progress:
+                        progress(number + 1)
+            if len(runs) == 0:
+                chunk.sort(reverse=descending)
+                return array("q", (number for _, number in chunk))
+            if chunk:
+                runs.append(self.write_run(chunk, directory, descending))
+            merged = heapq.merge(*(self.read_run(path) for path in runs), reverse=descending)
+            return array("q", (number for _, number in merged))
+
+    def filter_mask(self, query, column=None, progress=None):
+        """Отметки строк (1 байт на строку), содержащих query без учета регистра"""
+        query = query.casefold()
+        mask = bytearray(self.row_count)
+        for number, row in enumerate(self.iter_rows()):
+            if self.cancelled:
+                return None
+            if column is None:
+                found = any(query in value.casefold() for value in row)
+            else:
+                found = column < len(row) and query in row[column].casefold()
+            if found:
+                mask[number] = 1
+            if progress and number % self.PROGRESS_EVERY == 0:
+                progress(number)
+        return mask
+
+
+class JsonStreamError(ValueError):
+    """Синтаксическая ошибка JSON с позицией (строки и столбцы с 1, offset - смещение в символах)"""
+
+    def __init__(self, message, line, column, offset):
+        super().__init__(f"{message} (строка {line}, столбец {column})")
+        self.line = line
+        self.column = column
+        self.offset = offset
+
+
+class JsonStreamProcessor:
+    """Потоковое форматирование, сжатие и проверка JSON.
+
+    Текст читается кусками и разбирается на лексемы регулярным выражением;
+    грамматика проверяется автоматом со стеком, поэтому документ целиком
+    в памяти не нужен.
+    """
+    CHUNK_SIZE = 1024 * 1024
+    FLUSH_SIZE = 1024 * 1024
+
+    # Пробелы + одна лексема: строка, число, литерал или знак.
+    # Строка записана как "символы (escape символы)*": разбор однозначен и идет без возвратов
+    TOKEN = re.compile(r'''[ \t\n\r]*(
+        "[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*"
+      | -?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?
+      | true|false|null
+      | [{}\[\]:,]
+    )''', re.VERBOSE)
+    WHITESPACE = re.compile(r"[ \t\n\r]*")
+    # Начало лексемы, обрезанной концом куска
+    PARTIAL = re.compile(r'''
+        "[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*(?:\\u?[0-9a-fA-F]{0,3})?
+      | t(?:r(?:ue?)?)?|f(?:a(?:l(?:se?)?)?)?|n(?:u(?:ll?)?)?
+      | -?[0-9]*(?:\.[0-9]*)?(?:[eE][+-]?[0-9]*)?
+    ''', re.VERBOSE)
+    # Содержимое строки без кавычек и обрезанная концом куска escape-последовательность
+    STRING_BODY = re.compile(r'[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*')
+    PARTIAL_ESCAPE = re.compile(r"\\(?:u[0-9a-fA-F]{0,3})?")
+
+    # Что ожидается следующим
+    VALUE, FIRST_VALUE, KEY, FIRST_KEY, COLON, NEXT, END = range(7)
+
+    def __init__(self, mode="format", indent=2):
+        if mode not in ("format", "minify", "validate"):
+            raise ValueError(f"Неизвестный режим: {mode}")
+        self.mode = mode
+        self.indent = indent
+
+    def process(self, source, write=None, progress=None):
+        """Обрабатываем поток source (read(n) -> str); результат отдается кусками в write.
+
+        Возвращает статистику, при ошибке бросает JsonStreamError.
+        """
+        VALUE, FIRST_VALUE, KEY, FIRST_KEY, COLON, NEXT, END = range(7)
+        buffer = source.read(self.CHUNK_SIZE)
+        eof = not buffer
+        base = 0  # смещение начала buffer в исходном тексте
+        position = 0
+        # Переводы строк в уже отброшенной части - для номера строки в сообщении об ошибке
+        lines_before, line_start = 0, 0
+
+        output = []
+        output_size = 0
+        pretty = self.mode == "format"
+        emit = write is not None and self.mode != "validate"
+        indents = ["\n"]
+
+        stack = []
+        expect = VALUE
+        pending_open = False
+        tokens = 0
+        max_depth = 0
+        # Строка, не закончившаяся в куске: проверенные части и смещение открывающей кавычки
+        string_parts = None
+        string_start = 0
+
+        def fail(message, offset):
+            local = offset - base
+            line = lines_before + buffer.count("\n", 0, local) + 1
+            last_newline = buffer.rfind("\n", 0, local)
+            start = base + last_newline + 1 if last_newline != -1 else line_start
+            raise JsonStreamError(message, line, offset - start + 1, offset)
+
+        while True:
+            at_end = False
+            while True:
+                # match, а не finditer: finditer ищет дальше, перескакивая недопустимый символ
+                match = self.TOKEN.match(buffer, position)
+                if match is None:
+                    break
+                end = match.end()
+                if end + 2 >= len(buffer) and not eof:
+                    # Лексема может продолжаться в следующем куске (например, "1" + ".5e+3")
+                    at_end = True
+                    break
+                value = match.group(1)
+                offset = base + end - len(value)
+                position = end
+                tokens += 1
+                char = value[0]
+
+                if char in "}]":
+                    if not stack or stack[-1] != ("{" if char == "}" else "["):
+                        fail(f"Лишняя закрывающая скобка {value!r}", offset)
+                    if expect != NEXT and expect != FIRST_KEY and expect != FIRST_VALUE:
+                        fail(f"Ожидалось значение перед {value!r}", offset)
+                    stack.pop()
+                    if pretty and not pending_open:
+                        output.append(indents[len(stack)])
+                    output.append(value)
+                    pending_open = False
+                    expect = NEXT if stack else END
+                elif char == ",":
+                    if expect != NEXT:
+                        fail("Неожиданная запятая", offset)
+                    output.append(",")
+                    if pretty:
+                        output.append(indents[len(stack)])
+                    expect = KEY if stack[-1] == "{" else VALUE
+                elif char == ":":
+                    if expect != COLON:
+                        fail("Неожиданное двоеточие", offset)
+                    output.append(": " if pretty else ":")
+                    expect = VALUE
+                else:
+                    if expect == KEY or expect == FIRST_KEY:
+                        if char != '"':
+                            fail("Ожидался ключ-строка", offset)
+                        next_expect = COLON
+                    elif expect == VALUE or expect == FIRST_VALUE:
+                        if char == "{":
+                            next_expect = FIRST_KEY
+                        elif char == "[":
+                            next_expect = FIRST_VALUE
+                        else:
+                            next_expect = NEXT if stack else END
+                    elif expect == END:
+                        fail("Лишние данные после JSON", offset)
+                    else:
+                        fail("Ожидалась запятая или закрывающая скобка", offset)
+
+                    if pending_open:
+                        output.append(indents[len(stack)])
+                        pending_open = False
+                    output.append(value)
+                    if char == "{" or char == "[":
+                        stack.append(char)
+                        if len(stack) > max_depth:
+                            max_depth = len(stack)
+                            if pretty:
+                                indents.append("\n" + " " * (self.indent * max_depth))
+                        pending_open = pretty
+                    expect = next_expect
+
+                if emit:
+                    output_size += len(value)
+                    if output_size >= self.FLUSH_SIZE:
+                        write("".join(output))
+                        output.clear()
+                        output_size = 0
+                elif len(output) > 4096:
+                    output.clear()
+
+            if not at_end:
+                # Разбор остановился не на лексеме: это ошибка, если только остаток
+                # не может оказаться началом лексемы, обрезанной концом куска
+                bad = self.WHITESPACE.match(buffer, position).end()
+                partial = not eof and self.PARTIAL.match(buffer, bad).end() == len(buffer)
+                if bad < len(buffer) and not partial:
+                    if buffer[bad] == '"':
+                        fail("Незакрытая строка или недопустимый символ в строке", base + bad)
+                    fail(f"Неожиданный символ {buffer[bad]!r}", base + bad)
+                if partial and bad < len(buffer) and buffer[bad] == '"':
+                    # Длинная строка продолжается в следующем куске: проверенную часть откладываем,
+                    # чтобы не разбирать ее заново с каждым новым куском
+                    string_start = base + bad
+                    position = self.STRING_BODY.match(buffer, bad + 1).end()
+                    string_parts = [buffer[bad:position]]
+            if eof:
+                break
+
+            # Дочитываем следующий кусок, отбрасывая разобранное
+            chunk = source.read(self.CHUNK_SIZE)
+            lines_before += buffer.count("\n", 0, position)
+            last_newline = buffer.rfind("\n", 0, position)
+            if last_newline != -1:
+                line_start = base + last_newline + 1
+            base += position
+            buffer = buffer[position:] + chunk
+            position = 0
+            eof = not chunk
+            # Продолжение незакрытой строки: проверяем только новые символы
+            while string_parts is not None:
+                scanned = self.STRING_BODY.match(buffer).end()
+                if eof or not (scanned == len(buffer) or self.PARTIAL_ESCAPE.fullmatch(buffer, scanned)):
+                    # Строка закрылась (или ошибка, или конец файла) - разбираем ее целиком один раз
+                    buffer = "".join(string_parts) + buffer
+                    base = string_start
+                    string_parts = None
+                    break
+                string_parts.append(buffer[:scanned])
+                base += scanned
+                chunk = source.read(self.CHUNK_SIZE)
+                buffer = buffer[scanned:] + chunk
+                eof = not chunk
+                if progress:
+                    progress(base)
+            if progress:
+                progress(base)
+
+        end_offset = base + len(buffer)
+        if tokens == 0:
+            fail("Пустой документ", end_offset)
+        if stack:
+            fail(f"Не закрыта скобка {stack[-1]!r}", end_offset)
+        if expect != END:
+            fail("Неожиданный конец документа", end_offset)
+        if emit:
+            if pretty:
+                output.append("\n")
+            write("".join(output))
+        return {"chars": end_offset, "tokens": tokens, "depth": max_depth}
+
+
+# Виртуальный перенос - настоящий перевод строки в виджете, помеченный этим тегом.
+# От переводов строк самого текста его отличает только тег: правка не превращает перенос в символы текста
+VIRTUAL_BREAK_TAG = "virtual_break"
+
+
+def newline_offsets(text, numbers):
+    """Смещения переводов строк с номерами numbers (с нуля, по возрастанию) в text"""
+    offsets = []
+    position = count = -1
+    for number in numbers:
+        while count < number:
+            position = text.find("\n", position + 1)
+            if position == -1:
+                return offsets
+            count += 1
+        offsets.append(position)
+    return offsets
+
+
+def tagged_insert_args(text, offsets, tag):
+    """Аргументы insert виджета Text: символы text в позициях offsets получают тег tag"""
+    args = []
+    last = 0
+    for offset in offsets:
+        args += [text[last:offset], (), text[offset], (tag,)]
+        last = offset + 1
+    args += [text[last:], ()]
+    return args
+
+
+class LineSplitter:
+    """Мягкая разбивка очень длинных строк на сегменты фиксированной ширины для Tk Text"""
+
+    MAX_LINE = 10000
+    SEGMENT = 1000
+
+    def __init__(self, max_line=None, segment=None):
+        self.max_line = self.MAX_LINE if max_line is None else max_line
+        self.segment = segment or self.SEGMENT
+        # ^ в многострочном режиме: каждая строка просматривается один раз
+        self.long_line = re.compile(r"^[^\n]{%d,}" % self.max_line, re.MULTILINE) if self.max_line else None
+
+    def split(self, text):
+        """Текст для виджета и смещения виртуальных переносов в нем (по возрастанию)"""
+        if self.long_line is None:
+            return text, []
+        parts, breaks = [], []
+        last = 0
+        segment = self.segment
+        for match in self.long_line.finditer(text):
+            line = match.group()
+            parts.append(text[last:match.start()])
+            parts.append("\n".join(line[i:i + segment] for i in range(0, len(line), segment)))
+            # Каждый предыдущий перенос сдвигает позицию в тексте виджета на символ
+            shift = len(breaks)
+            breaks.extend(match.start() + i + shift + n
+                          for n, i in enumerate(range(segment, len(line), segment)))
+            last = match.end()
+        if not parts:
+            return text, []
+        parts.append(text[last:])
+        return "".join(parts), breaks
+
+    @staticmethod
+    def join(display, breaks):
+        """Настоящий текст: убираем переводы строк в позициях breaks (по возрастанию)"""
+        if not breaks:
+            return display
+        parts = []
+        last = 0
+        for offset in breaks:
+            parts.append(display[last:offset])
+            last = offset + 1
+        parts.append(display[last:])
+        return "".join(parts)
+
+    @staticmethod
+    def break_positions(breaks):
+        """Смещения виртуальных переносов в настоящем тексте (по возрастанию)"""
+        return [offset - count for count, offset in enumerate(breaks)]
+
+    @staticmethod
+    def to_display(positions, offset, end=False):
+        """Смещение в настоящем тексте -> смещение в тексте виджета.
+
+        Начало попадает после переноса на границе сегментов, конец - перед ним.
+        """
+        count = bisect.bisect_left(positions, offset) if end else bisect.bisect_right(positions, offset)
+        return offset + count
+
+
+class PieceTable:
+    """Модель документа "таблица фрагментов": правка стоит O(размер правки), а не O(документ)"""
+
+    MAX_PIECES = 1024
+
+    # Версии уникальны между документами: результат фоновой операции не применится к другой вкладке
+    versions = itertools.count(1)
+
+    def __init__(self, text=""):
+        self.reset(text)
+
+    def reset(self, text):
+        """Заменяем все содержимое (исходный буфер = text)"""
+        # Фрагмент: (номер буфера, начало, длина, переводов строк)
+        self.buffers = [text]
+        self.pieces = [(0, 0, len(text), text.count("\n"))] if text else []
+        self.length = len(text)
+        self.cached = text
+        self.starts = None
+        self.line_starts = None
+        self.has_wide = bool(NON_BMP_PATTERN.search(text))
+        self.version = next(self.versions)
+
+    def __len__(self):
+        return self.length
+
+    def changed(self):
+        """Сбрасываем кэши после правки; слишком раздробленную таблицу склеиваем"""
+        self.cached = None
+        self.starts = None
+        self.line_starts = None
+        self.version = next(self.versions)
+        if len(self.pieces) > self.MAX_PIECES:
+            self.reset(self.text())
+
+    def build_index(self):
+        """Накопленные смещения и количества строк фрагментов для бинарного поиска"""
+        if self.starts is None:
+            starts, line_starts = [], []
+            offset = lines = 0
+            for _, _, length, newlines in self.pieces:
+                starts.append(offset)
+                line_starts.append(lines)
+                offset += length
+                lines += newlines
+            self.starts, self.line_starts = starts, line_starts
+
+    def split(self, offset):
+        """Гарантируем границу фрагмента в offset; возвращаем номер фрагмента, начинающегося там"""
+        self.build_index()
+        if offset >= self.length:
+            return len(self.pieces)
+        i = bisect.bisect_right(self.starts, offset) - 1
+        inner = offset - self.starts[i]
+        if inner == 0:
+            return i
+
+        buffer, start, length, _ = self.pieces[i]
+        data = self.buffers[buffer]
+        left_newlines = data.count("\n", start, start + inner)
+        right_newlines = data.count("\n", start + inner, start + length)
+        self.pieces[i:i + 1] = [
+            (buffer, start, inner, left_newlines),
+            (buffer, start + inner, length - inner, right_newlines)
+        ]
+        self.starts = None
+        return i + 1
+
+    def insert(self, offset, text):
+        """Вставляем text в позицию offset"""
+        if not text:
+            return
+        i = self.split(offset)
+        newlines = text.count("\n")
+        self.has_wide = self.has_wide or bool(NON_BMP_PATTERN.search(text))
+
+        # Ввод подряд дописывается в последний буфер вместо создания нового фрагмента
+        last_buffer = len(self.buffers) - 1
+        if i > 0 and last_buffer > 0:
+            buffer, start, length, count = self.pieces[i - 1]
+            if buffer == last_buffer and start + length == len(self.buffers[buffer]):
+                self.buffers[buffer] += text
+                self.pieces[i - 1] = (buffer, start, length + len(text), count + newlines)
+                self.length += len(text)
+                self.changed()
+                return
+
+        self.buffers.append(text)
+        self.pieces.insert(i, (len(self.buffers) - 1, 0, len(text), newlines))
+        self.length += len(text)
+        self.changed()
+
+    def delete(self, offset, length):
+        """Удаляем length символов начиная с offset"""
+        length = min(length, self.length - offset)
+        if length <= 0:
+            return
+        i = self.split(offset)
+        j = self.split(offset + length)
+        del self.pieces[i:j]
+        self.length -= length
+        self.changed()
+
+    def text(self):
+        """Весь текст; собирается один раз на каждую версию документа"""
+        if self.cached is None:
+            self.cached = "".join(self.buffers[b][s:s + l] for b, s, l, _ in self.pieces)
+        return self.cached
+
+    def slice(self, start, end):
+        """Фрагмент документа без сборки всего текста"""
+        if self.cached is not None:
+            return self.cached[start:end]
+        self.build_index()
+        parts = []
+        i = max(0, bisect.bisect_right(self.starts, start) - 1)
+        while i < len(self.pieces) and self.starts[i] < end:
+            buffer, piece_start, length, _ = self.pieces[i]
+            lo = max(start - self.starts[i], 0)
+            hi = min(end - self.starts[i], length)
+            if lo < hi:
+                parts.append(self.buffers[buffer][piece_start + lo:piece_start + hi])
+            i += 1
+        return "".join(parts)
+
+    def line_count(self):
+        """Количество строк без сборки текста"""
+        return sum(piece[3] for piece in self.pieces) + 1
+
+    def line_start(self, line):
+        """Смещение начала строки line (нумерация с 1, как в Tk)"""
+        if line <= 1:
+            return 0
+        self.build_index()
+        target = line - 1  # сколько переводов строки должно остаться позади
+        if not self.pieces or self.line_starts[-1] + self.pieces[-1][3] < target:
+            return self.length
+
+        # Первый фрагмент, на котором накопленное число переводов строки достигает target
+        i = bisect.bisect_left(self.line_starts, target, 1) - 1
+        buffer, start, length, _ = self.pieces[i]
+        data = self.buffers[buffer]
+        position = start - 1
+        for _ in range(target - self.line_starts[i]):
+            position = data.find("\n", position + 1, start + length)
+        return self.starts[i] + position - start + 1
+
+    def offset_of(self, index, wide_chars=False):
+        """Смещение в тексте для индекса Tk вида "строка.столбец"
+
+        В Tk 8.6 символы вне BMP занимают в столбце две позиции (wide_chars).
+        """
+        line, column = (int(part) for part in index.split("."))
+        start = self.line_start(line)
+        if not (wide_chars and self.has_wide):
+            return min(start + column, self.length)
+
+        offset = start
+        position = 0
+        for char in self.slice(start, start + column):
+            if position >= column or char == "\n":
+                break
+            position += 2 if ord(char) > 0xFFFF else 1
+            offset += 1
+        return offset
+
+
+class UndoManager:
+    """Журнал правок для отмены/повтора: хранит только измененные фрагменты, а не снимки текста"""
+
+    GROUP_TIMEOUT = 1.0
+    MAX_CHARS = 5 * 1024 * 1024
+
+    def __init__(self, widget, max_chars=None, tracked_tag=None):
+        self.widget = widget
+        self.max_chars = max_chars or self.MAX_CHARS
+        # Тег переводов строк, который восстанавливается вместе с текстом при отмене/повторе
+        self.tracked_tag = tracked_tag
+        # Группа = список операций одного действия пользователя:
+        # ("insert"|"delete", начало, конец, текст, смещения символов с tracked_tag)
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.size = 0
+        self.current = None
+        self.depth = 0
+        self.replaying = False
+        self.last_time = 0.0
+        # Подписчики на изменения текста: callback(kind, start, end, text)
+        self.listeners = []
+        self.install()
+
+    def add_listener(self, callback):
+        """Подписываемся на все изменения текста (включая отмену/повтор)"""
+        self.listeners.append(callback)
+
+    def notify(self, kind, start=None, end=None, text=""):
+        for callback in self.listeners:
+            callback(kind, start, end, text)
+
+    def install(self):
+        """Перехватываем команды insert/delete/replace виджета; чтение идет напрямую, минуя Python"""
+        path = self.widget._w
+        self.original = f"{path}_undo_orig"
+        callback = f"{path}_undo_record"
+        self.widget.tk.createcommand(callback, self.dispatch)
+        self.widget.tk.eval(f"""
+            rename {path} {self.original}
+            proc {path} {{args}} {{
+                if {{[lindex $args 0] in {{insert delete replace}}}} {{
+                    return [{callback} {{*}}$args]
+                }}
+                return [uplevel 1 [list {self.original} {{*}}$args]]
+            }}
+        """)
+
+    def uninstall(self):
+        """Возвращаем виджету исходную команду (перед уничтожением виджета)"""
+        path = self.widget._w
+        self.widget.tk.eval(f"rename {path} {{}}; rename {self.original} {path}")
+        self.widget.tk.deletecommand(f"{path}_undo_record")
+        self.listeners.clear()
+
+    def call(self, *args):
+        """Вызываем исходную команду виджета без записи в журнал"""
+        return self.widget.tk.call((self.original,) + args)
+
+    def index(self, index):
+        return str(self.call("index", index))
+
+    def compare(self, index1, op, index2):
+        return self.widget.tk.getboolean(self.call("compare", index1, op, index2))
+
+    def tagged_offsets(self, start, end, text):
+        """Смещения в text (= get(start, end)) переводов строк с tracked_tag"""
+        if self.tracked_tag is None:
+            return []
+        start, end = self.index(start), self.index(end)
+        first_line = int(start.split(".")[0])
+        numbers = []
+        index = start
+        while True:
+            found = self.widget.tk.splitlist(self.call("tag", "nextrange", self.tracked_tag, index, end))
+            if not found:
+                break
+            # Помечены только переводы строк: номер строки диапазона = номер перевода строки в text
+            numbers.append(int(str(found[0]).split(".")[0]) - first_line)
+            index = str(found[1])
+        return newline_offsets(text, numbers)
+
+    def dispatch(self, command, *args):
+        """Обработчик команд изменения текста"""
+        if self.replaying:
+            return self.call(command, *args)
+        if command == "insert":
+            return self.record_insert(args)
+        if command == "delete":
+            return self.record_delete(args)
+
+        # replace = delete + insert одним действием
+        start, end = self.index(args[0]), self.index(args[1])
+        with self.action():
+            self.record_delete((start, end))
+            self.record_insert((start,) + args[2:])
+        return ""
+
+    def record_insert(self, args):
+        start = self.index(args[0])
+        if self.compare(start, "==", "end"):
+            start = self.index("end-1c")
+        chars = "".join(args[1::2])
+        tagged = []
+        if self.tracked_tag is not None:
+            offset = 0
+            for position in range(1, len(args), 2):
+                tags = args[position + 1] if position + 1 < len(args) else ""
+                if self.tracked_tag in self.widget.tk.splitlist(tags):
+                    tagged.extend(range(offset, offset + len(args[position])))
+                offset += len(args[position])
+
+        # Метка с правой гравитацией окажется сразу после вставленного текста
+        self.call("mark", "set", "undo_end", start)
+        self.call("mark", "gravity", "undo_end", "right")
+        result = self.call("insert", *args)
+        end = self.index("undo_end")
+        self.call("mark", "unset", "undo_end")
+
+        if chars:
+            self.notify("insert", start, end, chars)
+            self.record(("insert", start, end, chars, tagged))
+        return result
+
+    def record_delete(self, args):
+        if len(args) > 2:
+            # Удаление нескольких диапазонов сразу не восстанавливаем - сбрасываем журнал
+            self.clear()
+            result = self.call("delete", *args)
+            self.notify("reset")
+            return result
+
+        start = self.index(args[0])
+        end = self.index(args[1]) if len(args) > 1 else self.index(f"{start}+1c")
+        # Последний перевод строки Tk не удаляет
+        if self.compare(end, "==", "end"):
+            end = self.index("end-1c")
+        if not self.compare(start, "<", end):
+            return self.call("delete", *args)
+
+        text = self.call("get", start, end)
+        tagged = self.tagged_offsets(start, end, text)
+        result = self.call("delete", start, end)
+        self.notify("delete", start, end, text)
+        self.record(("delete", start, end, text, tagged))
+        return result
+
+    def can_merge(self, op, now):
+        """Ввод и удаление по одному символу подряд объединяем в одно действие"""
+        if not self.undo_stack or now - self.last_time > self.GROUP_TIMEOUT:
+            return False
+        last = self.undo_stack[-1][-1]
+        kind, start, end, text, _ = op
+        if kind != last[0] or len(text) != 1 or len(last[3]) != 1:
+            return False
+        if kind == "insert":
+            # Пробел после слова начинает новое действие
+            return start == last[2] and not (text.isspace() and not last[3].isspace())
+        # Backspace (удаляем перед предыдущим) или Delete (на том же месте)
+        return end == last[1] or start == last[1]
+
+    def record(self, op):
+        self.redo_stack.clear()
+        now = time.monotonic()
+        if self.current is None:
+            if self.can_merge(op, now):
+                self.current = self.undo_stack[-1]
+            else:
+                self.current = []
+                self.undo_stack.append(self.current)
+            # Все правки одного события Tk (например, ввод поверх выделения) - одно действие
+            self.widget.after_idle(self.close_group)
+
+        self.current.append(op)
+        self.size += len(op[3])
+        self.last_time = now
+        self.trim()
+
+    def close_group(self):
+        if self.depth == 0:
+            self.current = None
+
+    def begin_group(self):
+        if self.depth == 0:
+            self.current = []
+            self.undo_stack.append(self.current)
+        self.depth += 1
+
+    def end_group(self):
+        self.depth -= 1
+        if self.depth == 0:
+            if not self.current and self.undo_stack and self.undo_stack[-1] is self.current:
+                self.undo_stack.pop()
+            self.current = None
+
+    @contextlib.contextmanager
+    def action(self):
+        """Все правки внутри блока отменяются одним действием"""
+        self.begin_group()
+        try:
+            yield
+        finally:
+            self.end_group()
+
+    def trim(self):
+        """Удаляем самые старые действия, пока журнал превышает лимит"""
+        while self.size > self.max_chars and len(self.undo_stack) > 1:
+            group = self.undo_stack.popleft()
+            self.size -= sum(len(op[3]) for op in group)
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.size = 0
+        self.current = None
+
+    def apply(self, group, undo):
+        """Применяем группу операций в прямом или обратном порядке"""
+        self.replaying = True
+        try:
+            for kind, start, end, text, tagged in (reversed(group) if undo else group):
+                if (kind == "insert") == undo:
+                    self.call("delete", start, end)
+                    self.notify("delete", start, end, text)
+                    cursor = start
+                else:
+                    if tagged:
+                        self.call("insert", start, *tagged_insert_args(text, tagged, self.tracked_tag))
+                    else:
+                        self.call("insert", start, text)
+                    self.notify("insert", start, end, text)
+                    cursor = end
+            self.call("mark", "set", "insert", cursor)
+            self.call("see", "insert")
+        finally:
+            self.replaying = False
+
+    def undo(self):
+        """Отменяем последнее действие. Возвращает False, если отменять нечего"""
+        self.current = None
+        if not self.undo_stack or self.depth:
+            return False
+        group = self.undo_stack.pop()
+        self.apply(group, undo=True)
+        self.redo_stack.append(group)
+        self.size -= sum(len(op[3]) for op in group)
+        return True
+
+    def redo(self):
+        """Повторяем отмененное действие. Возвращает False, если повторять нечего"""
+        self.current = None
+        if not self.redo_stack or self.depth:
+            return False
+        group = self.redo_stack.pop()
+        self.apply(group, undo=False)
+        self.undo_stack.append(group)
+        self.size += sum(len(op[3]) for op in group)
+        self.trim()
+        return True
+
+
+EMOJI_PATTERN = re.compile("["
+                           u"\U0001F600-\U0001F64F"  # emoticons
+                           u"\U0001F300-\U0001F5FF"  # symbols & pictographs
+                           u"\U0001F680-\U0001F6FF"  # transport & map symbols
+                           u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
+                           u"\U00002500-\U00002BEF"  # chinese char
+                           u"\U00002702-\U000027B0"
+                           u"\U00002702-\U000027B0"
+                           u"\U000024C2-\U0001F251"
+                           u"\U0001f926-\U0001f937"
+                           u"\U00010000-\U0010ffff"
+                           u"\u2640-\u2642"
+                           u"\u2600-\u2B55"
+                           u"\u200d"
+                           u"\u23cf"
+                           u"\u23e9"
+                           u"\u231a"
+                           u"\ufe0f"  # dingbats
+                           u"\u3030"
+                           "]+", flags=re.UNICODE)
+
+# Классические текстовые смайлы
+TEXT_SMILES_PATTERN = re.compile("|".join(
+    re.escape(smile) for smile in [":\)", ":D", ":\(=", ":P", ";\)", ":\|", ":\/", ":O", ":\*", ":'\("]))
+
+LAYOUT_EN = "qwertyuiop[]asdfghjkl;'zxcvbnm,." + "QWERTYUIOP{}ASDFGHJKL:\"ZXCVBNM<>"
+LAYOUT_RU = "йцукенгшщзхъфывапролджэячсмитьбю" + "ЙЦУКЕНГШЩЗХЪФЫВАПРОЛДЖЭЯЧСМИТЬБЮ"
+LAYOUT_TABLE = str.maketrans(dict(list(zip(LAYOUT_EN, LAYOUT_RU)) + list(zip(LAYOUT_RU, LAYOUT_EN))))
+
+
+def remove_emojis_text(text):
+    """Удаляем смайлы и эмодзи из текста"""
+    return EMOJI_PATTERN.sub("", TEXT_SMILES_PATTERN.sub("", text))
+
+
+def change_layout_text(text):
+    """Меняем раскладку текста (en <-> ru)"""
+    return text.translate(LAYOUT_TABLE)
+
+
+def remove_digits_text(text):
+    """Удаляем все цифры"""
+    return ''.join(c for c in text if not c.isdigit())
+
+
+def remove_letters_text(text):
+    """Удаляем все буквы"""
+    return ''.join(c for c in text if not c.isalpha())
+
+
+# Операции над текстом, общие для редактора и пакетного режима.
+# Все они работают посимвольно, поэтому их можно применять к кускам,
+# разрезанным по границам строк.
+TEXT_OPERATIONS = {
+    "upper": str.upper,
+    "lower": str.lower,
+    "remove-digits": remove_digits_text,
+    "remove-letters": remove_letters_text,
+    "remove-emojis": remove_emojis_text,
+    "layout": change_layout_text,
+}
+
+
+def apply_operations(text, operations):
+    """Последовательно применяем операции к тексту"""
+    for name in operations:
+        text = TEXT_OPERATIONS[name](text)
+    return text
+
+
+def delete_words_text(text, words):
+    """Удаляем слова, перечисленные через запятую"""
+    for word in words.split(','):
+        cleaned_word = word.strip()
+        if cleaned_word:
+            text = text.replace(cleaned_word, '')
+    return text
+
+
+def build_search_pattern(pattern, case_sensitive=False, whole_word=False):
+    """Компилируем шаблон поиска из диалога "Найти и заменить" """
+    if whole_word:
+        pattern = r"\b" + re.escape(pattern) + r"\b"
+    return re.compile(pattern, 0 if case_sensitive else re.IGNORECASE)
+
+
+def text_statistics(text):
+    """Считаем статистику текста за один проход Counter по символам"""
+    char_counter = Counter(text)
+    chars = len(text)
+    spaces = char_counter[' ']
+    # Классифицируем только различные символы, а не каждый символ текста
+    digits = sum(count for char, count in char_counter.items() if char.isdigit())
+    letters = sum(count for char, count in char_counter.items() if char.isalpha())
+    return {
+        "chars": chars,
+        "chars_no_space": chars - spaces,
+        "words": len(text.split()),
+        "lines": char_counter['\n'] + 1,
+        "digits": digits,
+        "letters": letters,
+        "special": chars - digits - letters - spaces - char_counter['\n'],
+        "top_chars": char_counter.most_common(5),
+    }
+
+
+def decode_text_bytes(raw_data, chunk_size=64 * 1024):
+    """Декодируем содержимое файла, определяя кодировку.
+
+    Корректный UTF-8 декодируется сразу; иначе chardet получает файл
+    кусками и останавливается, как только уверен в кодировке.
+    """
+    try:
+        text, encoding = raw_data.decode('utf-8'), 'utf-8'
+    except UnicodeDecodeError:
+        detector = chardet.UniversalDetector()
+        for start in range(0, len(raw_data), chunk_size):
+            detector.feed(raw_data[start:start + chunk_size])
+            if detector.done:
+                break
+        detector.close()
+        encoding = detector.result['encoding'] or 'utf-8'
+        text = raw_data.decode(encoding)
+    if text.startswith('\ufeff'):
+        text = text[1:]
+    # Как при чтении в текстовом режиме: переводы строк приводим к '\n'
+    return text.replace('\r\n', '\n').replace('\r', '\n'), encoding
+
+
+def detect_file_encoding(path, sample_size=1024 * 1024):
+    """Кодировка файла для потокового чтения по первым sample_size байтам.
+
+    Срез может оборвать многобайтовый символ - это не ошибка; файл с BOM читаем как utf-8-sig,
+    иначе BOM попадет в текст первым символом.
+    """
+    with open(path, "rb") as f:
+        sample = f.read(sample_size)
+        complete = not f.read(1)
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=complete)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return chardet.detect(sample)["encoding"] or "utf-8"
+
+
+def transform_stream(source, target, operations, encoding="utf-8", chunk_size=1024 * 1024):
+    """Потоково обрабатываем бинарный поток кусками, выровненными по строкам.
+
+    Возвращает (прочитано байт, записано байт).
+    """
+    bytes_in = bytes_out = 0
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        if not chunk.endswith(b"\n"):
+            # Дочитываем строку до конца, чтобы не резать символы и смайлы
+            chunk += source.readline()
+        bytes_in += len(chunk)
+        data = apply_operations(chunk.decode(encoding, errors="surrogateescape"), operations)
+        data = data.encode(encoding, errors="surrogateescape")
+        target.write(data)
+        bytes_out += len(data)
+    return bytes_in, bytes_out
+
+
+def transform_file(job):
+    """Обрабатываем один файл (выполняется в процессе пула)"""
+    input_path, output_path, operations, encoding = job
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(input_path, "rb") as source, open(output_path, "wb") as target:
+        return transform_stream(source, target, operations, encoding)
+
+
+class BatchProcessor:
+    """Пакетная обработка файлов без графического интерфейса"""
+
+    def __init__(self, operations, max_workers=None, encoding="utf-8"):
+        unknown = [name for name in operations if name not in TEXT_OPERATIONS]
+        if unknown:
+            raise ValueError(f"Неизвестные операции: {', '.join(unknown)}. "
+                             f"Доступны: {', '.join(TEXT_OPERATIONS)}")
+        self.operations = list(operations)
+        self.max_workers = max_workers
+        self.encoding = encoding
+
+    @staticmethod
+    def collect_jobs(input_path, output_path):
+        """Составляем пары (входной файл, выходной файл)"""
+        if not os.path.isdir(input_path):
+            if os.path.isdir(output_path):
+                output_path = os.path.join(output_path, os.path.basename(input_path))
+            return [(input_path, output_path)]
+
+        jobs = []
+        for folder, _, files in os.walk(input_path):
+            for name in sorted(files):
+                source = os.path.join(folder, name)
+                relative = os.path.relpath(source, input_path)
+                jobs.append((source, os.path.join(output_path, relative)))
+        return jobs
+
+    def run_stream(self, source, target):
+        """Обрабатываем stdin -> stdout"""
+        started = time.perf_counter()
+        bytes_in, bytes_out = transform_stream(source, target, self.operations, self.encoding)
+        target.flush()
+        return self.make_stats(1, 0, bytes_in, bytes_out, time.perf_counter() - started)
+
+    def run(self, input_path, output_path, progress_callback=None):
+        """Обрабатываем файл или папку; несколько файлов — в пуле процессов"""
+        pairs = self.collect_jobs(input_path, output_path)
+        jobs = [(source, target, self.operations, self.encoding) for source, target in pairs]
+        started = time.perf_counter()
+        files = failed = bytes_in = bytes_out = 0
+
+        if len(jobs) == 1:
+            results = [(jobs[0], self.safe_transform(jobs[0]))]
+        else:
+            results = []
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self.safe_transform, job): job for job in jobs}
+                for future in as_completed(futures):
+                    results.append((futures[future], future.result()))
+                    if progress_callback:
+                        progress_callback(len(results), len(jobs))
+
+        for job, result in results:
+            if isinstance(result, Exception):
+                print(f"Ошибка обработки {job[0]}: {result}", file=sys.stderr)
+                failed += 1
+            else:
+                files += 1
+                bytes_in += result[0]
+                bytes_out += result[1]
+
+        return self.make_stats(files, failed, bytes_in, bytes_out, time.perf_counter() - started)
+
+    @staticmethod
+    def safe_transform(job):
+        """Ошибка одного файла не должна останавливать всю пачку"""
+        try:
+            return transform_file(job)
+        except Exception as e:
+            return e
+
+    @staticmethod
+    def make_stats(files, failed, bytes_in, bytes_out, elapsed):
+        return {
+            "files": files,
+            "failed": failed,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "elapsed": elapsed,
+            "mb_per_sec": bytes_in / (1024 * 1024) / elapsed if elapsed > 0 else 0.0,
+        }
+
+    @staticmethod
+    def format_stats(stats):
+        return (f"Файлов: {stats['files']}, ошибок: {stats['failed']}, "
+                f"{stats['bytes_in'] / (1024 * 1024):.2f} МБ за {stats['elapsed']:.2f} с "
+                f"({stats['mb_per_sec']:.1f} МБ/с)")
+
+
+def run_batch_cli(argv):
+    """Точка входа `python app.py batch --ops upper,layout in/ out/`"""
+    parser = argparse.ArgumentParser(
+        prog="app.py batch",
+        description="Пакетная обработка текста без графического интерфейса")
+    parser.add_argument("--ops", required=True,
+                        help=f"операции через запятую: {', '.join(TEXT_OPERATIONS)}")
+    parser.add_argument("--encoding", default="utf-8", help="кодировка файлов (по умолчанию utf-8)")
+    parser.add_argument("--workers", type=int, default=None, help="число процессов")
+    parser.add_argument("input", nargs="?", default="-", help="файл, папка или - для stdin")
+    parser.add_argument("output", nargs="?", default="-", help="файл, папка или - для stdout")
+    args = parser.parse_args(argv)
+
+    try:
+        processor = BatchProcessor([op.strip() for op in args.ops.split(",") if op.strip()],
+                                   args.workers, args.encoding)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.input == "-" or args.output == "-":
+        source = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+        target = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        try:
+            stats = processor.run_stream(source, target)
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+            if target is not sys.stdout.buffer:
+                target.close()
+    else:
+        if not os.path.exists(args.input):
+            parser.error(f"Путь не найден: {args.input}")
+        stats = processor.run(args.input, args.output)
+
+    print(processor.format_stats(stats), file=sys.stderr)
+    return 1 if stats["failed"] else 0
+
+
+class BenchmarkSuite:
+    """Воспроизводимые замеры основных операций над текстом и хранилищем истории"""
+    CORPORA = ("latin", "cyrillic", "emoji-chat", "json")
+    DEFAULT_SIZES = "1K,100K,1M,10M,100M"
+    SIZE_UNITS = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    BLOCK_SIZE = 256 * 1024
+    HISTORY_ENTRIES = 20
+    PIECE_TABLE_EDITS = 1000
+
+    LATIN_WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit",
+                   "sed", "do", "eiusmod", "tempor", "the", "quick", "brown", "fox", "2024", "42")
+    CYRILLIC_WORDS = ("привет", "мир", "текст", "редактор", "строка", "и", "в", "не", "что",
+                      "раскладка", "смайл", "история", "файл", "123", "ёжик")
+    EMOJIS = ("😀", "😂", "👍", "🔥", "❤️", "🎉", "🙈", "🚀", ":)", ":D")
+
+    def __init__(self, sizes=None, corpora=None, repeat=3, min_time=0.2, seed=42):
+        self.sizes = [self.parse_size(size) for size in (sizes or self.DEFAULT_SIZES).split(",")]
+        self.corpora = list(corpora or self.CORPORA)
+        self.repeat = repeat
+        self.min_time = min_time
+        self.seed = seed
+        self.cases = [
+            ("change_layout", self.case_change_layout),
+            ("remove_emojis", self.case_remove_emojis),
+            ("delete_words", self.case_delete_words),
+            ("show_stats", self.case_show_stats),
+            ("find", self.case_find),
+            ("replace_all", self.case_replace_all),
+            ("open_file_utf8", self.case_open_file_utf8),
+            ("open_file_cp1251", self.case_open_file_cp1251),
+            ("history_add", self.case_history_add),
+            ("history_save", self.case_history_save),
+            ("history_add_queued", self.case_history_add_queued),
+            ("history_load", self.case_history_load),
+            ("history_filter", self.case_history_filter),
+            ("history_archive_search", self.case_history_archive_search),
+            ("fuzzy_search", self.case_fuzzy_search),
+            ("diff_snapshots", self.case_diff_snapshots),
+            ("translate_edited", self.case_translate_edited),
+            ("piece_table_edits", self.case_piece_table_edits),
+            ("history_snapshot", self.case_history_snapshot),
+            ("split_long_lines", self.case_split_long_lines),
+        ]
+
+    @classmethod
+    def parse_size(cls, size):
+        """'100K' -> 102400"""
+        size = size.strip().upper()
+        if size[-1:] in cls.SIZE_UNITS:
+            return int(float(size[:-1]) * cls.SIZE_UNITS[size[-1]])
+        return int(size)
+
+    @staticmethod
+    def format_size(size):
+        for unit, factor in (("M", 1024 * 1024), ("K", 1024)):
+            if size >= factor and size % factor == 0:
+                return f"{size // factor}{unit}"
+        return str(size)
+
+    def make_block(self, kind, rng):
+        """Блок синтетического текста примерно BLOCK_SIZE байт"""
+        parts = []
+        length = 0
+        while length < self.BLOCK_SIZE:
+            if kind == "latin":
+                line = " ".join(rng.choice(self.LATIN_WORDS) for _ in range(rng.randint(5, 15))) + ".\n"
+            elif kind == "cyrillic":
+                line = " ".join(rng.choice(self.CYRILLIC_WORDS) for _ in range(rng.randint(5, 15))) + ".\n"
+            elif kind == "emoji-chat":
+                words = [rng.choice(self.EMOJIS if rng.random() < 0.3 else self.CYRILLIC_WORDS + self.LATIN_WORDS)
+                         for _ in range(rng.randint(3, 10))]
+                line = f"[{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}] user{rng.randint(1, 9)}: " \
+                       + " ".join(words) + "\n"
+            else:
+                # Длинные строки JSON: объекты без переводов строк внутри
+                line = json.dumps({"id": rng.randint(0, 10 ** 6),
+                                   "name": rng.choice(self.LATIN_WORDS),
+                                   "title": " ".join(rng.choice(self.CYRILLIC_WORDS) for _ in range(5)),
+                                   "tags": [rng.choice(self.LATIN_WORDS) for _ in range(4)],
+                                   "score": rng.random()}, ensure_ascii=False) + ", "
+            parts.append(line)
+            length += len(line.encode("utf-8"))
+        return "".join(parts)
+
+    def make_corpus(self, kind, size):
+        """Детерминированный корпус размером около size байт в UTF-8"""
+        rng = random.Random(f"{self.seed}-{kind}")
+        block = self.make_block(kind, rng)
+        block_bytes = len(block.encode("utf-8"))
+        repeats, rest = divmod(size, block_bytes)
+        # Остаток отрезаем по символам пропорционально, чтобы не резать суррогаты в байтах
+        tail = block[:int(len(block) * rest / block_bytes)]
+        text = block * repeats + tail
+        if kind == "json":
+            text = "[" + text.rstrip(", ") + "]"
+        return text
+
+    # Каждый замер возвращает время измеряемой части в секундах
+    def case_change_layout(self, text, workdir):
+        started = time.perf_counter()
+        change_layout_text(text)
+        return time.perf_counter() - started
+
+    def case_remove_emojis(self, text, workdir):
+        started = time.perf_counter()
+        remove_emojis_text(text)
+        return time.perf_counter() - started
+
+    def case_delete_words(self, text, workdir):
+        started = time.perf_counter()
+        delete_words_text(text, "lorem, the, привет, и, user1")
+        return time.perf_counter() - started
+
+    def case_show_stats(self, text, workdir):
+        started = time.perf_counter()
+        text_statistics(text)
+        return time.perf_counter() - started
+
+    def case_find(self, text, workdir):
+        started = time.perf_counter()
+        pattern = build_search_pattern("ёжик", whole_word=True)
+        sum(1 for _ in pattern.finditer(text))
+        return time.perf_counter() - started
+
+    def case_replace_all(self, text, workdir):
+        started = time.perf_counter()
+        build_search_pattern("fox").sub("cat", text)
+        return time.perf_counter() - started
+
+    def case_open_file_utf8(self, text, workdir):
+        return self.time_open_file(text, workdir, "utf-8")
+
+    def case_open_file_cp1251(self, text, workdir):
+        return self.time_open_file(text, workdir, "cp1251")
+
+    def time_open_file(self, text, workdir, encoding):
+        path = os.path.join(workdir, f"corpus.{encoding}.txt")
+        if not os.path.exists(path):
+            try:
+                data = text.encode(encoding)
+            except UnicodeEncodeError:
+                return None
+            if encoding != "utf-8" and data.isascii():
+                # Чистый ASCII и так декодируется как UTF-8 — замер ничего не добавит
+                return None
+            with open(path, "wb") as f:
+                f.write(data)
+        started = time.perf_counter()
+        with open(path, "rb") as f:
+            decode_text_bytes(f.read())
+        return time.perf_counter() - started
+
+    def history_texts(self, text):
+        """Записи истории: документ, нарезанный на HISTORY_ENTRIES частей"""
+        step = max(1, len(text) // self.HISTORY_ENTRIES)
+        return [text[i:i + step] for i in range(0, len(text), step)][:self.HISTORY_ENTRIES]
+
+    def history_add(self, texts, store):
+        # Так же, как TextEditorApp.add_to_history
+        return [{"hash": store.add(item), "timestamp": f"2024-01-01 00:00:{i:02d}"}
+                for i, item in enumerate(texts)]
+
+    def case_history_add(self, text, workdir):
+        texts = self.history_texts(text)
+        store = BlobStore(tempfile.mkdtemp(dir=workdir))
+        started = time.perf_counter()
+        self.history_add(texts, store)
+        return time.perf_counter() - started
+
+    def case_history_add_queued(self, text, workdir):
+        # Как add_to_history в приложении: поток Tk только ставит записи в очередь фонового потока
+        directory = tempfile.mkdtemp(dir=workdir)
+        writer = PersistenceWriter()
+        store = BlobStore(directory, writer=writer)
+        path = os.path.join(directory, "history.json")
+        entries = []
+        started = time.perf_counter()
+        for i, item in enumerate(self.history_texts(text)):
+            entries.append({"hash": store.add(item), "timestamp": f"2024-01-01 00:00:{i:02d}"})
+            writer.write_json(path, entries)
+        elapsed = time.perf_counter() - started
+        writer.close()
+        return elapsed
+
+    def case_history_save(self, text, workdir):
+        entries = self.history_add(self.history_texts(text), BlobStore(tempfile.mkdtemp(dir=workdir)))
+        path = os.path.join(workdir, "history.json")
+        started = time.perf_counter()
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False, indent=2)
+        return time.perf_counter() - started
+
+    def case_history_load(self, text, workdir):
+        directory = tempfile.mkdtemp(dir=workdir)
+        entries = self.history_add(self.history_texts(text), BlobStore(directory))
+        path = os.path.join(workdir, "history.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False, indent=2)
+        started = time.perf_counter()
+        store = BlobStore(directory)
+        with open(path, "r", encoding="utf-8") as f:
+            loaded = json.load(f)
+        for item in loaded:
+            store.retain(item["hash"])
+            store.get(item["hash"])
+        return time.perf_counter() - started
+
+    def case_history_filter(self, text, workdir):
+        store = BlobStore(tempfile.mkdtemp(dir=workdir))
+        entries = self.history_add(self.history_texts(text), store)
+        started = time.perf_counter()
+        # Так же, как TextEditorApp.filter_history
+        [item for item in reversed(entries) if "ёжик" in store.get(item["hash"]).lower()]
+        return time.perf_counter() - started
+
+    def case_history_archive_search(self, text, workdir):
+        # Как filter_history по архиву: сегменты распаковываются по одному
+        writer = PersistenceWriter(coalesce_seconds=0)
+        archive = HistoryArchive(writer, tempfile.mkdtemp(dir=workdir))
+        texts = self.history_texts(text)
+        for start in range(0, len(texts), HistoryArchive.SEGMENT_ENTRIES):
+            archive.append([(f"2024-01-01 00:00:{i:02d}", item)
+                            for i, item in enumerate(texts[start:start + HistoryArchive.SEGMENT_ENTRIES])])
+        writer.flush()
+        started = time.perf_counter()
+        archive.search("ёжик")
+        elapsed = time.perf_counter() - started
+        writer.close()
+        return elapsed
+
+    def case_fuzzy_search(self, text, workdir):
+        # Строки корпуса - записи (до 100 тыс.); замеряется только поиск, с опечаткой и без
+        index = FuzzySearchIndex()
+        for i, line in enumerate(itertools.islice(filter(None, text.splitlines()), 100000)):
+            index.add(i, None, line)
+        # Слово из корпуса, оно же с пропущенной буквой и пара слов
+        words = [word for word in text[:100000].split() if len(word) >= 5] or ["hello"]
+        word = words[len(words) // 2]
+        queries = (word, word[:2] + word[3:], " ".join(words[:2]))
+        started = time.perf_counter()
+        for query in queries:
+            index.search(query)
+        return (time.perf_counter() - started) / len(queries)
+
+    def case_diff_snapshots(self, text, workdir):
+        # Две версии документа: правлена каждая сотая строка; кэш сравнений не используется
+        lines = text.splitlines()
+        rng = random.Random(self.seed)
+        for number in range(0, len(lines), 100):
+            position = rng.randint(0, len(lines[number]))
+            lines[number] = lines[number][:position] + "правка" + lines[number][position:]
+        edited = "\n".join(lines)
+        started = time.perf_counter()
+        TextDiff(cache_size=0).compare(text, edited)
+        return time.perf_counter() - started
+
+    def case_translate_edited(self, text, workdir):
+        # Повторный перевод после правки одного предложения через локальный сервер-заглушку
+        # (первые 100 тыс. символов, чтобы первый перевод не занимал минуты)
+        text = text[:100000]
+        stub = StubTranslationServer()
+        url = stub.start()
+        writer = PersistenceWriter(coalesce_seconds=0)
+        service = TranslationService(HttpTranslationBackend(url),
+                                     TranslationCache(writer, os.path.join(tempfile.mkdtemp(dir=workdir), "cache.json")))
+        try:
+            service.translate(text)
+            middle = len(text) // 2
+            edited = text[:middle] + " правка. " + text[middle:]
+            started = time.perf_counter()
+            service.translate(edited)
+            return time.perf_counter() - started
+        finally:
+            stub.close()
+            writer.close()
+
+    def case_piece_table_edits(self, text, workdir):
+        document = PieceTable(text)
+        rng = random.Random(self.seed)
+        started = time.perf_counter()
+        for _ in range(self.PIECE_TABLE_EDITS):
+            offset = rng.randint(0, len(document))
+            if rng.random() < 0.7:
+                document.insert(offset, "abc")
+            else:
+                document.delete(offset, min(3, len(document) - offset))
+            document.line_count()
+        return time.perf_counter() - started
+
+    def case_history_snapshot(self, text, workdir):
+        """Цена одной правки в обычном режиме: снимок текста, сравнение и хэш для истории
+        (так же, как TextEditorApp.on_text_modified); по ней выбран порог большого документа"""
+        document = PieceTable(text)
+        last_text = document.text().strip()
+        started = time.perf_counter()
+        document.insert(len(document) // 2, "x")
+        current_text = document.text().strip()
+        if current_text != last_text:
+            BlobStore.hash_text(current_text)
+        return time.perf_counter() - started
+
+    def case_split_long_lines(self, text, workdir):
+        splitter = LineSplitter()
+        started = time.perf_counter()
+        LineSplitter.break_positions(splitter.split(text)[1])
+        return time.perf_counter() - started
+
+    def time_case(self, case, text, workdir):
+        """Повторяем замер, пока не наберем repeat раз и min_time секунд (не более 50 раз)"""
+        timings = []
+        while len(timings) < self.repeat or (sum(timings) < self.min_time and len(timings) < 50):
+            elapsed = case(text, workdir)
+            if elapsed is None:
+                return None
+            timings.append(elapsed)
+        return sorted(timings)
+
+    def run(self, progress=None):
+        """Запускаем все замеры; возвращаем словарь для сохранения в JSON"""
+        results = []
+        for kind in self.corpora:
+            for size in self.sizes:
+                text = self.make_corpus(kind, size)
+                with tempfile.TemporaryDirectory() as workdir:
+                    for name, case in self.cases:
+                        timings = self.time_case(case, text, workdir)
+                        if timings is None:
+                            continue
+                        result = {
+                            "case": name,
+                            "corpus": kind,
+                            "size": size,
+                            "runs": len(timings),
+                            "best": timings[0],
+                            "median": timings[len(timings) // 2],
+                            "mb_per_sec": size / (1024 * 1024) / timings[0] if timings[0] > 0 else 0.0,
+                        }
+                        results.append(result)
+                        if progress:
+                            progress(result)
+                del text
+        return {
+            "meta": {
+                "date": datetime.now().isoformat(timespec="seconds"),
+                "python": sys.version.split()[0],
+                "platform": sys.platform,
+                "seed": self.seed,
+            },
+            "results": results,
+        }
+
+    @staticmethod
+    def format_result(result):
+        return (f"{result['case']:<18} {result['corpus']:<10} {BenchmarkSuite.format_size(result['size']):>6} "
+                f"{result['best'] * 1000:>10.2f} мс {result['mb_per_sec']:>9.1f} МБ/с")
+
+    @staticmethod
+    def compare(old, new, threshold=0.15, min_delta=0.0005):
+        """Сравниваем два прогона; регрессия — медленнее на threshold и не меньше min_delta секунд"""
+        baseline = {(r["case"], r["corpus"], r["size"]): r for r in old["results"]}
+        rows = []
+        for result in new["results"]:
+            before = baseline.get((result["case"], result["corpus"], result["size"]))
+            if not before:
+                continue
+            ratio = result["best"] / before["best"] if before["best"] > 0 else 1.0
+            regression = ratio > 1 + threshold and result["best"] - before["best"] >= min_delta
+            rows.append((result, before, ratio, regression))
+        return rows
+
+
+def run_bench_cli(argv):
+    """Точка входа `python app.py bench`"""
+    parser = argparse.ArgumentParser(prog="app.py bench", description="Замеры производительности без интерфейса")
+    parser.add_argument("--sizes", default=BenchmarkSuite.DEFAULT_SIZES, help="размеры корпусов, например 1K,1M,100M")
+    parser.add_argument("--corpora", default=",".join(BenchmarkSuite.CORPORA),
+                        help=f"корпуса: {', '.join(BenchmarkSuite.CORPORA)}")
+    parser.add_argument("--cases", default="", help="только перечисленные замеры (через запятую)")
+    parser.add_argument("--repeat", type=int, default=3, help="минимальное число повторов")
+    parser.add_argument("--output", default="benchmark.json", help="файл результатов")
+    parser.add_argument("--compare", nargs="+", metavar="JSON",
+                        help="сравнить с прошлым прогоном: СТАРЫЙ.json [НОВЫЙ.json]")
+    parser.add_argument("--threshold", type=float, default=0.15, help="допустимое замедление (0.15 = 15%%)")
+    args = parser.parse_args(argv)
+
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare принимает один или два файла")
+
+    if args.compare and len(args.compare) == 2:
+        with open(args.compare[1], "r", encoding="utf-8") as f:
+            new = json.load(f)
+    else:
+        corpora = [kind.strip() for kind in args.corpora.split(",") if kind.strip()]
+        unknown = [kind for kind in corpora if kind not in BenchmarkSuite.CORPORA]
+        if unknown:
+            parser.error(f"Неизвестные корпуса: {', '.join(unknown)}")
+        suite = BenchmarkSuite(args.sizes, corpora, args.repeat)
+        if args.cases:
+            wanted = {name.strip() for name in args.cases.split(",")}
+            suite.cases = [(name, case) for name, case in suite.cases if name in wanted]
+        new = suite.run(progress=lambda result: print(BenchmarkSuite.format_result(result), flush=True))
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(new, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+    if not args.compare:
+        return 0
+
+    with open(args.compare[0], "r", encoding="utf-8") as f:
+        old = json.load(f)
+    regressions = 0
+    for result, before, ratio, regression in BenchmarkSuite.compare(old, new, args.threshold):
+        mark = "РЕГРЕССИЯ" if regression else ""
+        regressions += regression
+        print(f"{result['case']:<18} {result['corpus']:<10} {BenchmarkSuite.format_size(result['size']):>6} "
+              f"{before['best'] * 1000:>10.2f} -> {result['best'] * 1000:>10.2f} мс  x{ratio:.2f} {mark}")
+    print(f"Регрессий: {regressions}")
+    return 1 if regressions else 0
+
+
+class SingleInstance:
+    """Единственный экземпляр приложения (для каждого пользователя свой).
+
+    Первый запуск слушает локальный сокет на случайном порту и записывает порт
+    и случайный токен в файл в профиле пользователя. Последующие запуски читают
+    этот файл и передают файл или текст вместе с токеном; сообщения без верного
+    токена (другие пользователи и процессы) отклоняются.
+    """
+    HOST = "127.0.0.1"
+    FILE_NAME = "instance.json"
+    CONNECT_TIMEOUT = 0.5
+    READ_TIMEOUT = 5.0
+    ATTEMPTS = 3
+    MAX_MESSAGE_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(self.user_directory(), self.FILE_NAME)
+        self.port = None
+        self.token = None
+        self.server = None
+        self.thread = None
+
+    @staticmethod
+    def user_directory():
+        """Каталог приложения в профиле пользователя (на Windows - в %LOCALAPPDATA%)"""
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, ".advanced_text_editor")
+
+    def read_endpoint(self):
+        """Порт и токен работающего экземпляра из файла; None - файла нет или он испорчен"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                info = json.load(f)
+            return int(info["port"]), str(info["token"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def acquire(self):
+        """Пытаемся стать первым экземпляром; True — мы первый (или связаться не с кем)"""
+        for _ in range(self.ATTEMPTS):
+            endpoint = self.read_endpoint()
+            if endpoint:
+                self.port, self.token = endpoint
+                if self.request({"action": "ping"}):
+                    return False
+                # Экземпляр завершился аварийно и оставил файл
+                with contextlib.suppress(OSError):
+                    os.remove(self.path)
+
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                server.bind((self.HOST, 0))
+                server.listen(8)
+            except OSError:
+                server.close()
+                return True
+            port, token = server.getsockname()[1], secrets.token_hex(16)
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                # O_EXCL: из двух одновременно запущенных экземпляров файл создаст только один
+                fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                server.close()
+                continue
+            except OSError as e:
+                print(f"Не удалось записать файл экземпляра: {e}")
+                server.close()
+                return True
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"port": port, "token": token}, f)
+            self.server, self.port, self.token = server, port, token
+            return True
+        return True
+
+    def request(self, message):
+        """Отправляем сообщение с токеном; True — экземпляр подтвердил прием"""
+        data = json.dumps(dict(message, token=self.token), ensure_ascii=False).encode("utf-8")
+        try:
+            with socket.create_connection((self.HOST, self.port), timeout=self.CONNECT_TIMEOUT) as conn:
+                conn.settimeout(self.READ_TIMEOUT)
+                conn.sendall(data)
+                conn.shutdown(socket.SHUT_WR)
+                return conn.recv(16) == b"ok"
+        except OSError:
+            return False
+
+    def send(self, message):
+        """Передаем сообщение работающему экземпляру; True — если он подтвердил прием"""
+        if self.port is None:
+            return False
+        if not self.request(message):
+            print("Не удалось связаться с запущенным экземпляром")
+            return False
+        return True
+
+    def serve(self, handler):
+        """Принимаем сообщения в фоновом потоке и передаем их в handler"""
+        self.thread = threading.Thread(target=self.accept_loop, args=(handler,), daemon=True)
+        self.thread.start()
+
+    def accept_loop(self, handler):
+        while self.server:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+            with conn:
+                try:
+                    conn.settimeout(self.READ_TIMEOUT)
+                    chunks = []
+                    received = 0
+                    while True:
+                        chunk = conn.recv(65536)
+                        if not chunk:
+                            break
+                        received += len(chunk)
+                        if received > self.MAX_MESSAGE_BYTES:
+                            raise ValueError(f"сообщение больше {self.MAX_MESSAGE_BYTES} байт")
+                        chunks.append(chunk)
+                    message = json.loads(b"".join(chunks).decode("utf-8"))
+                    token = message.pop("token", None) if isinstance(message, dict) else None
+                    # Сравниваем байты: compare_digest не принимает строки с не-ASCII символами
+                    if not isinstance(token, str) or not hmac.compare_digest(token.encode("utf-8"),
+                                                                             self.token.encode("utf-8")):
+                        print("Отклонено сообщение без верного токена экземпляра")
+                        continue
+                    if message.get("action") != "ping":
+                        handler(message)
+                    conn.sendall(b"ok")
+                except (OSError, ValueError) as e:
+                    print(f"Ошибка приема сообщения от другого экземпляра: {e}")
+
+    def close(self):
+        if self.server:
+            server, self.server = self.server, None
+            # Файл удаляем, только если он все еще наш
+            if self.read_endpoint() == (self.port, self.token):
+                with contextlib.suppress(OSError):
+                    os.remove(self.path)
+            # shutdown будит поток, ожидающий в accept
+            with contextlib.suppress(OSError):
+                server.shutdown(socket.SHUT_RDWR)
+            server.close()
+
+    @staticmethod
+    def message_from_args(argv, stdin=None):
+        """Собираем сообщение из аргументов командной строки или текста из stdin"""
+        if argv:
+            return {"action": "open", "path": os.path.abspath(argv[0])}
+        # Читаем stdin только если в него действительно что-то передали
+        # (у pythonw stdin отсутствует, у консоли это терминал)
+        if stdin is not None:
+            try:
+                mode = os.fstat(stdin.fileno()).st_mode
+            except (OSError, ValueError, AttributeError):
+                mode = 0
+            if stat.S_ISFIFO(mode) or stat.S_ISREG(mode):
+                text = stdin.read()
+                if text:
+                    return {"action": "text", "text": text}
+        return {"action": "show"}
+
+
+class Instrumentation:
+    """Замеры времени команд в кольцевом буфере.
+
+    Каждая запись: (операция, время начала, длительность в секундах,
+    размер документа, прочитано байт, записано байт, была ли ошибка).
+    """
+
+    def __init__(self, capacity=5000, enabled=True):
+        self.records = deque(maxlen=capacity)
+        self.enabled = enabled
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def wrap(self, name, func, size_func=None):
+        """Оборачиваем команду замером; выключенный замер стоит одну проверку флага"""
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            size = size_func() if size_func else 0
+            read, written = self.bytes_read, self.bytes_written
+            started = time.time()
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = func(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self.records.append((name, started, time.perf_counter() - start, size,
+                                     self.bytes_read - read, self.bytes_written - written, failed))
+        wrapper.__name__ = getattr(func, "__name__", name)
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def count_io(self, read=0, written=0):
+        """Учитываем прочитанные и записанные байты текущей операции"""
+        if self.enabled:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def clear(self):
+        self.records.clear()
+
+    @staticmethod
+    def percentile(values, q):
+        """Перцентиль по ближайшему рангу для отсортированного списка"""
+        return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+    def summary(self):
+        """Сводка по операциям: вызовы, p50/p95/max, средний размер документа, ввод-вывод"""
+        grouped = {}
+        for name, _, elapsed, size, read, written, failed in list(self.records):
+            stats = grouped.setdefault(name, {"times": [], "sizes": 0, "read": 0, "written": 0, "errors": 0})
+            stats["times"].append(elapsed)
+            stats["sizes"] += size
+            stats["read"] += read
+            stats["written"] += written
+            stats["errors"] += failed
+
+        rows = []
+        for name, stats in grouped.items():
+            times = sorted(stats["times"])
+            rows.append({
+                "name": name,
+                "count": len(times),
+                "p50": self.percentile(times, 0.5),
+                "p95": self.percentile(times, 0.95),
+                "max": times[-1],
+                "avg_size": stats["sizes"] / len(times),
+                "read": stats["read"],
+                "written": stats["written"],
+                "errors": stats["errors"],
+            })
+        rows.sort(key=lambda row: row["p95"], reverse=True)
+        return rows
+
+
+class EditorTab:
+    """Вкладка документа: свой буфер, файл, кодировка и признак изменений.
+    Неактивная вкладка может быть выгружена: текст уходит во временный файл, виджет уничтожается."""
+
+    def __init__(self, frame, number):
+        self.frame = frame
+        self.number = number
+        self.file_path = None
+        self.encoding = "utf-8"
+        self.dirty = False
+        self.large_document = False
+        self.last_active = time.monotonic()
+        self.spill_path = None
+        # Виджет, журнал правок и модель документа (None, пока вкладка выгружена)
+        self.text_area = None
+        self.x_scrollbar = None
+        self.undo_manager = None
+        self.document = None
+
+    @property
+    def unloaded(self):
+        return self.spill_path is not None
+
+    def name(self):
+        return os.path.basename(self.file_path) if self.file_path else f"Документ {self.number}"
+
+    def title(self):
+        """Подпись вкладки: имя файла, звездочка у измененного документа"""
+        return f"{self.name()} *" if self.dirty else self.name()
+
+    def spill(self, text):
+        """Пишем text (настоящий текст вкладки) во временный файл и забываем модель документа;
+        возвращаем число байт"""
+        fd, path = tempfile.mkstemp(prefix="editor_tab_", suffix=".txt")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+                f.write(text)
+        except Exception:
+            os.remove(path)
+            raise
+        self.spill_path = path
+        self.document = None
+        self.large_document = False
+        return os.path.getsize(path)
+
+    def take_spilled(self):
+        """Читаем выгруженный текст и удаляем временный файл"""
+        with open(self.spill_path, "r", encoding="utf-8", newline="") as f:
+            text = f.read()
+        self.discard()
+        return text
+
+    def discard(self):
+        """Удаляем временный файл выгруженной вкладки"""
+        if self.spill_path:
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+            self.spill_path = None
+
+
 class TextEditorApp:
+    # Предпросмотр результата в контекстном меню
+    PREVIEW_TIMEOUT_MS = 500
+    PREVIEW_POLL_MS = 15
+    PREVIEW_CACHE_SIZE = 128
+    PREVIEW_OPERAND = re.compile(r"[\dπ]|\b(?:pi|e|tau)\b")
+    PREVIEW_OPERATOR = re.compile(r"[-+*/^%(×÷]")
+
+    # Сколько строк таблицы CSV показывать до первой подгонки под размер окна
+    CSV_VISIBLE_ROWS = 25
+
+    # История: сколько последних записей держать в горячем уровне (остальные - в архиве)
+    # и сколько сегментов архива показывать за одно нажатие
+    HISTORY_HOT_ENTRIES = 50
+    HISTORY_ARCHIVE_PAGE = 4
+
+    # Сколько лучших результатов показывать в нечетком поиске
+    FUZZY_RESULTS = 20
+
+    # Сравнение записей: сколько строк дописывать в окно за один шаг прокрутки
+    DIFF_RENDER_LINES = 400
+
+    # Без сервера перевода текст уходит в адресе страницы переводчика: длиннее URL не принимается
+    BROWSER_TRANSLATE_CHARS = 5000
+
+    # Интервал разбора очереди задач для потока Tk
+    UI_QUEUE_POLL_MS = 10
+
+    # Режим большого документа (символов). Пороги по умолчанию подобраны по `app.py bench`:
+    # на 1 млн символов статистика и снимок истории на каждую правку занимают десятки мс
+    LARGE_DOCUMENT_CHARS = 1000000
+    LARGE_DOCUMENT_EXIT_CHARS = 800000
+
+    # Выгрузка неактивных вкладок во временные файлы: через сколько секунд, от какого размера
+    # и как часто проверять. Мелкие документы не выгружаем - они почти не занимают память
+    TAB_UNLOAD_SECONDS = 300
+    TAB_UNLOAD_MIN_CHARS = 100000
+    TAB_UNLOAD_CHECK_MS = 30000
+
+    # Команды кнопок, F-клавиш, контекстного меню, конвертера и истории, которые замеряются
+    INSTRUMENTED_COMMANDS = (
+        "paste_from_clipboard", "copy_to_clipboard", "open_file", "load_file", "open_csv_view", "save_file",
+        "find_replace", "show_stats", "remove_emojis", "generate_qrcode", "open_qr_bulk_export",
+        "change_layout", "translate_text", "open_settings", "open_file_converter", "open_calculator",
+        "open_json_tools",
+        "delete_words", "delete_letters", "delete_digits", "remove_all_digits", "remove_all_letters",
+        "to_uppercase", "to_lowercase", "cut_text", "copy_text", "paste_text", "clear_text",
+        "calculate_selection", "show_selected_stats", "evaluate_all_expressions", "show_number_totals",
+        "convert_file", "convert_images_batch", "clear_conversion_cache",
+        "add_to_history", "add_checkpoint", "restore_from_history", "add_to_favorites_from_history", "delete_from_history",
+        "copy_from_favorites", "delete_from_favorites", "add_to_favorites",
+        "filter_history", "filter_favorites", "undo", "redo", "new_tab", "close_tab", "show_archived_history",
+    )
+
     def __init__(self, root):
         self.root = root
         root.title("Advanced Text Editor")
         root.geometry("800x650")
         root.protocol("WM_DELETE_WINDOW", self.minimize_to_tray)
 
+        # Замер команд: оборачиваем до создания кнопок и привязок, чтобы они получили обертки
+        self.instrumentation = Instrumentation()
+        for name in self.INSTRUMENTED_COMMANDS:
+            setattr(self, name, self.instrumentation.wrap(name, getattr(self, name), self.document_size))
+
+        # Очередь задач из других потоков (горячая клавиша, трей, запись на диск): выполняются только в потоке Tk
+        self.ui_queue = queue.Queue()
+        self.root.after(self.UI_QUEUE_POLL_MS, self.process_ui_queue)
+
+        # Вся запись данных и настроек идет в фоновом потоке
+        self.persistence = PersistenceWriter(on_error=self.report_write_error)
+
         # Загрузка истории и избранного
-        self.history = self.load_data("history.json", max_items=50)
-        self.favorites = self.load_data("favorites.json")
+        # Тексты хранятся один раз по хэшу, записи ссылаются на них
+        self.blob_store = BlobStore(writer=self.persistence)
+        # При запуске читается только горячий уровень истории; старые записи - в сжатом архиве
+        self.history_archive = HistoryArchive(self.persistence)
+        self.history_archiving = False
+        self.history_rows = []
+        self.history_archive_shown = 0
+        self.history_search_token = 0
+        # Файлы истории/избранного, которые не удалось прочитать: тексты по их ссылкам не удаляем
+        self.load_failed = []
+        self.history = self.load_entries("history.json")
+        # Нечеткий поиск: индексы строятся при первом использовании
+        self.history_fuzzy = None
+        self.history_fuzzy_pending = None
+        self.history_fuzzy_stale = False
+        self.favorites_fuzzy = None
+        self.favorites_rows = []
+        # Сравнение записей: результаты кэшируются по паре текстов; отмеченная запись - (подпись, текст)
+        self.text_diff = TextDiff()
+        self.diff_base = None
+        # Переведенные предложения; читаются с диска при первом переводе
+        self.translation_cache = TranslationCache(self.persistence)
+        self.translating = False
+        self.favorites = self.load_entries("favorites.json")
+        self.favorite_hashes = {item['hash'] for item in self.favorites}
+        # Дописываем тексты, перенесенные из старого формата, до удаления временных файлов хранилища
+        self.persistence.flush()
+        if self.load_failed:
+            print(f"Очистка хранилища текстов пропущена: не прочитаны {', '.join(self.load_failed)}")
+        else:
+            self.blob_store.collect_garbage()
 
-        # Создаем панель вкладок
+        # Панель вкладок: документы, затем история и избранное
         self.notebook = ttk.Notebook(root)
         self.notebook.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        self.notebook.bind("<Button-2>", self.on_tab_middle_click)
+        self.notebook.bind("<Button-3>", self.show_tab_menu)
+        self.tab_menu = Menu(self.root, tearoff=0)
+
+        self.tk_wide_chars = int(self.root.tk.call("string", "length", "\U0001F600")) == 2
+
+        # Режим большого документа: включается автоматически по размеру (у каждой вкладки свой)
+        self.editor_settings = self.load_editor_settings()
+        self.document_mode_pending = False
+        self.background_executor = ThreadPoolExecutor(max_workers=1)
+        self.mode_var = tk.StringVar(value="Обычный режим")
+
+        # Разбивка длинных строк: виджет показывает сегменты, остальной код видит настоящий текст
+        self.line_splitter = LineSplitter(self.editor_settings["long_line_chars"],
+                                          self.editor_settings["line_segment_chars"])
+        self.true_text_cache = ""
+        self.true_text_version = 0
+        self.break_offsets = []
+        self.break_positions = []
+        self.break_version = 0
 
-        # Вкладка основного редактора
-        self.editor_frame = ttk.Frame(self.notebook)
-        self.notebook.add(self.editor_frame, text="Редактор")
-
-        # Создаем текстовое поле с прокруткой
-        self.text_area = scrolledtext.ScrolledText(
-            self.editor_frame,
-            wrap=tk.WORD,
-            width=90,
-            height=25,
-            font=("Arial", 12)
-        )
-        self.text_area.pack(padx=15, pady=15, fill=tk.BOTH, expand=True)
+        # Переменная для отслеживания изменений
+        self.last_history_text = ""
 
-        # Привязываем обработчик изменений текста
-        self.text_area.bind("<<Modified>>", self.on_text_modified)
-        self.text_area.bind("<FocusOut>", self.on_focus_out)
+        # Вкладки документов: у каждой свой виджет, модель документа и журнал правок.
+        # text_area, document и undo_manager приложения указывают на текущую вкладку
+        self.tabs = []
+        self.current_tab = None
+        self.tab_numbers = itertools.count(1)
+        self.new_tab()
 
         # Загружаем настройки горячих клавиш
         self.hotkeys = self.load_hotkeys()
 
+        # Фоновое вычисление результата для контекстного меню
+        self.preview_executor = ThreadPoolExecutor(max_workers=1)
+        self.preview_future = None
+        self.preview_cache = OrderedDict()
+        self.preview_token = 0
+
         # Создаем контекстное меню
         self.create_context_menu()
 
         # Привязываем горячие клавиши
         self.bind_hotkeys()
 
-        # Создаем фрейм для кнопок
-        button_frame = tk.Frame(self.editor_frame)
+        # Создаем фрейм для кнопок: он общий для всех вкладок, кнопки действуют на текущий документ
+        button_frame = tk.Frame(root)
         button_frame.pack(fill=tk.X, padx=10, pady=5)
 
         # Кнопки операций
@@ -119,11 +4492,14 @@ class TextEditorApp:
             ("📊 Статистика", self.show_stats),
             ("🗑️ Удалить смайлы", self.remove_emojis),
             ("🔣 QR-код", self.generate_qrcode),
+            ("📦 QR пакетно", self.open_qr_bulk_export),
             ("🔄 Сменить раскладку", self.change_layout),
             ("🌍 Перевести", self.translate_text),
             ("⚙️ Настройки", self.open_settings),
             ("🔄 Конвертер", self.open_file_converter),
-            ("🧮 Калькулятор", self.open_calculator)
+            ("🧮 Калькулятор", self.open_calculator),
+            ("⏱ Диагностика", self.open_diagnostics),
+            ("🧾 JSON", self.open_json_tools)
         ]
 
         # Располагаем кнопки в 4 ряда
@@ -142,97 +4518,64 @@ class TextEditorApp:
             )
             btn.pack(side=tk.LEFT, padx=2, pady=2, fill=tk.X, expand=True)
 
-        # Инициализируем словари для смены раскладки
-        self.init_layout_dicts()
-
         # Создаем вкладки истории и избранного
         self.create_history_favorites_tabs()
 
         # Статусная строка
+        status_frame = tk.Frame(root)
+        status_frame.pack(side=tk.BOTTOM, fill=tk.X)
+
         self.status_var = tk.StringVar()
         status_bar = tk.Label(
-            root,
+            status_frame,
             textvariable=self.status_var,
             bd=1,
             relief=tk.SUNKEN,
             anchor=tk.W
         )
-        status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        status_bar.pack(side=tk.LEFT, fill=tk.X, expand=True)
 
-        # Переменная для отслеживания изменений
-        self.last_history_text = ""
+        # Индикатор режима документа
+        tk.Label(status_frame, textvariable=self.mode_var, bd=1, relief=tk.SUNKEN, padx=5).pack(side=tk.RIGHT)
 
         # Переменные для работы с треем
         self.tray_icon = None
         self.tray_thread = None
         self.tray_active = False
 
+        # Захват выделенного текста и задержки "горячая клавиша -> окно"
+        backend = Win32ClipboardBackend() if win32clipboard else FakeClipboardBackend()
+        self.selection_capture = SelectionCapture(backend)
+        self.hotkey_latencies = deque(maxlen=100)
+
         # Глобальные горячие клавиши
         self.hotkey_enabled = True
         self.hotkey_combination = "ctrl+alt+e"  # Менее конфликтное сочетание
         self.register_global_hotkey()
 
-        # Проверяем наличие ffmpeg
-        self.check_ffmpeg()
-
-        self.update_status("Готов к работе")
+        # Безопасный вычислитель выражений (калькулятор и контекстное меню)
+        self.expression_evaluator = ExpressionEvaluator()
+        self.document_calculator = DocumentCalculator(self.expression_evaluator)
 
-    def create_context_menu(self):
-        """Создаем контекстное меню для текстового поля с новой функцией"""
-        self.context_menu = Menu(self.root, tearoff=0)
-        self.context_menu.add_command(label="Вырезать", command=self.cut_text)
-        self.context_menu.add_command(label="Копировать", command=self.copy_text)
-        self.context_menu.add_command(label="Вставить", command=self.paste_text)
-        self.context_menu.add_separator()
-        self.context_menu.add_command(label="Вычислить выражение", command=self.calculate_selection)
-        self.context_menu.add_command(label="Статистика выделенного", command=self.show_selected_stats)
-        self.context_menu.add_command(label="Удалить все", command=self.clear_text)
+        # Генератор QR-кодов с кэшем и его настройки
+        self.qr_renderer = QRRenderer()
+        self.qr_error_level = "L"
+        self.qr_box_size = 10
 
-        # Привязываем контекстное меню к текстовому полю
-        self.text_area.bind("<Button-3>", self.show_context_menu)
+        # Кэш результатов конвертации и движок конвертации изображений
+        self.conversion_cache = ConversionCache()
+        self.image_converter = ImageConverter(cache=self.conversion_cache)
 
-    def show_context_menu(self, event):
-        """Показываем контекстное меню с учетом выделения"""
-        try:
-            # Очищаем старое меню
-            self.context_menu.delete(0, 'end')
-
-            # Стандартные пункты
-            self.context_menu.add_command(label="Вырезать", command=self.cut_text)
-            self.context_menu.add_command(label="Копировать", command=self.copy_text)
-            self.context_menu.add_command(label="Вставить", command=self.paste_text)
-            self.context_menu.add_separator()
-
-            # Проверяем, есть ли выделенный текст
-            if self.text_area.tag_ranges("sel"):
-                selected_text = self.text_area.get("sel.first", "sel.last")
-
-                # Добавляем пункт с результатом вычисления
-                if self.is_math_expression(selected_text):
-                    try:
-                        # Вычисляем выражение
-                        result = self.calculate_expression(selected_text)
-                        # Добавляем пункт с результатом (не активный)
-                        self.context_menu.add_command(
-                            label=f"Результат: {selected_text} = {result}",
-                            state=tk.DISABLED
-                        )
-                        self.context_menu.add_separator()
-                    except Exception as e:
-                        pass  # Если не вычислилось, просто пропускаем
+        # Проверяем наличие ffmpeg
+        self.check_ffmpeg()
 
-                # Добавляем вычисление и статистику
-                self.context_menu.add_command(label="Вычислить выражение", command=self.calculate_selection)
-                self.context_menu.add_command(label="Статистика выделенного", command=self.show_selected_stats)
-                self.context_menu.add_separator()
+        # Периодическая выгрузка неактивных вкладок
+        self.root.after(self.TAB_UNLOAD_CHECK_MS, self.unload_idle_tabs)
 
-            # Общие пункты
-            self.context_menu.add_command(label="Удалить все", command=self.clear_text)
+        # Лишние записи истории (например, из файла старого формата) уходят в архив
+        self.archive_history()
 
-            # Показываем меню
-            self.context_menu.tk_popup(event.x_root, event.y_root)
-        except Exception as e:
-            print(f"Ошибка при показе контекстного меню: {e}")
+        self.update_status("Готов к работе")
 
     def check_ffmpeg(self):
         """Проверяем наличие ffmpeg в системе"""
@@ -240,67 +4583,15 @@ class TextEditorApp:
             self.update_status("Внимание: ffmpeg не установлен! Конвертация видео/аудио может не работать")
             print("FFmpeg не найден. Установите ffmpeg для работы конвертера.")
 
-    def show_context_menu(self, event):
-        """Показываем контекстное меню с учетом выделения"""
-        try:
-            # Очищаем старое меню
-            self.context_menu.delete(0, 'end')
-
-            # Стандартные пункты
-            self.context_menu.add_command(label="Вырезать", command=self.cut_text)
-            self.context_menu.add_command(label="Копировать", command=self.copy_text)
-            self.context_menu.add_command(label="Вставить", command=self.paste_text)
-            self.context_menu.add_separator()
-
-            # Проверяем, есть ли выделенный текст
-            if self.text_area.tag_ranges("sel"):
-                selected_text = self.text_area.get("sel.first", "sel.last")
-
-                # Добавляем пункт с результатом вычисления
-                if self.is_math_expression(selected_text):
-                    try:
-                        # Вычисляем выражение
-                        result = self.calculate_expression(selected_text)
-                        # Добавляем пункт с результатом (не активный)
-                        self.context_menu.add_command(
-                            label=f"Результат: {selected_text} = {result}",
-                            state=tk.DISABLED
-                        )
-                        self.context_menu.add_separator()
-                    except Exception as e:
-                        pass  # Если не вычислилось, просто пропускаем
-
-                # Добавляем вычисление и статистику
-                self.context_menu.add_command(label="Вычислить выражение", command=self.calculate_selection)
-                self.context_menu.add_command(label="Статистика выделенного", command=self.show_selected_stats)
-                self.context_menu.add_separator()
-
-            # Общие пункты
-            self.context_menu.add_command(label="Удалить все", command=self.clear_text)
-
-            # Показываем меню
-            self.context_menu.tk_popup(event.x_root, event.y_root)
-        except Exception as e:
-            print(f"Ошибка при показе контекстного меню: {e}")
-
     def is_math_expression(self, text):
-        """Проверяем, является ли текст математическим выражением"""
-        # Удаляем пробелы для упрощения проверки
-        clean_text = text.replace(" ", "")
-
-        # Проверяем наличие математических операторов
-        operators = ['+', '-', '*', '/', '^', '%', '(', ')']
-        if any(op in clean_text for op in operators):
-            # Проверяем, что остальные символы допустимы
-            allowed_chars = "0123456789.+-*/^%()eπ"
-            return all(c in allowed_chars for c in clean_text)
-        return False
+        """Проверяем, является ли текст математическим выражением (разбор кэшируется)"""
+        return self.expression_evaluator.is_expression(text)
 
     def calculate_selection(self):
         """Вычисляем математическое выражение в выделенном тексте"""
         try:
             # Получаем выделенный текст
-            selected_text = self.text_area.get("sel.first", "sel.last")
+            selected_text = self.selected_text()
 
             if not selected_text:
                 messagebox.showinfo("Информация", "Нет выделенного текста")
@@ -322,10 +4613,7 @@ class TextEditorApp:
     def calculate_expression(self, expression):
         """Вычисляем математическое выражение"""
         try:
-            # Заменяем символы для вычисления
-            expr = expression.replace('^', '**').replace('π', 'math.pi').replace('%', '/100')
-            # Вычисляем выражение
-            result = eval(expr, {"__builtins__": None}, {"math": math})
+            result = self.expression_evaluator.evaluate(expression)
             return round(result, 4)  # Округляем до 4 знаков после запятой
         except Exception as e:
             raise ValueError(f"Не удалось вычислить выражение: {str(e)}")
@@ -341,6 +4629,7 @@ class TextEditorApp:
         # Переменные
         self.calc_input = tk.StringVar()
         self.calc_history = []
+        self.calc_last_result = 0
 
         # Поле ввода
         input_frame = tk.Frame(calc_win)
@@ -411,11 +4700,9 @@ class TextEditorApp:
             self.calc_input.set(current_text[:-1])
         elif button_text == '=':
             try:
-                # Заменяем символы для вычисления
-                expression = current_text.replace('^', '**').replace('π', 'math.pi').replace('%', '/100')
-
-                # Вычисляем выражение
-                result = eval(expression, {"__builtins__": None}, {"math": math})
+                # Вычисляем выражение (ans - результат предыдущего вычисления)
+                result = self.expression_evaluator.evaluate(current_text, {"ans": self.calc_last_result})
+                self.calc_last_result = result
 
                 # Сохраняем в историю
                 history_entry = f"{current_text} = {result}"
@@ -455,15 +4742,36 @@ class TextEditorApp:
             else:
                 print(error_msg)
 
+    def call_in_ui(self, func, *args):
+        """Планируем вызов в потоке Tk (безопасно вызывать из любого потока)"""
+        self.ui_queue.put((func, args))
+
+    def process_ui_queue(self):
+        """Выполняем накопившиеся задачи из других потоков"""
+        try:
+            while True:
+                func, args = self.ui_queue.get_nowait()
+                try:
+                    func(*args)
+                except Exception as e:
+                    print(f"Ошибка при выполнении задачи интерфейса: {e}")
+        except queue.Empty:
+            pass
+        self.root.after(self.UI_QUEUE_POLL_MS, self.process_ui_queue)
+
     def global_hotkey_pressed(self):
-        """Обработчик нажатия глобальной горячей клавиши (без изменения громкости)"""
+        """Обработчик нажатия глобальной горячей клавиши (вызывается из потока keyboard)"""
         if not self.hotkey_enabled:
             return
 
-        try:
-            # Получаем выделенный текст напрямую через Win32 API
-            selected_text = self.get_selected_text()
+        started = time.perf_counter()
+        # Буфер обмена читаем здесь, а с виджетами работаем только в потоке Tk
+        selected_text = self.get_selected_text()
+        self.call_in_ui(self.show_from_hotkey, selected_text, started)
 
+    def show_from_hotkey(self, selected_text, started):
+        """Показываем окно с захваченным текстом и замеряем задержку"""
+        try:
             # Если есть выделенный текст - устанавливаем его
             if selected_text:
                 self.set_text(selected_text)
@@ -473,49 +4781,28 @@ class TextEditorApp:
             self.root.lift()
             self.root.focus_force()
 
-            self.update_status("Активировано горячей клавишей")
+            latency_ms = (time.perf_counter() - started) * 1000
+            self.hotkey_latencies.append(latency_ms)
+            self.update_status(f"Активировано горячей клавишей ({latency_ms:.0f} мс)")
         except Exception as e:
             self.update_status(f"Ошибка горячей клавиши: {str(e)}")
 
+    def handle_instance_message(self, message):
+        """Открываем файл или текст, переданный повторным запуском приложения"""
+        action = message.get("action")
+        if action == "open":
+            self.load_file(message.get("path", ""))
+        elif action == "text":
+            # Открытый документ не затираем: текст идет в пустую вкладку или в новую
+            self.tab_for_new_content()
+            self.set_text(message.get("text", ""))
+            self.update_status("Получен текст от другого запуска")
+        self.restore_from_tray()
+
     def get_selected_text(self):
-        """Получаем выделенный текст с помощью Win32 API (без имитации клавиш)"""
+        """Получаем выделенный текст активного окна через буфер обмена"""
         try:
-            # Сохраняем текущий буфер обмена
-            win32clipboard.OpenClipboard()
-            try:
-                original_clipboard = win32clipboard.GetClipboardData(win32con.CF_UNICODETEXT)
-            except:
-                original_clipboard = ""
-            win32clipboard.CloseClipboard()
-
-            # Копируем выделенный текст в буфер обмена
-            win32clipboard.OpenClipboard()
-            win32clipboard.EmptyClipboard()
-
-            # Получаем активное окно
-            hwnd = win32gui.GetForegroundWindow()
-
-            # Отправляем сообщение о копировании
-            win32gui.SendMessage(hwnd, win32con.WM_COPY, 0, 0)
-
-            # Даем время на обработку
-            time.sleep(0.1)
-
-            # Получаем текст из буфера обмена
-            try:
-                selected_text = win32clipboard.GetClipboardData(win32con.CF_UNICODETEXT)
-            except:
-                selected_text = ""
-
-            win32clipboard.CloseClipboard()
-
-            # Восстанавливаем оригинальный буфер обмена
-            win32clipboard.OpenClipboard()
-            win32clipboard.EmptyClipboard()
-            win32clipboard.SetClipboardText(original_clipboard, win32con.CF_UNICODETEXT)
-            win32clipboard.CloseClipboard()
-
-            return selected_text
+            return self.selection_capture.capture()
         except Exception as e:
             print(f"Ошибка при получении выделенного текста: {e}")
             return ""
@@ -523,14 +4810,18 @@ class TextEditorApp:
     def on_text_modified(self, event):
         """Обработчик изменения текста"""
         if self.text_area.edit_modified():
-            current_text = self.get_text()
-            if current_text != self.last_history_text:
-                self.add_to_history(current_text)
-                self.last_history_text = current_text
+            # В режиме большого документа история пишется только по контрольным точкам
+            if not self.large_document:
+                current_text = self.get_text()
+                if current_text != self.last_history_text:
+                    self.add_to_history(current_text)
+                    self.last_history_text = current_text
             self.text_area.edit_modified(False)
 
     def on_focus_out(self, event):
         """Обработчик потери фокуса"""
+        if self.large_document:
+            return
         current_text = self.get_text()
         if current_text != self.last_history_text:
             self.add_to_history(current_text)
@@ -538,25 +4829,57 @@ class TextEditorApp:
 
     # Методы для работы с данными
     def load_data(self, filename, max_items=None):
-        """Загружаем данные из JSON-файла"""
+        """Загружаем данные из JSON-файла; нечитаемый файл попадает в load_failed, возвращается []"""
         data = []
         if os.path.exists(filename):
             try:
                 with open(filename, "r", encoding="utf-8") as f:
                     data = json.load(f)
+                    self.instrumentation.count_io(read=os.path.getsize(filename))
                     if max_items and len(data) > max_items:
                         data = data[-max_items:]
-            except:
-                pass
+            except (OSError, ValueError, TypeError) as e:
+                print(f"Не удалось прочитать {filename}: {e}")
+                self.load_failed.append(filename)
+                data = []
+                # Следующее сохранение перезапишет файл - оставляем копию для восстановления
+                with contextlib.suppress(OSError):
+                    shutil.copyfile(filename, filename + ".broken")
         return data
 
+    def load_entries(self, filename, max_items=None):
+        """Загружаем записи истории/избранного, переводя старый формат с текстом внутри на хэши"""
+        entries = self.load_data(filename, max_items)
+        migrated = False
+        for item in entries:
+            if "text" in item:
+                item["hash"] = self.blob_store.add(item.pop("text"))
+                migrated = True
+            else:
+                self.blob_store.retain(item["hash"])
+        if migrated:
+            self.save_data(filename, entries)
+        return entries
+
+    def entry_text(self, item):
+        """Текст записи истории/избранного"""
+        return self.blob_store.get(item['hash'])
+
+    def entry_preview(self, item):
+        """Строка для списка истории/избранного (у новых записей превью хранится в самой записи)"""
+        preview = item.get("preview")
+        if preview is None:
+            preview = HistoryArchive.make_preview(self.entry_text(item))
+        return f"{item['timestamp']}: {preview}"
+
     def save_data(self, filename, data):
-        """Сохраняем данные в JSON-файл"""
-        try:
-            with open(filename, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось сохранить данные: {str(e)}")
+        """Сохраняем данные в JSON-файл (в фоне, повторные записи склеиваются)"""
+        self.persistence.write_json(filename, data)
+
+    def report_write_error(self, path, error):
+        """Ошибка фоновой записи: сообщаем в строке состояния, не прерывая работу"""
+        print(f"Не удалось записать {path}: {error}")
+        self.call_in_ui(self.update_status, f"Ошибка записи {path}: {error}")
 
     # Методы для работы с горячими клавишами
     def load_hotkeys(self):
@@ -589,11 +4912,34 @@ class TextEditorApp:
 
     def save_hotkeys(self):
         """Сохраняем настройки горячих клавиш в файл"""
-        try:
-            with open("hotkeys.json", "w", encoding="utf-8") as f:
-                json.dump(self.hotkeys, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось сохранить настройки: {str(e)}")
+        self.persistence.write_json("hotkeys.json", self.hotkeys)
+
+    def load_editor_settings(self):
+        """Загружаем настройки редактора (пороги режима большого документа)"""
+        settings = {
+            "large_document_chars": self.LARGE_DOCUMENT_CHARS,
+            "large_document_exit_chars": self.LARGE_DOCUMENT_EXIT_CHARS,
+            "long_line_chars": LineSplitter.MAX_LINE,
+            "line_segment_chars": LineSplitter.SEGMENT,
+            "tab_unload_seconds": self.TAB_UNLOAD_SECONDS,
+            "tab_unload_min_chars": self.TAB_UNLOAD_MIN_CHARS,
+            # Сервер перевода с API LibreTranslate; пусто - перевод в браузере
+            "translation_url": "",
+            "translation_api_key": "",
+            "translation_source": "auto",
+            "translation_target": "en",
+        }
+        if os.path.exists("settings.json"):
+            try:
+                with open("settings.json", "r", encoding="utf-8") as f:
+                    settings.update(json.load(f))
+            except:
+                pass
+        return settings
+
+    def save_editor_settings(self):
+        """Сохраняем настройки редактора в файл"""
+        self.persistence.write_json("settings.json", self.editor_settings)
 
     def bind_hotkeys(self):
         """Привязываем горячие клавиши к функциям"""
@@ -609,6 +4955,8 @@ class TextEditorApp:
         self.root.bind("<F10>", lambda e: self.change_layout())
         self.root.bind("<F11>", lambda e: self.translate_text())
         self.root.bind("<F12>", lambda e: self.minimize_to_tray())
+        self.root.bind("<Control-n>", lambda e: self.new_tab())
+        self.root.bind("<Control-w>", lambda e: self.close_tab())
 
     # Методы интерфейса
     def create_context_menu(self):
@@ -620,12 +4968,10 @@ class TextEditorApp:
         self.context_menu.add_separator()
         self.context_menu.add_command(label="Вычислить выражение", command=self.calculate_selection)
         self.context_menu.add_command(label="Статистика выделенного", command=self.show_selected_stats)
+        self.context_menu.add_command(label="Вычислить все выражения", command=self.evaluate_all_expressions)
+        self.context_menu.add_command(label="Итоги по числам", command=self.show_number_totals)
         self.context_menu.add_command(label="Удалить все", command=self.clear_text)
 
-        # Привязываем контекстное меню к текстовому полю
-        self.text_area.bind("<Button-3>", self.show_context_menu)
-
-
     def show_context_menu(self, event):
         """Показываем контекстное меню с учетом выделения"""
         try:
@@ -640,21 +4986,10 @@ class TextEditorApp:
 
             # Проверяем, есть ли выделенный текст
             if self.text_area.tag_ranges("sel"):
-                selected_text = self.text_area.get("sel.first", "sel.last")
-
-                # Добавляем пункт с результатом вычисления
-                if self.is_math_expression(selected_text):
-                    try:
-                        # Вычисляем выражение
-                        result = self.calculate_expression(selected_text)
-                        # Добавляем пункт с результатом (не активный)
-                        self.context_menu.add_command(
-                            label=f"Результат: {selected_text} = {result}",
-                            state=tk.DISABLED
-                        )
-                        self.context_menu.add_separator()
-                    except Exception as e:
-                        pass  # Если не вычислилось, просто пропускаем
+                # Пункт с результатом: из кэша сразу или заглушка, которую заполнит фоновое вычисление
+                # (в режиме большого документа предпросмотр пропускаем)
+                if not self.large_document:
+                    self.add_preview_item()
 
                 # Добавляем вычисление и статистику
                 self.context_menu.add_command(label="Вычислить выражение", command=self.calculate_selection)
@@ -662,6 +4997,10 @@ class TextEditorApp:
                 self.context_menu.add_separator()
 
             # Общие пункты
+            self.context_menu.add_command(label="Вычислить все выражения", command=self.evaluate_all_expressions)
+            self.context_menu.add_command(label="Итоги по числам", command=self.show_number_totals)
+            if self.large_document:
+                self.context_menu.add_command(label="Сохранить контрольную точку", command=self.add_checkpoint)
             self.context_menu.add_command(label="Удалить все", command=self.clear_text)
 
             # Показываем меню
@@ -669,11 +5008,158 @@ class TextEditorApp:
         except Exception as e:
             print(f"Ошибка при показе контекстного меню: {e}")
 
+    def add_preview_item(self):
+        """Добавляем в меню результат вычисления выделения, не вычисляя его в потоке Tk"""
+        self.preview_token += 1
+
+        # Длинное выделение заведомо не выражение - даже не копируем его из виджета
+        length = self.text_area.count("sel.first", "sel.last", "chars")
+        if not length or length[0] > ExpressionEvaluator.MAX_LENGTH:
+            return
+        selected_text = self.selected_text()
+        if not (self.PREVIEW_OPERAND.search(selected_text) and self.PREVIEW_OPERATOR.search(selected_text)):
+            return
+
+        key = hashlib.sha1(selected_text.encode("utf-8")).hexdigest()
+        if key in self.preview_cache:
+            self.preview_cache.move_to_end(key)
+            label = self.preview_cache[key]
+            if label:
+                self.context_menu.add_command(label=label, state=tk.DISABLED)
+                self.context_menu.add_separator()
+            return
+
+        index = self.context_menu.index(tk.END) + 1
+        self.context_menu.add_command(label="Результат: вычисляется...", state=tk.DISABLED)
+        self.context_menu.add_separator()
+
+        # Прошлое вычисление еще идет - новое не должно ждать его в очереди
+        if self.preview_future is not None and not self.preview_future.done():
+            self.replace_preview_executor()
+        future = self.preview_future = self.preview_executor.submit(self.compute_preview, selected_text)
+        deadline = time.perf_counter() + self.PREVIEW_TIMEOUT_MS / 1000
+        self.root.after(self.PREVIEW_POLL_MS, self.poll_preview, self.preview_token, future, key, index, deadline)
+
+    def replace_preview_executor(self):
+        """Заменяем занятый поток предпросмотра: прервать вычисление нельзя, старый поток доработает сам"""
+        self.preview_executor.shutdown(wait=False, cancel_futures=True)
+        self.preview_executor = ThreadPoolExecutor(max_workers=1)
+
+    def cache_preview(self, key, label):
+        self.preview_cache[key] = label
+        if len(self.preview_cache) > self.PREVIEW_CACHE_SIZE:
+            self.preview_cache.popitem(last=False)
+
+    def compute_preview(self, selected_text):
+        """Вычисляем подпись с результатом (выполняется в фоновом потоке)"""
+        if not self.is_math_expression(selected_text):
+            return None
+        try:
+            result = self.calculate_expression(selected_text)
+        except ValueError:
+            return None
+        shown = selected_text if len(selected_text) <= 40 else selected_text[:40] + "..."
+        return f"Результат: {shown} = {result}"
+
+    def poll_preview(self, token, future, key, index, deadline):
+        """Подставляем готовый результат в уже открытое меню"""
+        if token != self.preview_token:
+            return  # меню уже открыто заново для другого выделения
+
+        if not future.done():
+            if time.perf_counter() < deadline:
+                self.root.after(self.PREVIEW_POLL_MS, self.poll_preview, token, future, key, index, deadline)
+            else:
+                # Запоминаем, чтобы не запускать то же выражение снова, и освобождаем очередь
+                label = "Результат: слишком долгое вычисление"
+                self.cache_preview(key, label)
+                self.replace_preview_executor()
+                try:
+                    self.context_menu.entryconfigure(index, label=label)
+                except tk.TclError:
+                    pass
+            return
+
+        label = future.result()
+        self.cache_preview(key, label)
+
+        try:
+            if label:
+                self.context_menu.entryconfigure(index, label=label)
+            else:
+                self.context_menu.delete(index, index + 1)
+        except tk.TclError:
+            pass  # меню успели перестроить
+
+    def evaluate_all_expressions(self):
+        """Вычисляем все выражения вида "12*4.5 =" в документе за один проход"""
+        text = self.get_text()
+        new_text, evaluated, errors = self.document_calculator.evaluate_all(text)
+
+        if evaluated:
+            # Все результаты вставляются одной правкой
+            self.set_text(new_text)
+        message = f"Вычислено выражений: {evaluated}"
+        if errors:
+            message += f", с ошибкой: {errors}"
+        self.update_status(message)
+
+    def show_number_totals(self):
+        """Показываем сумму, среднее, минимум, максимум и медиану по числам выделения или документа"""
+        if self.text_area.tag_ranges("sel"):
+            text = self.selected_text()
+            scope = "выделения"
+        else:
+            text = self.get_text()
+            scope = "документа"
+
+        column = simpledialog.askstring(
+            "Итоги по числам",
+            "Номер столбца (пусто - все числа):",
+            parent=self.root
+        )
+        if column is None:
+            return
+        column = column.strip()
+        if column and (not column.isdigit() or int(column) < 1):
+            messagebox.showerror("Ошибка", "Номер столбца должен быть положительным числом")
+            return
+
+        totals = self.document_calculator.aggregate(text, int(column) if column else None)
+        if not totals:
+            messagebox.showinfo("Информация", "Числа не найдены")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title(f"Итоги по числам {scope}")
+        dialog.geometry("300x260")
+
+        fmt = DocumentCalculator.format_number
+        stats = [
+            f"Количество: {totals['count']}",
+            f"Сумма: {fmt(totals['sum'])}",
+            f"Среднее: {fmt(totals['avg'])}",
+            f"Минимум: {fmt(totals['min'])}",
+            f"Максимум: {fmt(totals['max'])}",
+            f"Медиана: {fmt(totals['median'])}"
+        ]
+
+        for stat in stats:
+            tk.Label(dialog, text=stat, anchor=tk.W).pack(fill=tk.X, padx=20, pady=3)
+
+        tk.Button(
+            dialog,
+            text="Копировать сумму",
+            command=lambda: pyperclip.copy(fmt(totals["sum"]))
+        ).pack(pady=(10, 0))
+        tk.Button(dialog, text="Закрыть", command=dialog.destroy).pack(pady=5)
+        self.update_status(f"Итоги по {totals['count']} числам")
+
     def show_selected_stats(self):
         """Показываем статистику выделенного текста"""
         try:
             # Получаем выделенный текст
-            selected_text = self.text_area.get("sel.first", "sel.last")
+            selected_text = self.selected_text()
 
             if not selected_text:
                 messagebox.showinfo("Информация", "Нет выделенного текста")
@@ -713,7 +5199,7 @@ class TextEditorApp:
         """Открываем окно конвертера файлов"""
         converter_win = tk.Toplevel(self.root)
         converter_win.title("Конвертер файлов")
-        converter_win.geometry("600x400")
+        converter_win.geometry("600x520")
         converter_win.grab_set()
 
         # Основной фрейм
@@ -728,6 +5214,7 @@ class TextEditorApp:
             ("Видео в аудио", "video_to_audio"),
             ("Изображение в PNG", "image_to_png"),
             ("Изображение в JPG", "image_to_jpg"),
+            ("Изображение в WebP", "image_to_webp"),
             ("Аудио в MP3", "audio_to_mp3")
         ]
 
@@ -771,19 +5258,45 @@ class TextEditorApp:
             row=5, column=1, sticky=tk.EW, padx=5, pady=2
         )
 
+        # Параметры изображений
+        image_frame = ttk.LabelFrame(main_frame, text="Параметры изображений")
+        image_frame.grid(row=6, column=0, columnspan=3, sticky=tk.EW, pady=10)
+
+        ttk.Label(image_frame, text="Макс. размер (px):").pack(side=tk.LEFT, padx=5, pady=5)
+        self.image_max_size = tk.StringVar(value="")
+        ttk.Entry(image_frame, textvariable=self.image_max_size, width=8).pack(side=tk.LEFT, padx=5)
+
+        ttk.Label(image_frame, text="Качество:").pack(side=tk.LEFT, padx=5)
+        self.image_quality = tk.IntVar(value=self.image_converter.quality)
+        ttk.Spinbox(image_frame, from_=1, to=100, textvariable=self.image_quality, width=5).pack(
+            side=tk.LEFT, padx=5
+        )
+
         # Статус конвертации
         self.convert_status = tk.StringVar(value="Готов к конвертации")
         ttk.Label(main_frame, textvariable=self.convert_status).grid(
-            row=6, column=0, columnspan=3, pady=10
+            row=7, column=0, columnspan=3, pady=10
+        )
+
+        # Состояние кэша конвертации
+        self.cache_status = tk.StringVar(value=self.conversion_cache.format_stats())
+        ttk.Label(main_frame, textvariable=self.cache_status).grid(
+            row=8, column=0, columnspan=3
         )
 
         # Кнопки
         btn_frame = ttk.Frame(main_frame)
-        btn_frame.grid(row=7, column=0, columnspan=3, pady=10)
+        btn_frame.grid(row=9, column=0, columnspan=3, pady=10)
 
         ttk.Button(btn_frame, text="Конвертировать", command=self.convert_file).pack(
             side=tk.LEFT, padx=10
         )
+        ttk.Button(btn_frame, text="Пакетно (изображения)...", command=self.convert_images_batch).pack(
+            side=tk.LEFT, padx=10
+        )
+        ttk.Button(btn_frame, text="Очистить кэш", command=self.clear_conversion_cache).pack(
+            side=tk.LEFT, padx=10
+        )
         ttk.Button(btn_frame, text="Закрыть", command=converter_win.destroy).pack(
             side=tk.LEFT, padx=10
         )
@@ -791,6 +5304,12 @@ class TextEditorApp:
         # Настройка сетки
         main_frame.columnconfigure(1, weight=1)
 
+    def clear_conversion_cache(self):
+        """Очищаем кэш результатов конвертации"""
+        self.conversion_cache.clear()
+        self.cache_status.set(self.conversion_cache.format_stats())
+        self.update_status("Кэш конвертации очищен")
+
     def browse_file(self, target_var):
         """Открываем диалог выбора файла"""
         file_path = filedialog.askopenfilename()
@@ -827,6 +5346,7 @@ class TextEditorApp:
                 "video_to_audio": ".mp3",
                 "image_to_png": ".png",
                 "image_to_jpg": ".jpg",
+                "image_to_webp": ".webp",
                 "audio_to_mp3": ".mp3"
             }
 
@@ -834,14 +5354,23 @@ class TextEditorApp:
             output_path = os.path.join(dest_folder, f"{output_name}{output_ext}")
 
             # Выполняем конвертацию в зависимости от типа
+            from_cache = False
             if conversion_type == "video_to_audio":
-                self.convert_video_to_audio(source, output_path)
+                from_cache = self.conversion_cache.run(
+                    source, output_path, conversion_type, {}, self.convert_video_to_audio
+                )
             elif conversion_type.startswith("image_to_"):
-                self.convert_image(source, output_path)
+                # Изображения конвертируются в фоне, результат придет через run_image_conversion
+                self.run_image_conversion([(source, output_path)])
+                return
             elif conversion_type == "audio_to_mp3":
-                self.convert_audio_to_mp3(source, output_path)
+                from_cache = self.conversion_cache.run(
+                    source, output_path, conversion_type, {}, self.convert_audio_to_mp3
+                )
 
-            self.convert_status.set(f"Конвертация завершена: {os.path.basename(output_path)}")
+            suffix = " (из кэша)" if from_cache else ""
+            self.convert_status.set(f"Конвертация завершена{suffix}: {os.path.basename(output_path)}")
+            self.cache_status.set(self.conversion_cache.format_stats())
             messagebox.showinfo("Успех", f"Файл успешно сконвертирован:\n{output_path}")
 
         except Exception as e:
@@ -852,7 +5381,8 @@ class TextEditorApp:
     def convert_video_to_audio(self, input_path, output_path):
         """Конвертируем видео в аудио (MP3)"""
         try:
-            # Используем moviepy для конвертации
+            # Используем moviepy для конвертации (импортируем лениво: он грузится долго)
+            from moviepy.editor import VideoFileClip
             video = VideoFileClip(input_path)
             audio = video.audio
             audio.write_audiofile(output_path, verbose=False, logger=None)
@@ -874,24 +5404,95 @@ class TextEditorApp:
             except Exception as fallback_error:
                 raise Exception(f"Ошибка при конвертации видео: {fallback_error}")
 
-    def convert_image(self, input_path, output_path):
-        """Конвертируем изображения между форматами"""
+    def get_image_options(self):
+        """Читаем параметры конвертации изображений из окна конвертера"""
+        max_size = self.image_max_size.get().strip()
+        max_size = int(max_size) if max_size else None
+        if max_size is not None and max_size <= 0:
+            max_size = None
+
+        quality = max(1, min(100, int(self.image_quality.get())))
+        return max_size, quality
+
+    def convert_images_batch(self):
+        """Пакетная конвертация нескольких изображений в папку назначения"""
+        conversion_type = self.conversion_type.get()
+        if not conversion_type.startswith("image_to_"):
+            messagebox.showerror("Ошибка", "Выберите тип конвертации изображения")
+            return
+
+        dest_folder = self.dest_folder.get()
+        if not dest_folder or not os.path.exists(dest_folder):
+            messagebox.showerror("Ошибка", "Пожалуйста, выберите папку назначения")
+            return
+
+        sources = filedialog.askopenfilenames(
+            filetypes=[
+                ("Изображения", "*.png *.jpg *.jpeg *.webp *.bmp *.gif *.tif *.tiff"),
+                ("Все файлы", "*.*")
+            ]
+        )
+        if not sources:
+            return
+
+        output_ext = "." + conversion_type[len("image_to_"):]
+        jobs = []
+        for source in sources:
+            name = os.path.splitext(os.path.basename(source))[0]
+            output_path = os.path.join(dest_folder, f"{name}{output_ext}")
+            # Не перезаписываем исходный файл
+            if os.path.abspath(output_path) == os.path.abspath(source):
+                output_path = os.path.join(dest_folder, f"{name}_converted{output_ext}")
+            jobs.append((source, output_path))
+
+        self.run_image_conversion(jobs)
+
+    def run_image_conversion(self, jobs):
+        """Запускаем конвертацию изображений в фоновом потоке, не блокируя интерфейс"""
         try:
-            img = Image.open(input_path)
+            max_size, quality = self.get_image_options()
+        except (ValueError, tk.TclError):
+            messagebox.showerror("Ошибка", "Некорректные параметры изображения")
+            return
 
-            # Конвертируем в RGB для JPG
-            if output_path.lower().endswith(('.jpg', '.jpeg')):
-                if img.mode in ("RGBA", "P"):
-                    img = img.convert("RGB")
+        progress = {"done": 0, "total": len(jobs), "result": None}
 
-            img.save(output_path)
-        except Exception as e:
-            raise Exception(f"Ошибка при конвертации изображения: {str(e)}")
+        def on_progress(done, total):
+            progress["done"] = done
+
+        def worker():
+            progress["result"] = self.image_converter.convert_batch(
+                jobs, max_size=max_size, quality=quality, progress_callback=on_progress
+            )
+
+        def poll():
+            result = progress["result"]
+            if result is None:
+                self.convert_status.set(f"Конвертация... {progress['done']}/{progress['total']}")
+                self.root.after(100, poll)
+                return
+
+            summary = ImageConverter.format_stats(result)
+            self.convert_status.set(summary)
+            self.cache_status.set(self.conversion_cache.format_stats())
+            self.update_status(summary)
+            if result["failed"]:
+                errors = "\n".join(f"{os.path.basename(src)}: {err}" for src, err in result["failed"][:10])
+                messagebox.showerror("Ошибка", f"Не удалось сконвертировать:\n{errors}")
+            elif len(jobs) == 1:
+                messagebox.showinfo("Успех", f"Файл успешно сконвертирован:\n{jobs[0][1]}")
+            else:
+                messagebox.showinfo("Успех", summary)
+
+        self.convert_status.set("Конвертация...")
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(100, poll)
 
     def convert_audio_to_mp3(self, input_path, output_path):
         """Конвертируем аудио в MP3"""
         try:
-            # Используем pydub для конвертации
+            # Используем pydub для конвертации (импортируем лениво)
+            from pydub import AudioSegment
             audio = AudioSegment.from_file(input_path)
             audio.export(output_path, format="mp3")
         except Exception as e:
@@ -926,15 +5527,198 @@ class TextEditorApp:
         self.text_area.delete("1.0", tk.END)
 
     # Методы для работы с текстом
+    def on_text_change(self, kind, start, end, text):
+        """Повторяем правку виджета в модели документа"""
+        if kind == "insert":
+            self.document.insert(self.document.offset_of(start, self.tk_wide_chars), text)
+        elif kind == "delete":
+            self.document.delete(self.document.offset_of(start, self.tk_wide_chars), len(text))
+        else:
+            self.document.reset(self.text_area.get("1.0", "end-1c"))
+        if not self.current_tab.dirty:
+            self.current_tab.dirty = True
+            self.update_tab_title(self.current_tab)
+        self.check_document_mode()
+
+    def wants_large_document(self):
+        """Нужен ли режим большого документа (с гистерезисом между порогами)"""
+        key = "large_document_exit_chars" if self.large_document else "large_document_chars"
+        return len(self.document) >= self.editor_settings[key]
+
+    def check_document_mode(self):
+        """Планируем смену режима, если документ пересек порог"""
+        if self.wants_large_document() != self.large_document and not self.document_mode_pending:
+            # Виджет сейчас внутри правки - перенастраиваем его после нее
+            self.document_mode_pending = True
+            self.root.after_idle(self.apply_document_mode)
+
+    def apply_document_mode(self):
+        """Включаем или выключаем режим большого документа"""
+        self.document_mode_pending = False
+        large = self.wants_large_document()
+        if large == self.large_document:
+            return
+
+        self.large_document = large
+        if large:
+            self.text_area.configure(wrap=tk.NONE)
+            self.x_scrollbar.pack(side=tk.BOTTOM, fill=tk.X, before=self.text_area)
+            self.update_mode_indicator()
+            self.update_status("Большой документ: перенос строк и автосохранение в историю отключены")
+        else:
+            self.text_area.configure(wrap=tk.WORD)
+            self.x_scrollbar.pack_forget()
+            self.update_mode_indicator()
+            self.last_history_text = ""
+            self.update_status("Обычный режим документа")
+
+    def update_mode_indicator(self):
+        """Показываем режим документа и разбивку длинных строк в строке состояния"""
+        if self.large_document:
+            mode = f"Большой документ ({len(self.document) // 1000} тыс. симв.)"
+        else:
+            mode = "Обычный режим"
+        if self.text_area.tag_nextrange(VIRTUAL_BREAK_TAG, "1.0"):
+            mode += " | длинные строки разбиты"
+        self.mode_var.set(mode)
+
+    def run_task(self, func, callback, *args):
+        """Выполняем func(*args): в режиме большого документа в фоне, callback - в потоке Tk"""
+        if not self.large_document:
+            callback(func(*args))
+            return
+        self.update_status("Выполняется в фоне...")
+        future = self.background_executor.submit(func, *args)
+        future.add_done_callback(lambda done: self.call_in_ui(self.finish_task, done, callback))
+
+    def finish_task(self, future, callback):
+        """Передаем результат фоновой операции в callback"""
+        try:
+            result = future.result()
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Фоновая операция завершилась с ошибкой: {str(e)}")
+            self.update_status(f"Ошибка фоновой операции: {str(e)}")
+            return
+        callback(result)
+
+    def add_checkpoint(self):
+        """Сохраняем текущий текст в историю (режим большого документа)"""
+        current_text = self.get_text()
+        if current_text != self.last_history_text:
+            self.add_to_history(current_text)
+            self.last_history_text = current_text
+        self.update_status("Контрольная точка сохранена в историю")
+
     def get_text(self):
-        """Получаем текст из текстового поля"""
-        return self.text_area.get("1.0", tk.END).strip()
+        """Получаем текст из модели документа (без копирования буфера Tk)"""
+        return self.true_text().strip()
+
+    def true_text(self, tab=None):
+        """Настоящий текст документа без виртуальных переносов (собирается раз на версию)"""
+        document = (tab or self.current_tab).document
+        if self.true_text_version != document.version:
+            self.true_text_cache = LineSplitter.join(document.text(), self.break_offsets_now(tab))
+            self.true_text_version = document.version
+        return self.true_text_cache
+
+    def break_offsets_now(self, tab=None):
+        """Смещения виртуальных переносов в тексте виджета (версии документов уникальны между вкладками)"""
+        tab = tab or self.current_tab
+        if self.break_version != tab.document.version:
+            ranges = tab.text_area.tag_ranges(VIRTUAL_BREAK_TAG)
+            numbers = [int(str(index).split(".")[0]) - 1 for index in ranges[::2]]
+            self.break_offsets = newline_offsets(tab.document.text(), numbers)
+            self.break_positions = LineSplitter.break_positions(self.break_offsets)
+            self.break_version = tab.document.version
+        return self.break_offsets
+
+    def break_positions_now(self):
+        """Позиции виртуальных переносов в настоящем тексте для текущей версии документа"""
+        self.break_offsets_now()
+        return self.break_positions
+
+    def true_index(self, offset, end=False):
+        """Индекс Tk для смещения в настоящем тексте"""
+        display_offset = LineSplitter.to_display(self.break_positions_now(), offset, end)
+        return self.text_index(self.document.text(), display_offset)
+
+    def selected_text(self):
+        """Выделенный текст без виртуальных переносов"""
+        raw = self.text_area.get("sel.first", "sel.last")
+        return LineSplitter.join(raw, self.undo_manager.tagged_offsets("sel.first", "sel.last", raw))
+
+    def copy_selection(self, event=None, cut=False):
+        """Копирование/вырезание: в буфер обмена попадает настоящий текст"""
+        if not self.text_area.tag_ranges("sel"):
+            return None
+        raw = self.text_area.get("sel.first", "sel.last")
+        breaks = self.undo_manager.tagged_offsets("sel.first", "sel.last", raw)
+        if not breaks:
+            return None  # стандартная обработка Tk
+        self.root.clipboard_clear()
+        self.root.clipboard_append(LineSplitter.join(raw, breaks))
+        if cut:
+            self.text_area.delete("sel.first", "sel.last")
+        return "break"
+
+    def text_index(self, text, offset):
+        """Индекс Tk для смещения в строке text (эмодзи в Tk 8.6 занимают две позиции)"""
+        if self.tk_wide_chars:
+            offset += len(NON_BMP_PATTERN.findall(text, 0, offset))
+        return f"1.0 + {offset} chars"
 
     def set_text(self, text):
-        """Устанавливаем текст в текстовое поле"""
-        self.text_area.delete("1.0", tk.END)
-        self.text_area.insert("1.0", text)
-        self.add_to_history(text)
+        """Устанавливаем текст в текстовое поле, заменяя только изменившийся фрагмент"""
+        current = self.document.text()
+        current_breaks = self.break_offsets_now()
+        # В виджет идет текст с разбитыми длинными строками, в историю - настоящий
+        display, breaks = self.line_splitter.split(text)
+        prefix, suffix = common_affix_lengths(current, display)
+
+        # Общие начало и конец не должны захватывать перевод строки, который в одном тексте
+        # виртуальный, а в другом настоящий
+        for old, new in itertools.zip_longest(current_breaks, breaks, fillvalue=len(current) + len(display)):
+            if old != new or old >= prefix:
+                prefix = min(prefix, old, new)
+                break
+        for old, new in itertools.zip_longest(reversed(current_breaks), reversed(breaks), fillvalue=-1):
+            old_distance, new_distance = len(current) - old, len(display) - new
+            if old_distance != new_distance or old_distance > suffix:
+                suffix = max(0, min(suffix, old_distance - 1, new_distance - 1))
+                break
+
+        start = self.text_index(current, prefix)
+        end = self.text_index(current, len(current) - suffix)
+
+        # Для отмены в журнал попадает только измененная середина, одним действием
+        with self.undo_manager.action():
+            if prefix < len(current) - suffix:
+                self.text_area.delete(start, end)
+            middle_end = len(display) - suffix
+            if prefix < middle_end:
+                offsets = [offset - prefix for offset in breaks if prefix <= offset < middle_end]
+                self.text_area.insert(start, *tagged_insert_args(display[prefix:middle_end], offsets,
+                                                                 VIRTUAL_BREAK_TAG))
+        self.update_mode_indicator()
+        # В режиме большого документа полный снимок в историю - только по контрольной точке
+        if not self.large_document:
+            self.add_to_history(text)
+
+    def undo(self, event=None):
+        """Отменяем последнее действие (Ctrl+Z)"""
+        if self.undo_manager.undo():
+            self.update_status("Действие отменено")
+        else:
+            self.update_status("Нечего отменять")
+        return "break"
+
+    def redo(self, event=None):
+        """Повторяем отмененное действие (Ctrl+Y)"""
+        if self.undo_manager.redo():
+            self.update_status("Действие повторено")
+        else:
+            self.update_status("Нечего повторять")
+        return "break"
 
     def paste_from_clipboard(self):
         """Вставляем текст из буфера обмена"""
@@ -962,12 +5746,7 @@ class TextEditorApp:
         if not words:
             return
 
-        text = self.get_text()
-        for word in words.split(','):
-            cleaned_word = word.strip()
-            if cleaned_word:
-                text = text.replace(cleaned_word, '')
-        self.set_text(text)
+        self.set_text(delete_words_text(self.get_text(), words))
         self.update_status("Слова удалены")
 
     def delete_letters(self):
@@ -996,16 +5775,12 @@ class TextEditorApp:
 
     def remove_all_digits(self):
         """Удаляем все цифры"""
-        text = self.get_text()
-        text = ''.join(c for c in text if not c.isdigit())
-        self.set_text(text)
+        self.set_text(remove_digits_text(self.get_text()))
         self.update_status("Все цифры удалены")
 
     def remove_all_letters(self):
         """Удаляем все буквы"""
-        text = self.get_text()
-        text = ''.join(c for c in text if not c.isalpha())
-        self.set_text(text)
+        self.set_text(remove_letters_text(self.get_text()))
         self.update_status("Все буквы удалены")
 
     def to_uppercase(self):
@@ -1020,48 +5795,75 @@ class TextEditorApp:
         self.set_text(text.lower())
         self.update_status("Текст преобразован в нижний регистр")
 
-    def init_layout_dicts(self):
-        """Инициализируем словари для смены раскладки"""
-        en_lower = "qwertyuiop[]asdfghjkl;'zxcvbnm,."
-        ru_lower = "йцукенгшщзхъфывапролджэячсмитьбю"
-        en_upper = "QWERTYUIOP{}ASDFGHJKL:\"ZXCVBNM<>"
-        ru_upper = "ЙЦУКЕНГШЩЗХЪФЫВАПРОЛДЖЭЯЧСМИТЬБЮ"
-
-        # Создаем словари для преобразования
-        self.en_to_ru = dict(zip(en_lower + en_upper, ru_lower + ru_upper))
-        self.ru_to_en = dict(zip(ru_lower + ru_upper, en_lower + en_upper))
-
     def change_layout(self):
         """Меняем раскладку текста"""
-        text = self.get_text()
-        converted = []
-        for char in text:
-            if char in self.en_to_ru:
-                converted.append(self.en_to_ru[char])
-            elif char in self.ru_to_en:
-                converted.append(self.ru_to_en[char])
-            else:
-                converted.append(char)
-        self.set_text(''.join(converted))
+        self.set_text(change_layout_text(self.get_text()))
         self.update_status("Раскладка изменена")
 
     def translate_text(self):
-        """Открываем перевод текста в Google Translate"""
+        """Переводим текст через сервер перевода в фоне; без сервера - открываем Google Translate"""
         text = self.get_text()
-        if text:
-            # Формируем URL для Google Translate
-            url = f"https://translate.google.com/?sl=auto&tl=en&text={text}"
-            webbrowser.open(url)
-            self.update_status("Открыт переводчик Google")
-        else:
+        if not text:
             messagebox.showwarning("Предупреждение", "Нет текста для перевода")
             self.update_status("Нет текста для перевода")
+            return
+
+        settings = self.editor_settings
+        source, target = settings["translation_source"], settings["translation_target"]
+        if not settings["translation_url"]:
+            # Текст кодируется в адресе; длинный обрезается
+            url = "https://translate.google.com/?" + urllib.parse.urlencode(
+                {"sl": source, "tl": target, "op": "translate", "text": text[:self.BROWSER_TRANSLATE_CHARS]})
+            webbrowser.open(url)
+            if len(text) > self.BROWSER_TRANSLATE_CHARS:
+                self.update_status(f"Открыт переводчик Google (первые {self.BROWSER_TRANSLATE_CHARS} символов; "
+                                   f"для всего текста укажите сервер перевода в настройках)")
+            else:
+                self.update_status("Открыт переводчик Google")
+            return
+
+        if self.translating:
+            self.update_status("Перевод уже выполняется")
+            return
+        self.translating = True
+        service = TranslationService(
+            HttpTranslationBackend(settings["translation_url"], settings["translation_api_key"]),
+            self.translation_cache
+        )
+        self.update_status("Перевод...")
+
+        def progress(done, total):
+            self.call_in_ui(self.update_status, f"Перевод... пакетов {done} из {total}")
+
+        def worker():
+            try:
+                result = service.translate(text, source, target, progress)
+            except Exception as e:
+                self.call_in_ui(self.finish_translation, None, e)
+                return
+            self.call_in_ui(self.finish_translation, result, None)
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def finish_translation(self, result, error):
+        """Открываем перевод в новой вкладке"""
+        self.translating = False
+        if error:
+            messagebox.showerror("Ошибка", f"Не удалось перевести текст: {str(error)}")
+            self.update_status(f"Ошибка перевода: {str(error)}")
+            return
+        translated, stats = result
+        self.new_tab()
+        self.set_text(translated)
+        self.update_status(f"Перевод открыт в новой вкладке: предложений {stats['segments']}, "
+                           f"из кэша {stats['cached']}, отправлено {stats['sent']} "
+                           f"(пакетов {stats['batches']}) за {stats['elapsed']:.1f} с")
 
     def open_settings(self):
         """Открываем окно настроек горячих клавиш"""
         settings_win = tk.Toplevel(self.root)
         settings_win.title("Настройки горячих клавиш")
-        settings_win.geometry("500x400")
+        settings_win.geometry("500x660")
         settings_win.grab_set()
 
         tk.Label(settings_win, text="Настройте горячие клавиши:", font=("Arial", 12, "bold")).pack(pady=10)
@@ -1095,11 +5897,116 @@ class TextEditorApp:
         hotkey_entry.insert(0, self.hotkey_combination)
         hotkey_entry.pack(side=tk.LEFT, padx=5)
 
+        # Пороги режима большого документа
+        tk.Label(settings_win, text="Большой документ (символов):", font=("Arial", 10, "bold")).pack(pady=10,
+                                                                                                     anchor=tk.W)
+
+        large_frame = tk.Frame(settings_win)
+        large_frame.pack(fill=tk.X, padx=20, pady=5)
+
+        tk.Label(large_frame, text="Включать от:").pack(side=tk.LEFT)
+        large_entry = tk.Entry(large_frame, width=10)
+        large_entry.insert(0, str(self.editor_settings["large_document_chars"]))
+        large_entry.pack(side=tk.LEFT, padx=5)
+
+        tk.Label(large_frame, text="Выключать ниже:").pack(side=tk.LEFT)
+        large_exit_entry = tk.Entry(large_frame, width=10)
+        large_exit_entry.insert(0, str(self.editor_settings["large_document_exit_chars"]))
+        large_exit_entry.pack(side=tk.LEFT, padx=5)
+
+        split_frame = tk.Frame(settings_win)
+        split_frame.pack(fill=tk.X, padx=20, pady=5)
+
+        tk.Label(split_frame, text="Разбивать строки длиннее:").pack(side=tk.LEFT)
+        long_line_entry = tk.Entry(split_frame, width=10)
+        long_line_entry.insert(0, str(self.editor_settings["long_line_chars"]))
+        long_line_entry.pack(side=tk.LEFT, padx=5)
+
+        tk.Label(split_frame, text="по:").pack(side=tk.LEFT)
+        segment_entry = tk.Entry(split_frame, width=10)
+        segment_entry.insert(0, str(self.editor_settings["line_segment_chars"]))
+        segment_entry.pack(side=tk.LEFT, padx=5)
+
+        unload_frame = tk.Frame(settings_win)
+        unload_frame.pack(fill=tk.X, padx=20, pady=5)
+
+        tk.Label(unload_frame, text="Выгружать вкладки через (с):").pack(side=tk.LEFT)
+        unload_seconds_entry = tk.Entry(unload_frame, width=6)
+        unload_seconds_entry.insert(0, str(self.editor_settings["tab_unload_seconds"]))
+        unload_seconds_entry.pack(side=tk.LEFT, padx=5)
+
+        tk.Label(unload_frame, text="от (симв.):").pack(side=tk.LEFT)
+        unload_chars_entry = tk.Entry(unload_frame, width=10)
+        unload_chars_entry.insert(0, str(self.editor_settings["tab_unload_min_chars"]))
+        unload_chars_entry.pack(side=tk.LEFT, padx=5)
+
+        # Сервис перевода
+        tk.Label(settings_win, text="Перевод (сервер LibreTranslate):", font=("Arial", 10, "bold")).pack(pady=10,
+                                                                                                         anchor=tk.W)
+
+        translation_frame = tk.Frame(settings_win)
+        translation_frame.pack(fill=tk.X, padx=20, pady=5)
+
+        tk.Label(translation_frame, text="Адрес:").pack(side=tk.LEFT)
+        translation_url_entry = tk.Entry(translation_frame, width=40)
+        translation_url_entry.insert(0, self.editor_settings["translation_url"])
+        translation_url_entry.pack(side=tk.LEFT, padx=5)
+
+        language_frame = tk.Frame(settings_win)
+        language_frame.pack(fill=tk.X, padx=20, pady=5)
+
+        tk.Label(language_frame, text="Ключ:").pack(side=tk.LEFT)
+        translation_key_entry = tk.Entry(language_frame, width=16, show="*")
+        translation_key_entry.insert(0, self.editor_settings["translation_api_key"])
+        translation_key_entry.pack(side=tk.LEFT, padx=5)
+
+        tk.Label(language_frame, text="с языка:").pack(side=tk.LEFT)
+        source_entry = tk.Entry(language_frame, width=6)
+        source_entry.insert(0, self.editor_settings["translation_source"])
+        source_entry.pack(side=tk.LEFT, padx=5)
+
+        tk.Label(language_frame, text="на:").pack(side=tk.LEFT)
+        target_entry = tk.Entry(language_frame, width=6)
+        target_entry.insert(0, self.editor_settings["translation_target"])
+        target_entry.pack(side=tk.LEFT, padx=5)
+
         # Кнопки сохранения/отмены
         btn_frame = tk.Frame(settings_win)
         btn_frame.pack(pady=15)
 
         def save_all_settings():
+            try:
+                large_chars = int(large_entry.get())
+                large_exit_chars = int(large_exit_entry.get())
+                long_line_chars = int(long_line_entry.get())
+                segment_chars = int(segment_entry.get())
+                unload_seconds = int(unload_seconds_entry.get())
+                unload_chars = int(unload_chars_entry.get())
+                if large_chars <= 0 or not 0 < large_exit_chars <= large_chars:
+                    raise ValueError
+                if long_line_chars < 0 or segment_chars <= 0:
+                    raise ValueError
+                if unload_seconds < 0 or unload_chars < 0:
+                    raise ValueError
+            except ValueError:
+                messagebox.showerror("Ошибка", "Пороги должны быть целыми числами, "
+                                               "порог выключения не больше порога включения "
+                                               "(0 в разбивке строк и выгрузке вкладок - не выполнять)")
+                return
+            self.editor_settings["large_document_chars"] = large_chars
+            self.editor_settings["large_document_exit_chars"] = large_exit_chars
+            self.editor_settings["long_line_chars"] = long_line_chars
+            self.editor_settings["line_segment_chars"] = segment_chars
+            self.editor_settings["tab_unload_seconds"] = unload_seconds
+            self.editor_settings["tab_unload_min_chars"] = unload_chars
+            self.editor_settings["translation_url"] = translation_url_entry.get().strip()
+            self.editor_settings["translation_api_key"] = translation_key_entry.get().strip()
+            self.editor_settings["translation_source"] = source_entry.get().strip() or "auto"
+            self.editor_settings["translation_target"] = target_entry.get().strip() or "en"
+            self.line_splitter = LineSplitter(long_line_chars, segment_chars)
+            self.save_editor_settings()
+            self.check_document_mode()
+
             self.save_settings(entries, settings_win)
             new_hotkey = hotkey_entry.get().strip().lower()
             if new_hotkey and new_hotkey != self.hotkey_combination:
@@ -1136,8 +6043,9 @@ class TextEditorApp:
 
         # Меню для иконки в трее
         menu = (
-            TrayMenuItem('Открыть', self.restore_from_tray),
-            TrayMenuItem('Выход', self.exit_app)
+            # Меню трея работает в своем потоке - передаем действия в поток Tk
+            TrayMenuItem('Открыть', lambda: self.call_in_ui(self.restore_from_tray)),
+            TrayMenuItem('Выход', lambda: self.call_in_ui(self.exit_app))
         )
 
         self.tray_icon = Icon("text_editor", image, "Текстовый редактор", menu)
@@ -1164,8 +6072,210 @@ class TextEditorApp:
         """Полностью выходим из приложения"""
         if self.tray_active and self.tray_icon:
             self.tray_icon.stop()
+        for tab in self.tabs:
+            tab.discard()
+        # Дописываем очередь записи на диск
+        if not self.persistence.close():
+            print("Не все данные успели записаться на диск")
         self.root.destroy()
 
+    # Вкладки документов
+    @property
+    def text_area(self):
+        return self.current_tab.text_area
+
+    @property
+    def document(self):
+        return self.current_tab.document
+
+    @property
+    def undo_manager(self):
+        return self.current_tab.undo_manager
+
+    @property
+    def x_scrollbar(self):
+        return self.current_tab.x_scrollbar
+
+    @property
+    def large_document(self):
+        return self.current_tab.large_document
+
+    @large_document.setter
+    def large_document(self, value):
+        self.current_tab.large_document = value
+
+    def create_text_area(self, tab, text=""):
+        """Создаем виджет вкладки, модель документа и журнал правок"""
+        text_area = scrolledtext.ScrolledText(
+            tab.frame,
+            wrap=tk.WORD,
+            width=90,
+            height=25,
+            font=("Arial", 12)
+        )
+        text_area.pack(padx=15, pady=15, fill=tk.BOTH, expand=True)
+        # Текст выгруженной вкладки вставляем до журнала правок: он не попадает в отмену и историю
+        display, breaks = self.line_splitter.split(text)
+        if display:
+            text_area.insert("1.0", *tagged_insert_args(display, breaks, VIRTUAL_BREAK_TAG))
+            text_area.edit_modified(False)
+
+        tab.text_area = text_area
+        tab.document = PieceTable(display)
+        tab.undo_manager = UndoManager(text_area, tracked_tag=VIRTUAL_BREAK_TAG)
+        tab.undo_manager.add_listener(self.on_text_change)
+        tab.x_scrollbar = tk.Scrollbar(text_area.frame, orient=tk.HORIZONTAL, command=text_area.xview)
+        text_area.configure(xscrollcommand=tab.x_scrollbar.set)
+
+        text_area.bind("<<Copy>>", self.copy_selection)
+        text_area.bind("<<Cut>>", lambda event: self.copy_selection(event, cut=True))
+        for sequence in ("<<Undo>>", "<Control-z>"):
+            text_area.bind(sequence, self.undo)
+        for sequence in ("<<Redo>>", "<Control-y>", "<Control-Z>"):
+            text_area.bind(sequence, self.redo)
+
+        # Привязываем обработчик изменений текста и контекстное меню
+        text_area.bind("<<Modified>>", self.on_text_modified)
+        text_area.bind("<FocusOut>", self.on_focus_out)
+        text_area.bind("<Button-3>", self.show_context_menu)
+
+    def destroy_text_area(self, tab):
+        """Уничтожаем виджет вкладки вместе с журналом правок"""
+        tab.undo_manager.uninstall()
+        tab.text_area.frame.destroy()
+        tab.text_area = tab.x_scrollbar = tab.undo_manager = None
+        tab.document = None
+
+    def new_tab(self):
+        """Создаем пустую вкладку документа и переключаемся на нее"""
+        tab = EditorTab(ttk.Frame(self.notebook), next(self.tab_numbers))
+        self.create_text_area(tab)
+        # Документы идут перед историей и избранным (первая вкладка создается раньше них)
+        position = self.notebook.index(self.history_frame) if self.tabs else "end"
+        self.notebook.insert(position, tab.frame, text=tab.title())
+        self.tabs.append(tab)
+        self.select_tab(tab)
+        return tab
+
+    def select_tab(self, tab):
+        """Показываем вкладку и делаем ее текущей"""
+        self.notebook.select(tab.frame)
+        self.activate_tab(tab)
+        self.text_area.focus_set()
+
+    def tab_for_frame(self, frame):
+        """Вкладка документа по пути ее фрейма в панели (None для истории и избранного)"""
+        return next((tab for tab in self.tabs if str(tab.frame) == str(frame)), None)
+
+    def on_tab_changed(self, event):
+        """Переключение вкладок панели: документ становится текущим"""
+        tab = self.tab_for_frame(self.notebook.select())
+        if tab:
+            self.activate_tab(tab)
+
+    def activate_tab(self, tab):
+        """Делаем вкладку текущей (на нее действуют кнопки, клавиши и меню); выгруженную загружаем"""
+        if tab is self.current_tab:
+            return
+        now = time.monotonic()
+        if self.current_tab:
+            self.current_tab.last_active = now
+        tab.last_active = now
+        self.current_tab = tab
+        if tab.unloaded:
+            self.restore_tab(tab)
+        self.last_history_text = self.get_text()
+        self.update_mode_indicator()
+
+    def update_tab_title(self, tab):
+        self.notebook.tab(tab.frame, text=tab.title())
+
+    def tab_at(self, event):
+        """Вкладка документа под курсором мыши"""
+        try:
+            index = self.notebook.index(f"@{event.x},{event.y}")
+        except (tk.TclError, ValueError):
+            return None
+        return self.tab_for_frame(self.notebook.tabs()[index])
+
+    def on_tab_middle_click(self, event):
+        """Средняя кнопка мыши закрывает вкладку"""
+        tab = self.tab_at(event)
+        if tab:
+            self.close_tab(tab)
+
+    def show_tab_menu(self, event):
+        """Контекстное меню заголовка вкладки"""
+        tab = self.tab_at(event)
+        self.tab_menu.delete(0, 'end')
+        self.tab_menu.add_command(label="Новая вкладка (Ctrl+N)", command=self.new_tab)
+        if tab:
+            self.tab_menu.add_command(label="Закрыть вкладку (Ctrl+W)", command=lambda: self.close_tab(tab))
+        self.tab_menu.tk_popup(event.x_root, event.y_root)
+
+    def close_tab(self, tab=None):
+        """Закрываем вкладку документа, предлагая сохранить изменения"""
+        tab = tab or self.current_tab
+        if tab.dirty:
+            answer = messagebox.askyesnocancel("Закрыть вкладку", f"Сохранить изменения в «{tab.name()}»?")
+            if answer is None:
+                return
+            if answer:
+                self.select_tab(tab)
+                if not self.save_file():
+                    return
+
+        # Последнюю вкладку заменяем пустой
+        if len(self.tabs) == 1:
+            self.new_tab()
+        index = self.tabs.index(tab)
+        self.tabs.remove(tab)
+        if tab is self.current_tab:
+            self.select_tab(self.tabs[min(index, len(self.tabs) - 1)])
+        if not tab.unloaded:
+            self.destroy_text_area(tab)
+        tab.discard()
+        self.notebook.forget(tab.frame)
+        tab.frame.destroy()
+        self.update_status(f"Вкладка закрыта: {tab.name()}")
+
+    def unload_idle_tabs(self):
+        """Выгружаем вкладки, неактивные дольше порога, чтобы память не росла с числом документов"""
+        now = time.monotonic()
+        idle_seconds = self.editor_settings["tab_unload_seconds"]
+        min_chars = self.editor_settings["tab_unload_min_chars"]
+        if idle_seconds > 0:
+            for tab in self.tabs:
+                if tab is self.current_tab or tab.unloaded:
+                    continue
+                if now - tab.last_active >= idle_seconds and len(tab.document) >= min_chars:
+                    self.unload_tab(tab)
+        self.root.after(self.TAB_UNLOAD_CHECK_MS, self.unload_idle_tabs)
+
+    def unload_tab(self, tab):
+        """Пишем текст вкладки во временный файл и уничтожаем ее виджет и журнал правок"""
+        try:
+            written = tab.spill(self.true_text(tab))
+        except Exception as e:
+            print(f"Не удалось выгрузить вкладку {tab.name()}: {e}")
+            return
+        self.instrumentation.count_io(written=written)
+        self.destroy_text_area(tab)
+
+    def restore_tab(self, tab):
+        """Загружаем выгруженную вкладку из временного файла"""
+        try:
+            size = os.path.getsize(tab.spill_path)
+            text = tab.take_spilled()
+            self.instrumentation.count_io(read=size)
+        except Exception as e:
+            # Временный файл не удаляем: из него можно восстановить текст вручную
+            messagebox.showerror("Ошибка", f"Не удалось загрузить вкладку из {tab.spill_path}: {str(e)}")
+            tab.spill_path = None
+            text = ""
+        self.create_text_area(tab, text)
+        self.check_document_mode()
+
     # Методы для истории и избранного
     def create_history_favorites_tabs(self):
         """Создаем вкладки истории и избранного"""
@@ -1196,6 +6306,9 @@ class TextEditorApp:
 
         tk.Button(search_frame, text="Поиск", command=self.filter_history).pack(side=tk.LEFT, padx=5)
         tk.Button(search_frame, text="Очистить", command=self.clear_history_search).pack(side=tk.LEFT, padx=5)
+        self.history_fuzzy_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(search_frame, text="Нечетко", variable=self.history_fuzzy_var,
+                       command=self.filter_history).pack(side=tk.LEFT, padx=5)
 
         # Фрейм для списка с прокруткой
         list_frame = tk.Frame(self.history_frame)
@@ -1210,7 +6323,8 @@ class TextEditorApp:
             list_frame,
             yscrollcommand=scrollbar.set,
             width=100,
-            height=20
+            height=20,
+            selectmode=tk.EXTENDED
         )
         self.history_listbox.pack(fill=tk.BOTH, expand=True)
         scrollbar.config(command=self.history_listbox.yview)
@@ -1222,6 +6336,13 @@ class TextEditorApp:
         tk.Button(btn_frame, text="Восстановить", command=self.restore_from_history).pack(side=tk.LEFT, padx=5)
         tk.Button(btn_frame, text="В избранное", command=self.add_to_favorites_from_history).pack(side=tk.LEFT, padx=5)
         tk.Button(btn_frame, text="Удалить", command=self.delete_from_history).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Сравнить",
+                  command=lambda: self.compare_entries(self.selected_history_entries())).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Отметить для сравнения",
+                  command=lambda: self.mark_diff_base(self.selected_history_entries())).pack(side=tk.LEFT, padx=5)
+        self.history_archive_button = tk.Button(btn_frame, text="Показать старые записи",
+                                                command=self.show_archived_history)
+        self.history_archive_button.pack(side=tk.RIGHT, padx=5)
 
         # Заполняем историю
         self.populate_history()
@@ -1243,6 +6364,9 @@ class TextEditorApp:
 
         tk.Button(search_frame, text="Поиск", command=self.filter_favorites).pack(side=tk.LEFT, padx=5)
         tk.Button(search_frame, text="Очистить", command=self.clear_favorites_search).pack(side=tk.LEFT, padx=5)
+        self.favorites_fuzzy_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(search_frame, text="Нечетко", variable=self.favorites_fuzzy_var,
+                       command=self.filter_favorites).pack(side=tk.LEFT, padx=5)
 
         # Фрейм для списка с прокруткой
         list_frame = tk.Frame(self.favorites_frame)
@@ -1257,7 +6381,8 @@ class TextEditorApp:
             list_frame,
             yscrollcommand=scrollbar.set,
             width=100,
-            height=20
+            height=20,
+            selectmode=tk.EXTENDED
         )
         self.favorites_listbox.pack(fill=tk.BOTH, expand=True)
         scrollbar.config(command=self.favorites_listbox.yview)
@@ -1268,47 +6393,212 @@ class TextEditorApp:
 
         tk.Button(btn_frame, text="Копировать", command=self.copy_from_favorites).pack(side=tk.LEFT, padx=5)
         tk.Button(btn_frame, text="Удалить", command=self.delete_from_favorites).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Сравнить",
+                  command=lambda: self.compare_entries(self.selected_favorite_entries())).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Отметить для сравнения",
+                  command=lambda: self.mark_diff_base(self.selected_favorite_entries())).pack(side=tk.LEFT, padx=5)
 
         # Заполняем избранное
         self.populate_favorites()
 
     def populate_history(self):
-        """Заполняем список истории"""
+        """Заполняем список истории (горячий уровень; архив - по кнопке)"""
+        self.history_search_token += 1
         self.history_listbox.delete(0, tk.END)
+        self.history_rows = []
         for item in reversed(self.history):
-            preview = item['text'][:100] + "..." if len(item['text']) > 100 else item['text']
-            self.history_listbox.insert(tk.END, f"{item['timestamp']}: {preview}")
-            self.history_listbox.itemconfig(tk.END, {'fg': 'gray'})
+            self.add_history_row(("hot", item), self.entry_preview(item))
+        self.history_archive_shown = 0
+        self.update_archive_button()
+
+    def add_history_row(self, row, preview):
+        """Добавляем строку в список истории; записи архива помечаются"""
+        if row[0] == "cold":
+            preview = f"[архив] {preview}"
+        self.history_rows.append(row)
+        self.history_listbox.insert(tk.END, preview)
+        self.history_listbox.itemconfig(tk.END, {'fg': 'gray' if row[0] == "hot" else 'slate gray'})
+
+    def update_archive_button(self):
+        """Кнопка показа архива: сколько сегментов еще не показано"""
+        remaining = len(self.history_archive.segments()) - self.history_archive_shown
+        if remaining > 0 and not self.history_search_var.get():
+            self.history_archive_button.config(text=f"Показать старые записи ({remaining} сегм.)", state=tk.NORMAL)
+        else:
+            self.history_archive_button.config(text="Показать старые записи", state=tk.DISABLED)
+
+    def show_archived_history(self):
+        """Дописываем в список следующую страницу архива: читаются только индексы сегментов"""
+        numbers = list(reversed(self.history_archive.segments()))
+        page = numbers[self.history_archive_shown:self.history_archive_shown + self.HISTORY_ARCHIVE_PAGE]
+        try:
+            for number in page:
+                index = self.history_archive.read_index(number)
+                for position in range(len(index) - 1, -1, -1):
+                    entry = index[position]
+                    self.add_history_row(("cold", number, position, entry), f"{entry['timestamp']}: {entry['preview']}")
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось прочитать архив истории: {str(e)}")
+        self.history_archive_shown += len(page)
+        self.update_archive_button()
 
     def populate_favorites(self):
         """Заполняем список избранного"""
         self.favorites_listbox.delete(0, tk.END)
+        self.favorites_rows = []
         for item in self.favorites:
-            preview = item['text'][:100] + "..." if len(item['text']) > 100 else item['text']
-            self.favorites_listbox.insert(tk.END, f"{item['timestamp']}: {preview}")
-            self.favorites_listbox.itemconfig(tk.END, {'fg': 'blue'})
+            self.add_favorite_row(item, self.entry_preview(item))
+
+    def add_favorite_row(self, item, preview):
+        self.favorites_rows.append(item)
+        self.favorites_listbox.insert(tk.END, preview)
+        self.favorites_listbox.itemconfig(tk.END, {'fg': 'blue'})
+
+    def selected_favorite(self):
+        """Выбранная запись избранного (с учетом фильтра)"""
+        selected_index = self.favorites_listbox.curselection()
+        if not selected_index or selected_index[0] >= len(self.favorites_rows):
+            return None
+        return self.favorites_rows[selected_index[0]]
 
     def filter_history(self, event=None):
-        """Фильтруем историю по поисковому запросу"""
+        """Фильтруем историю по поисковому запросу; архив ищется в фоне"""
         query = self.history_search_var.get().lower()
+        self.history_search_token += 1
         self.history_listbox.delete(0, tk.END)
+        self.history_rows = []
+
+        if query and self.history_fuzzy_var.get():
+            self.fuzzy_filter_history(query)
+            self.update_archive_button()
+            return
 
         for item in reversed(self.history):
-            if query in item['text'].lower():
-                preview = item['text'][:100] + "..." if len(item['text']) > 100 else item['text']
-                self.history_listbox.insert(tk.END, f"{item['timestamp']}: {preview}")
-                self.history_listbox.itemconfig(tk.END, {'fg': 'gray'})
+            if query in self.entry_text(item).lower():
+                self.add_history_row(("hot", item), self.entry_preview(item))
+        self.update_archive_button()
+
+        if not query or not self.history_archive.segments():
+            return
+        # Более новый запрос отменяет поиск по оставшимся сегментам
+        token = self.history_search_token
+        self.update_status("Поиск в архиве истории...")
+        future = self.background_executor.submit(
+            self.history_archive.search, query, lambda: token != self.history_search_token)
+        future.add_done_callback(lambda done: self.call_in_ui(self.finish_archive_search, done, token))
+
+    def finish_archive_search(self, future, token):
+        """Дописываем найденные в архиве записи, если запрос не сменился"""
+        if token != self.history_search_token:
+            return
+        try:
+            matches = future.result()
+        except Exception as e:
+            self.update_status(f"Ошибка поиска в архиве: {str(e)}")
+            return
+        for number, position, entry in matches or []:
+            self.add_history_row(("cold", number, position, entry), f"{entry['timestamp']}: {entry['preview']}")
+        self.update_status(f"Найдено в архиве истории: {len(matches or [])}")
+
+    def fuzzy_preview(self, item, errors, snippet):
+        """Строка результата нечеткого поиска: найденный фрагмент вместо начала текста"""
+        typos = f"  (опечаток: {errors})" if errors else ""
+        return f"{item['timestamp']}: {snippet}{typos}"
+
+    def fuzzy_filter_history(self, query):
+        """Нечеткий поиск по всей истории (горячий уровень и архив) с ранжированием"""
+        if self.history_fuzzy is None:
+            # Список заполнится после сборки индекса
+            if self.history_fuzzy_pending is None:
+                self.build_history_index()
+            return
+        results, complete = self.history_fuzzy.search(query, self.FUZZY_RESULTS)
+        for key, info, errors, snippet in results:
+            row = ("hot", info) if key[0] == "hot" else key + (info,)
+            self.add_history_row(row, self.fuzzy_preview(info, errors, snippet))
+        suffix = "" if complete else " (поиск прерван по времени, показаны лучшие из проверенных)"
+        self.update_status(f"Нечеткий поиск: {len(results)} из {len(self.history_fuzzy)} записей{suffix}")
+
+    def history_index_update(self, method, *args):
+        """Правим нечеткий индекс истории; во время фоновой сборки правки копятся и применяются после"""
+        if self.history_fuzzy is not None:
+            getattr(self.history_fuzzy, method)(*args)
+        elif self.history_fuzzy_pending is not None:
+            self.history_fuzzy_pending.append((method, args))
+
+    def history_index_remove_cold(self, number, position, remaining):
+        """Запись удалена из сегмента архива: следующие за ней сдвигаются на одну позицию"""
+        if self.history_fuzzy_pending is not None:
+            # Сборка могла прочитать сегмент уже без записи - собираем индекс заново
+            self.history_fuzzy_stale = True
+            return
+        if self.history_fuzzy is None:
+            return
+        self.history_fuzzy.remove(("cold", number, position))
+        for old_position in range(position + 1, remaining + 1):
+            self.history_fuzzy.rekey(("cold", number, old_position), ("cold", number, old_position - 1))
+
+    def build_history_index(self):
+        """Строим нечеткий индекс истории в фоне: горячий уровень и все сегменты архива"""
+        self.history_fuzzy_pending = []
+        self.history_fuzzy_stale = False
+        hot = [(item, self.blob_store.texts.get(item["hash"]), self.blob_store.path(item["hash"]))
+               for item in self.history]
+        numbers = self.history_archive.segments()
+        self.update_status("Строится индекс нечеткого поиска по истории...")
+        future = self.background_executor.submit(self.make_history_index, hot, numbers)
+        future.add_done_callback(lambda done: self.call_in_ui(self.finish_history_index, done))
+
+    def make_history_index(self, hot, numbers):
+        """Индексируем записи от старых к новым: id индекса растут вместе со свежестью (фоновый поток)"""
+        index = FuzzySearchIndex()
+        for number in numbers:
+            entries = self.history_archive.read_index(number)
+            texts = self.history_archive.read_texts(number, cache=False)
+            for position, (entry, text) in enumerate(zip(entries, texts)):
+                index.add(("cold", number, position), entry, text)
+        for item, text, path in hot:
+            index.add(("hot", id(item)), item, BlobStore.load(path) if text is None else text)
+        return index
+
+    def finish_history_index(self, future):
+        """Применяем накопленные правки к собранному индексу и повторяем поиск"""
+        pending, self.history_fuzzy_pending = self.history_fuzzy_pending, None
+        try:
+            index = future.result()
+        except Exception as e:
+            self.update_status(f"Ошибка построения индекса поиска: {str(e)}")
+            return
+        if self.history_fuzzy_stale:
+            self.build_history_index()
+            return
+        for method, args in pending:
+            getattr(index, method)(*args)
+        self.history_fuzzy = index
+        self.update_status(f"Индекс нечеткого поиска построен: {len(index)} записей")
+        if self.history_fuzzy_var.get() and self.history_search_var.get():
+            self.filter_history()
 
     def filter_favorites(self, event=None):
         """Фильтруем избранное по поисковому запросу"""
         query = self.favorites_search_var.get().lower()
         self.favorites_listbox.delete(0, tk.END)
+        self.favorites_rows = []
+
+        if query and self.favorites_fuzzy_var.get():
+            # Избранное невелико: индекс строится сразу при первом нечетком поиске
+            if self.favorites_fuzzy is None:
+                self.favorites_fuzzy = FuzzySearchIndex()
+                for item in self.favorites:
+                    self.favorites_fuzzy.add(id(item), item, self.entry_text(item))
+            results, _ = self.favorites_fuzzy.search(query, self.FUZZY_RESULTS)
+            for _, item, errors, snippet in results:
+                self.add_favorite_row(item, self.fuzzy_preview(item, errors, snippet))
+            return
 
         for item in self.favorites:
-            if query in item['text'].lower():
-                preview = item['text'][:100] + "..." if len(item['text']) > 100 else item['text']
-                self.favorites_listbox.insert(tk.END, f"{item['timestamp']}: {preview}")
-                self.favorites_listbox.itemconfig(tk.END, {'fg': 'blue'})
+            if query in self.entry_text(item).lower():
+                self.add_favorite_row(item, self.entry_preview(item))
 
     def clear_history_search(self):
         """Очищаем поиск в истории"""
@@ -1323,93 +6613,334 @@ class TextEditorApp:
     def add_to_history(self, text):
         """Добавляем текст в историю"""
         # Не добавляем пустые или повторные записи
-        if not text or (self.history and self.history[-1]['text'] == text):
+        if not text:
+            return
+        key = BlobStore.hash_text(text)
+        if self.history and self.history[-1]['hash'] == key:
             return
 
-        self.history.append({
-            "text": text,
-            "timestamp": self.get_current_time()
-        })
+        # Повторяющийся текст хранится один раз, запись лишь ссылается на него.
+        # Размер и превью хранятся в записи, чтобы список строился без чтения текстов
+        item = {
+            "hash": self.blob_store.add(text, key),
+            "timestamp": self.get_current_time(),
+            "size": len(text),
+            "preview": HistoryArchive.make_preview(text)
+        }
+        self.history.append(item)
+        self.history_index_update("add", ("hot", id(item)), item, text)
         self.save_data("history.json", self.history)
+        self.archive_history()
 
         # Обновляем список если вкладка активна
-        if self.notebook.index(self.notebook.select()) == 1:
+        if self.notebook.select() == str(self.history_frame):
             self.populate_history()
 
-    def restore_from_history(self):
-        """Восстанавливаем текст из истории"""
-        selected_index = self.history_listbox.curselection()
-        if not selected_index:
+    def archive_history(self):
+        """Переносим самые старые записи горячего уровня в сжатый сегмент архива (в фоне)"""
+        if self.history_archiving or len(self.history) <= self.HISTORY_HOT_ENTRIES + HistoryArchive.SEGMENT_ENTRIES:
+            return
+        moved = self.history[:HistoryArchive.SEGMENT_ENTRIES]
+        # Загруженные тексты берем из памяти, остальные фоновый поток прочитает из хранилища
+        sources = [(item["timestamp"], self.blob_store.texts.get(item["hash"]), self.blob_store.path(item["hash"]))
+                   for item in moved]
+        self.history_archiving = True
+        future = self.background_executor.submit(self.write_archive_segment, sources)
+        future.add_done_callback(lambda done: self.call_in_ui(self.finish_archiving, done, moved))
+
+    def write_archive_segment(self, sources):
+        """Собираем тексты записей и пишем сегмент архива (фоновый поток)"""
+        entries = [(timestamp, BlobStore.load(path) if text is None else text) for timestamp, text, path in sources]
+        return self.history_archive.append(entries)
+
+    def finish_archiving(self, future, moved):
+        """Убираем перенесенные записи из горячего уровня и освобождаем их тексты"""
+        self.history_archiving = False
+        try:
+            number = future.result()
+        except Exception as e:
+            print(f"Не удалось перенести историю в архив: {e}")
+            self.update_status(f"Ошибка архивирования истории: {str(e)}")
             return
 
-        index = selected_index[0]
-        # Получаем реальный индекс в истории (с учетом реверса)
-        real_index = len(self.history) - 1 - index
-        if 0 <= real_index < len(self.history):
-            self.set_text(self.history[real_index]['text'])
+        # Записи, удаленные пользователем во время переноса, убираем и из нового сегмента
+        present = {id(item) for item in self.history}
+        kept = [item for item in moved if id(item) in present]
+        if len(kept) < len(moved):
+            try:
+                for position in range(len(moved) - 1, -1, -1):
+                    if id(moved[position]) not in present:
+                        self.history_archive.remove(number, position)
+            except Exception as e:
+                print(f"Не удалось убрать удаленные записи из архива истории: {e}")
+            if self.history_fuzzy_pending is not None:
+                # Сборка индекса могла прочитать сегмент вместе с удаленными записями
+                self.history_fuzzy_stale = True
+
+        for position, item in enumerate(kept):
+            self.history_index_update("rekey", ("hot", id(item)), ("cold", number, position),
+                                      {"timestamp": item["timestamp"]})
+
+        # Записи, удаленные пользователем во время переноса, уже освобождены
+        moved_ids = {id(item) for item in moved}
+        for item in self.history:
+            if id(item) in moved_ids:
+                self.blob_store.release(item['hash'])
+        self.history = [item for item in self.history if id(item) not in moved_ids]
+        self.save_data("history.json", self.history)
+        if self.notebook.select() == str(self.history_frame) and not self.history_search_var.get():
+            self.populate_history()
+        self.archive_history()
 
-    def add_to_favorites_from_history(self):
-        """Добавляем в избранное из истории"""
+    def selected_history_row(self):
+        """Выбранная строка списка истории: ("hot", запись) или ("cold", сегмент, позиция, запись индекса)"""
         selected_index = self.history_listbox.curselection()
-        if not selected_index:
-            return
+        if not selected_index or selected_index[0] >= len(self.history_rows):
+            return None
+        return self.history_rows[selected_index[0]]
+
+    def history_row_text(self, row):
+        """Текст строки истории; запись архива распаковывается вместе с ее сегментом"""
+        if row[0] == "hot":
+            return self.entry_text(row[1])
+        try:
+            return self.history_archive.text(row[1], row[2])
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось прочитать архив истории: {str(e)}")
+            return None
+
+    def restore_from_history(self):
+        """Восстанавливаем текст из истории"""
+        row = self.selected_history_row()
+        if row:
+            text = self.history_row_text(row)
+            if text is not None:
+                self.set_text(text)
 
-        index = selected_index[0]
-        # Получаем реальный индекс в истории (с учетом реверса)
-        real_index = len(self.history) - 1 - index
-        if 0 <= real_index < len(self.history):
-            self.add_to_favorites(self.history[real_index]['text'])
+    def add_to_favorites_from_history(self):
+        """Добавляем в избранное из истории"""
+        row = self.selected_history_row()
+        if row:
+            text = self.history_row_text(row)
+            if text is not None:
+                self.add_to_favorites(text)
 
     def delete_from_history(self):
         """Удаляем запись из истории"""
-        selected_index = self.history_listbox.curselection()
-        if not selected_index:
+        row = self.selected_history_row()
+        if not row:
             return
 
-        index = selected_index[0]
-        # Получаем реальный индекс в истории (с учетом реверса)
-        real_index = len(self.history) - 1 - index
-        if 0 <= real_index < len(self.history):
-            del self.history[real_index]
-            self.save_data("history.json", self.history)
+        if row[0] == "hot":
+            item = row[1]
+            if item in self.history:
+                self.history.remove(item)
+                self.blob_store.release(item['hash'])
+                self.history_index_update("remove", ("hot", id(item)))
+                self.save_data("history.json", self.history)
+        else:
+            try:
+                remaining = self.history_archive.remove(row[1], row[2])
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось изменить архив истории: {str(e)}")
+                return
+            self.history_index_remove_cold(row[1], row[2], remaining)
+        # Позиции в сегменте архива сдвинулись - строим список заново
+        if self.history_search_var.get():
+            self.filter_history()
+        else:
             self.populate_history()
 
     def copy_from_favorites(self):
         """Копируем текст из избранного"""
-        selected_index = self.favorites_listbox.curselection()
-        if not selected_index:
-            return
-
-        index = selected_index[0]
-        if 0 <= index < len(self.favorites):
-            text = self.favorites[index]['text']
+        item = self.selected_favorite()
+        if item:
+            text = self.entry_text(item)
             pyperclip.copy(text)
             self.update_status("Текст из избранного скопирован в буфер")
 
     def delete_from_favorites(self):
         """Удаляем запись из избранного"""
-        selected_index = self.favorites_listbox.curselection()
-        if not selected_index:
+        item = self.selected_favorite()
+        if item and item in self.favorites:
+            self.favorites.remove(item)
+            self.favorite_hashes.discard(item['hash'])
+            self.blob_store.release(item['hash'])
+            if self.favorites_fuzzy is not None:
+                self.favorites_fuzzy.remove(id(item))
+            self.save_data("favorites.json", self.favorites)
+            if self.favorites_search_var.get():
+                self.filter_favorites()
+            else:
+                self.populate_favorites()
+
+    def selected_history_entries(self):
+        """Выбранные записи истории [(подпись, текст)] от старых к новым (крайние две); None - ошибка чтения"""
+        selection = [i for i in self.history_listbox.curselection() if i < len(self.history_rows)]
+        entries = []
+        for i in sorted(set(selection[:1] + selection[-1:])):
+            row = self.history_rows[i]
+            text = self.history_row_text(row)
+            if text is None:
+                return None
+            entry = row[1] if row[0] == "hot" else row[3]
+            entries.append((f"История, {entry['timestamp']}", text))
+        # Список идет от новых записей к старым
+        entries.reverse()
+        return entries
+
+    def selected_favorite_entries(self):
+        """Выбранные записи избранного [(подпись, текст)] по времени добавления (крайние две)"""
+        selection = [i for i in self.favorites_listbox.curselection() if i < len(self.favorites_rows)]
+        items = sorted((self.favorites_rows[i] for i in set(selection[:1] + selection[-1:])),
+                       key=lambda item: item['timestamp'])
+        return [(f"Избранное, {item['timestamp']}", self.entry_text(item)) for item in items]
+
+    def mark_diff_base(self, entries):
+        """Запоминаем запись, с которой сравнится следующая выбранная (в т.ч. из другого списка)"""
+        if entries is None:
             return
+        if len(entries) != 1:
+            messagebox.showinfo("Информация", "Выберите одну запись")
+            return
+        self.diff_base = entries[0]
+        self.update_status(f"Отмечено для сравнения: {self.diff_base[0]}")
 
-        index = selected_index[0]
-        if 0 <= index < len(self.favorites):
-            del self.favorites[index]
-            self.save_data("favorites.json", self.favorites)
-            self.populate_favorites()
+    def compare_entries(self, entries):
+        """Две записи сравниваются между собой; одна - с отмеченной записью или с текущим текстом"""
+        if entries is None:
+            return
+        if len(entries) == 2:
+            old, new = entries
+        elif len(entries) == 1 and self.diff_base:
+            old, new = self.diff_base, entries[0]
+            self.diff_base = None
+        elif len(entries) == 1:
+            old, new = entries[0], ("Текущий текст", self.true_text())
+        else:
+            messagebox.showinfo("Информация", "Выберите одну или две записи")
+            return
+        self.open_diff_view(old, new)
+
+    def open_diff_view(self, old, new):
+        """Окно сравнения: diff считается в фоновом потоке, строки выводятся по мере прокрутки"""
+        (old_label, old_text), (new_label, new_text) = old, new
+        window = tk.Toplevel(self.root)
+        window.title("Сравнение")
+        window.geometry("900x600")
+
+        tk.Label(window, text=f"− {old_label}\n+ {new_label}", justify=tk.LEFT,
+                 anchor=tk.W).pack(fill=tk.X, padx=10, pady=5)
+
+        text_frame = tk.Frame(window)
+        text_frame.pack(fill=tk.BOTH, expand=True, padx=10)
+        view = tk.Text(text_frame, wrap=tk.NONE, font=("Courier New", 10))
+        vbar = tk.Scrollbar(text_frame, orient=tk.VERTICAL, command=view.yview)
+        hbar = tk.Scrollbar(text_frame, orient=tk.HORIZONTAL, command=view.xview)
+        vbar.pack(side=tk.RIGHT, fill=tk.Y)
+        hbar.pack(side=tk.BOTTOM, fill=tk.X)
+        view.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        view.tag_config("hunk", foreground="gray40", background="#eef0ff")
+        view.tag_config("removed", background="#ffecec")
+        view.tag_config("added", background="#eaffea")
+        view.tag_config("removed_word", background="#ffb3b3")
+        view.tag_config("added_word", background="#9fef9f")
+
+        status_var = tk.StringVar(value="Сравнение...")
+        tk.Label(window, textvariable=status_var, anchor=tk.W).pack(fill=tk.X, padx=10, pady=5)
+
+        # Позиция вывода: фрагмент, строка в нем и строка виджета
+        state = {"result": None, "hunk": 0, "line": 0, "row": 1, "pending": False}
+        line_tags = {"-": "removed", "+": "added"}
+        word_tags = {"-": "removed_word", "+": "added_word"}
+
+        def index(row, line, column):
+            # После знака строки и пробела; эмодзи в Tk 8.6 занимают две позиции
+            if self.tk_wide_chars:
+                column += len(NON_BMP_PATTERN.findall(line, 0, column))
+            return f"{row}.{column + 2}"
+
+        def render_more():
+            # Дописываем следующие DIFF_RENDER_LINES строк
+            state["pending"] = False
+            hunks = state["result"]["hunks"]
+            budget = self.DIFF_RENDER_LINES
+            view.config(state=tk.NORMAL)
+            while budget > 0 and state["hunk"] < len(hunks):
+                hunk = hunks[state["hunk"]]
+                if state["line"] == 0:
+                    view.insert(tk.END, hunk["header"] + "\n", "hunk")
+                    state["row"] += 1
+                lines = hunk["lines"]
+                end = min(len(lines), state["line"] + budget)
+                for kind, line, spans in lines[state["line"]:end]:
+                    row = state["row"]
+                    view.insert(tk.END, f"{kind} {line}\n", line_tags.get(kind, ()))
+                    for start, stop in spans:
+                        view.tag_add(word_tags[kind], index(row, line, start), index(row, line, stop))
+                    state["row"] += 1
+                budget -= end - state["line"]
+                if end == len(lines):
+                    state["hunk"] += 1
+                    state["line"] = 0
+                else:
+                    state["line"] = end
+            view.config(state=tk.DISABLED)
+            result = state["result"]
+            status_var.set(f"Фрагментов: {len(hunks)} (показано {state['hunk']}), "
+                           f"строк добавлено {result['added']}, удалено {result['removed']}")
+
+        def on_scroll(first, last):
+            vbar.set(first, last)
+            # Близко к концу выведенного - дописываем следующую порцию
+            result = state["result"]
+            if (result and not state["pending"] and float(last) > 0.9
+                    and state["hunk"] < len(result["hunks"])):
+                state["pending"] = True
+                window.after_idle(render_more)
+
+        view.configure(yscrollcommand=on_scroll, xscrollcommand=hbar.set, state=tk.DISABLED)
+
+        def finish(result, error):
+            if not window.winfo_exists():
+                return
+            if error:
+                status_var.set(f"Ошибка: {error}")
+                messagebox.showerror("Ошибка", f"Не удалось сравнить тексты: {str(error)}", parent=window)
+                return
+            state["result"] = result
+            if not result["hunks"]:
+                status_var.set("Тексты совпадают")
+                return
+            render_more()
+
+        def worker():
+            try:
+                result = self.text_diff.compare(old_text, new_text)
+            except Exception as e:
+                self.call_in_ui(finish, None, e)
+                return
+            self.call_in_ui(finish, result, None)
+
+        threading.Thread(target=worker, daemon=True).start()
 
     def add_to_favorites(self, text):
         """Добавляем текст в избранное"""
-        # Проверяем, нет ли уже такого текста в избранном
-        for item in self.favorites:
-            if item['text'] == text:
-                messagebox.showinfo("Информация", "Текст уже в избранном")
-                return
+        # Проверяем, нет ли уже такого текста в избранном (по хэшу, без сравнения текстов)
+        key = BlobStore.hash_text(text)
+        if key in self.favorite_hashes:
+            messagebox.showinfo("Информация", "Текст уже в избранном")
+            return
 
-        self.favorites.append({
-            "text": text,
+        item = {
+            "hash": self.blob_store.add(text, key),
             "timestamp": self.get_current_time()
-        })
+        }
+        self.favorites.append(item)
+        if self.favorites_fuzzy is not None:
+            self.favorites_fuzzy.add(id(item), item, text)
+        self.favorite_hashes.add(key)
         self.save_data("favorites.json", self.favorites)
         self.populate_favorites()
         messagebox.showinfo("Успех", "Текст добавлен в избранное")
@@ -1434,43 +6965,445 @@ class TextEditorApp:
 
         if not file_path:
             return
-
+        if file_path.lower().endswith((".csv", ".tsv")):
+            self.open_csv_view(file_path)
+        else:
+            self.load_file(file_path)
+
+    def tab_for_new_content(self):
+        """Текущая вкладка, если она пустая и без изменений, иначе новая (она становится текущей)"""
+        tab = self.current_tab
+        if tab.file_path or tab.dirty or len(tab.document):
+            tab = self.new_tab()
+        return tab
+
+    def load_file(self, file_path):
+        """Загружаем текстовый файл в редактор: в текущую вкладку, если она пуста, иначе в новую"""
+        for tab in self.tabs:
+            if tab.file_path and os.path.abspath(tab.file_path) == os.path.abspath(file_path):
+                self.select_tab(tab)
+                self.update_status(f"Файл уже открыт: {file_path}")
+                return
         try:
-            # Определяем кодировку
+            # Читаем файл один раз и определяем кодировку по прочитанным байтам
             with open(file_path, 'rb') as f:
                 raw_data = f.read()
-                encoding = chardet.detect(raw_data)['encoding'] or 'utf-8'
-
-            # Читаем файл
-            with open(file_path, 'r', encoding=encoding) as f:
-                content = f.read()
-                self.set_text(content)
-                self.update_status(f"Файл загружен: {file_path}")
+            self.instrumentation.count_io(read=len(raw_data))
+            content, encoding = decode_text_bytes(raw_data)
+            tab = self.tab_for_new_content()
+            self.set_text(content)
+            tab.file_path, tab.encoding, tab.dirty = file_path, encoding, False
+            self.update_tab_title(tab)
+            self.update_status(f"Файл загружен: {file_path} ({encoding})")
 
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось открыть файл: {str(e)}")
             self.update_status(f"Ошибка загрузки файла: {str(e)}")
 
+    def open_csv_view(self, file_path):
+        """Таблица CSV: строки читаются с диска постранично, видимы только строки окна"""
+        try:
+            table = CsvTable(file_path)
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Не удалось открыть CSV: {str(e)}")
+            return
+
+        window = tk.Toplevel(self.root)
+        window.title(f"CSV: {os.path.basename(file_path)}")
+        window.geometry("900x560")
+
+        # Панель фильтра
+        top_frame = tk.Frame(window)
+        top_frame.pack(fill=tk.X, padx=10, pady=5)
+
+        tk.Label(top_frame, text="Фильтр:").pack(side=tk.LEFT)
+        filter_var = tk.StringVar()
+        filter_entry = tk.Entry(top_frame, textvariable=filter_var, width=30)
+        filter_entry.pack(side=tk.LEFT, padx=5)
+
+        all_columns = "Все колонки"
+        column_var = tk.StringVar(value=all_columns)
+        column_box = ttk.Combobox(top_frame, textvariable=column_var, values=[all_columns] + table.header,
+                                  state="readonly", width=20)
+        column_box.pack(side=tk.LEFT, padx=5)
+
+        # Сетка с ручной прокруткой: в Treeview только видимые строки
+        grid_frame = tk.Frame(window)
+        grid_frame.pack(fill=tk.BOTH, expand=True, padx=10)
+
+        columns = [f"c{i}" for i in range(len(table.header))]
+        tree = ttk.Treeview(grid_frame, columns=columns, show="headings", height=self.CSV_VISIBLE_ROWS)
+        vbar = ttk.Scrollbar(grid_frame, orient=tk.VERTICAL)
+        hbar = ttk.Scrollbar(grid_frame, orient=tk.HORIZONTAL, command=tree.xview)
+        tree.configure(xscrollcommand=hbar.set)
+        vbar.pack(side=tk.RIGHT, fill=tk.Y)
+        hbar.pack(side=tk.BOTTOM, fill=tk.X)
+        tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        status_var = tk.StringVar(value="Индексация...")
+        tk.Label(window, textvariable=status_var, anchor=tk.W).pack(fill=tk.X, padx=10, pady=5)
+
+        # view - номера строк в порядке показа (None - все строки по порядку файла)
+        state = {"top": 0, "rows": self.CSV_VISIBLE_ROWS, "order": None, "mask": None, "view": None,
+                 "sort": None, "busy": False, "shown": -1}
+
+        def view_length():
+            return len(state["view"]) if state["view"] is not None else table.row_count
+
+        def render():
+            total = view_length()
+            top = state["top"] = max(0, min(state["top"], total - state["rows"]))
+            tree.delete(*tree.get_children())
+            for position in range(top, min(top + state["rows"], total)):
+                number = state["view"][position] if state["view"] is not None else position
+                tree.insert("", tk.END, values=table.get_row(number))
+            if total:
+                vbar.set(top / total, min(1.0, (top + state["rows"]) / total))
+            else:
+                vbar.set(0.0, 1.0)
+            state["shown"] = total
+
+        def scroll(*args):
+            if args[0] == "moveto":
+                state["top"] = int(float(args[1]) * view_length())
+            else:
+                step = state["rows"] if args[2] == "pages" else 1
+                state["top"] += int(args[1]) * step
+            render()
+            return "break"
+
+        def on_wheel(event):
+            if event.num == 4 or event.delta > 0:
+                return scroll("scroll", -3, "units")
+            return scroll("scroll", 3, "units")
+
+        def on_resize(event):
+            row_height = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+            rows = max(1, (event.height - row_height) // row_height)
+            if rows != state["rows"]:
+                state["rows"] = rows
+                tree.configure(height=rows)
+                render()
+
+        vbar.configure(command=scroll)
+        tree.bind("<MouseWheel>", on_wheel)
+        tree.bind("<Button-4>", on_wheel)
+        tree.bind("<Button-5>", on_wheel)
+        tree.bind("<Next>", lambda e: scroll("scroll", 1, "pages"))
+        tree.bind("<Prior>", lambda e: scroll("scroll", -1, "pages"))
+        grid_frame.bind("<Configure>", on_resize)
+
+        def rebuild_view():
+            order, mask = state["order"], state["mask"]
+            if mask is None:
+                state["view"] = order
+            else:
+                numbers = order if order is not None else range(table.row_count)
+                state["view"] = array("q", (number for number in numbers if mask[number]))
+            state["top"] = 0
+            render()
+
+        def run_in_background(description, func, on_done):
+            """Сортировка/фильтр в фоновом потоке с опросом из потока Tk"""
+            if state["busy"]:
+                return
+            if not table.indexed:
+                status_var.set("Дождитесь окончания индексации")
+                return
+            state["busy"] = True
+            progress = {"done": 0, "result": None, "finished": False, "error": None}
+
+            def worker():
+                try:
+                    progress["result"] = func(lambda done: progress.update(done=done))
+                except Exception as e:
+                    progress["error"] = e
+                progress["finished"] = True
+
+            def poll():
+                if not window.winfo_exists():
+                    return
+                if not progress["finished"]:
+                    status_var.set(f"{description}... {progress['done']:,} из {table.row_count:,}")
+                    window.after(200, poll)
+                    return
+                state["busy"] = False
+                if progress["error"]:
+                    status_var.set(f"Ошибка: {progress['error']}")
+                elif progress["result"] is not None:
+                    on_done(progress["result"])
+
+            threading.Thread(target=worker, daemon=True).start()
+            window.after(200, poll)
+
+        def sort_by(column):
+            descending = state["sort"] == (column, False)
+
+            def done(order):
+                state["order"] = order
+                state["sort"] = (column, descending)
+                for i, name in enumerate(table.header):
+                    arrow = (" ▼" if descending else " ▲") if i == column else ""
+                    tree.heading(columns[i], text=name + arrow)
+                rebuild_view()
+                status_var.set(f"Строк: {view_length():,}, сортировка по «{table.header[column]}»")
+
+            run_in_background("Сортировка",
+                              lambda progress: table.sort_order(column, descending, progress), done)
+
+        def apply_filter():
+            query = filter_var.get()
+            if not query:
+                reset_filter()
+                return
+            column = None if column_var.get() == all_columns else table.header.index(column_var.get())
+
+            def done(mask):
+                state["mask"] = mask
+                rebuild_view()
+                status_var.set(f"Найдено строк: {view_length():,} из {table.row_count:,}")
+
+            run_in_background("Фильтр", lambda progress: table.filter_mask(query, column, progress), done)
+
+        def reset_filter():
+            filter_var.set("")
+            state["mask"] = None
+            rebuild_view()
+            status_var.set(f"Строк: {view_length():,}")
+
+        header_var = tk.BooleanVar(value=table.has_header)
+
+        def toggle_header():
+            # Номера строк сортировки и фильтра меняются вместе с первой записью - сбрасываем их
+            if state["busy"] or not table.indexed:
+                header_var.set(table.has_header)
+                status_var.set("Дождитесь окончания индексации")
+                return
+            table.set_header(header_var.get())
+            header_var.set(table.has_header)
+            state.update(order=None, mask=None, sort=None)
+            filter_var.set("")
+            column_var.set(all_columns)
+            column_box.configure(values=[all_columns] + table.header)
+            for i, name in enumerate(table.header):
+                tree.heading(columns[i], text=name)
+            rebuild_view()
+            status_var.set(f"Строк: {view_length():,}")
+
+        for i, name in enumerate(table.header):
+            tree.heading(columns[i], text=name, command=lambda c=i: sort_by(c))
+            tree.column(columns[i], width=120, stretch=False)
+
+        filter_entry.bind("<Return>", lambda e: apply_filter())
+        tk.Button(top_frame, text="Фильтр", command=apply_filter).pack(side=tk.LEFT, padx=5)
+        tk.Button(top_frame, text="Сбросить", command=reset_filter).pack(side=tk.LEFT, padx=5)
+        tk.Checkbutton(top_frame, text="Заголовок", variable=header_var,
+                       command=toggle_header).pack(side=tk.LEFT, padx=5)
+        tk.Button(top_frame, text="Открыть как текст",
+                  command=lambda: self.load_file(file_path)).pack(side=tk.RIGHT, padx=5)
+
+        # Индексация в фоне; первые строки показываем сразу, как только они проиндексированы
+        def poll_index():
+            if not window.winfo_exists():
+                return
+            if state["view"] is None and state["shown"] < state["top"] + state["rows"] \
+                    and state["shown"] != table.row_count:
+                render()
+            if table.indexed:
+                status_var.set(f"Строк: {table.row_count:,} ({table.size / (1024 * 1024):.1f} МБ, "
+                               f"разделитель «{table.dialect.delimiter}», {table.encoding})")
+                render()
+                return
+            status_var.set(f"Индексация... {table.row_count:,} строк")
+            window.after(200, poll_index)
+
+        def on_close():
+            table.cancelled = True
+            window.destroy()
+
+        window.protocol("WM_DELETE_WINDOW", on_close)
+        threading.Thread(target=table.build_index, daemon=True).start()
+        window.after(100, poll_index)
+        self.update_status(f"Открыт CSV: {file_path}")
+
+    def open_json_tools(self):
+        """Форматирование, сжатие и проверка JSON из редактора или файла"""
+        window = tk.Toplevel(self.root)
+        window.title("JSON")
+        window.geometry("520x260")
+
+        source_var = tk.StringVar(value="editor")
+        input_var = tk.StringVar()
+        target_var = tk.StringVar(value="editor")
+        output_var = tk.StringVar()
+        status_var = tk.StringVar(value="")
+
+        source_frame = tk.LabelFrame(window, text="Источник")
+        source_frame.pack(fill=tk.X, padx=10, pady=5)
+        tk.Radiobutton(source_frame, text="Текст редактора", variable=source_var, value="editor").grid(
+            row=0, column=0, sticky=tk.W)
+        tk.Radiobutton(source_frame, text="Файл:", variable=source_var, value="file").grid(
+            row=1, column=0, sticky=tk.W)
+        tk.Entry(source_frame, textvariable=input_var, width=40).grid(row=1, column=1, padx=5)
+
+        def browse_input():
+            self.browse_file(input_var)
+            if input_var.get():
+                source_var.set("file")
+
+        tk.Button(source_frame, text="Обзор...", command=browse_input).grid(row=1, column=2)
+
+        target_frame = tk.LabelFrame(window, text="Результат")
+        target_frame.pack(fill=tk.X, padx=10, pady=5)
+        tk.Radiobutton(target_frame, text="В редактор", variable=target_var, value="editor").grid(
+            row=0, column=0, sticky=tk.W)
+        tk.Radiobutton(target_frame, text="В файл:", variable=target_var, value="file").grid(
+            row=1, column=0, sticky=tk.W)
+        tk.Entry(target_frame, textvariable=output_var, width=40).grid(row=1, column=1, padx=5)
+
+        def browse_output():
+            path = filedialog.asksaveasfilename(defaultextension=".json",
+                                                filetypes=[("JSON файлы", "*.json"), ("Все файлы", "*.*")])
+            if path:
+                output_var.set(path)
+                target_var.set("file")
+
+        tk.Button(target_frame, text="Обзор...", command=browse_output).grid(row=1, column=2)
+
+        def run(mode):
+            from_file = source_var.get() == "file"
+            to_file = target_var.get() == "file" and mode != "validate"
+            if from_file and not os.path.isfile(input_var.get()):
+                messagebox.showerror("Ошибка", "Выберите входной файл")
+                return
+            if to_file and not output_var.get():
+                messagebox.showerror("Ошибка", "Выберите выходной файл")
+                return
+            self.run_json_processing(mode, input_var.get() if from_file else None,
+                                     output_var.get() if to_file else None, status_var)
+
+        btn_frame = tk.Frame(window)
+        btn_frame.pack(pady=10)
+        tk.Button(btn_frame, text="Форматировать", command=lambda: run("format")).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Сжать", command=lambda: run("minify")).pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="Проверить", command=lambda: run("validate")).pack(side=tk.LEFT, padx=5)
+
+        tk.Label(window, textvariable=status_var, anchor=tk.W).pack(fill=tk.X, padx=10)
+
+    def run_json_processing(self, mode, input_path, output_path, status_var):
+        """Обрабатываем JSON в фоновом потоке; вывод пишется кусками в файл или собирается для редактора"""
+        processor = JsonStreamProcessor(mode)
+        if input_path:
+            total = os.path.getsize(input_path)
+            source_text = None
+        else:
+            source_text = self.true_text()
+            total = len(source_text)
+        version = self.document.version
+        progress = {"done": 0, "result": None, "error": None, "finished": False, "output": []}
+
+        def worker():
+            try:
+                if input_path:
+                    encoding = detect_file_encoding(input_path, JsonStreamProcessor.CHUNK_SIZE)
+                    source = open(input_path, "r", encoding=encoding)
+                else:
+                    source = StringIO(source_text)
+                with source:
+                    if output_path:
+                        with open(output_path, "w", encoding="utf-8") as target:
+                            progress["result"] = processor.process(
+                                source, target.write, lambda done: progress.update(done=done))
+                    else:
+                        progress["result"] = processor.process(
+                            source, progress["output"].append, lambda done: progress.update(done=done))
+            except Exception as e:
+                progress["error"] = e
+            progress["finished"] = True
+
+        names = {"format": "Форматирование", "minify": "Сжатие", "validate": "Проверка"}
+
+        def poll():
+            if not progress["finished"]:
+                percent = progress["done"] * 100 // total if total else 0
+                status_var.set(f"{names[mode]}... {percent}%")
+                self.root.after(100, poll)
+                return
+
+            error = progress["error"]
+            if isinstance(error, JsonStreamError):
+                status_var.set(str(error))
+                self.update_status(f"Ошибка JSON: {error}")
+                if not input_path and version == self.document.version:
+                    # Показываем место ошибки в редакторе
+                    index = self.true_index(error.offset)
+                    self.text_area.tag_remove("highlight", "1.0", tk.END)
+                    self.text_area.tag_add("highlight", index, f"{index}+1c")
+                    self.text_area.tag_config("highlight", background="yellow")
+                    self.text_area.mark_set(tk.INSERT, index)
+                    self.text_area.see(index)
+                messagebox.showerror("Ошибка JSON", str(error))
+                return
+            if error:
+                status_var.set(f"Ошибка: {error}")
+                messagebox.showerror("Ошибка", f"Не удалось обработать JSON: {str(error)}")
+                return
+
+            stats = progress["result"]
+            summary = (f"{names[mode]} завершено: {stats['chars']:,} символов, "
+                       f"{stats['tokens']:,} лексем, вложенность {stats['depth']}")
+            if mode != "validate" and not output_path:
+                if not input_path and version != self.document.version:
+                    summary = "Документ изменился во время обработки, результат не вставлен"
+                else:
+                    self.set_text("".join(progress["output"]))
+            elif output_path:
+                summary += f", сохранено в {output_path}"
+            status_var.set(summary)
+            self.update_status(summary)
+
+        status_var.set(f"{names[mode]}...")
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(100, poll)
+
     def save_file(self):
-        """Сохраняем текст в файл"""
+        """Сохраняем текст вкладки в файл (в кодировке, в которой он был открыт)"""
+        tab = self.current_tab
+        options = {}
+        if tab.file_path:
+            options = {"initialdir": os.path.dirname(tab.file_path), "initialfile": os.path.basename(tab.file_path)}
         file_path = filedialog.asksaveasfilename(
             defaultextension=".txt",
             filetypes=[
                 ("Текстовые файлы", "*.txt"),
                 ("Все файлы", "*.*")
-            ]
+            ],
+            **options
         )
 
         if not file_path:
-            return
+            return False
 
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                f.write(self.get_text())
-            self.update_status(f"Файл сохранен: {file_path}")
+            text = self.get_text()
+            encoding = tab.encoding
+            try:
+                with open(file_path, 'w', encoding=encoding) as f:
+                    f.write(text)
+            except (UnicodeEncodeError, LookupError):
+                # Текст не представим в исходной кодировке файла
+                encoding = "utf-8"
+                with open(file_path, 'w', encoding=encoding) as f:
+                    f.write(text)
+            self.instrumentation.count_io(written=os.path.getsize(file_path))
+            tab.file_path, tab.encoding, tab.dirty = file_path, encoding, False
+            self.update_tab_title(tab)
+            self.update_status(f"Файл сохранен: {file_path} ({encoding})")
+            return True
         except Exception as e:
             messagebox.showerror("Ошибка", f"Не удалось сохранить файл: {str(e)}")
             self.update_status(f"Ошибка сохранения файла: {str(e)}")
+            return False
 
     # Методы для работы с текстом (продолжение)
     def find_replace(self):
@@ -1498,21 +7431,24 @@ class TextEditorApp:
 
         # Функции замены
         def find_next():
-            text = self.text_area.get("1.0", tk.END)
+            text = self.true_text()
             pattern = find_entry.get()
 
             if not pattern:
                 return
 
-            if whole_word_var.get():
-                pattern = r"\b" + re.escape(pattern) + r"\b"
+            version = self.document.version
+            regex = build_search_pattern(pattern, case_var.get(), whole_word_var.get())
+            self.run_task(regex.search, lambda match: show_match(text, version, match), text)
 
-            flags = 0 if case_var.get() else re.IGNORECASE
-            match = re.search(pattern, text, flags)
+        def show_match(text, version, match):
+            if version != self.document.version:
+                self.update_status("Документ изменился во время поиска, повторите поиск")
+                return
 
             if match:
-                start_index = f"1.0 + {match.start()} chars"
-                end_index = f"1.0 + {match.end()} chars"
+                start_index = self.true_index(match.start())
+                end_index = self.true_index(match.end(), end=True)
                 self.text_area.tag_remove("highlight", "1.0", tk.END)
                 self.text_area.tag_add("highlight", start_index, end_index)
                 self.text_area.tag_config("highlight", background="yellow")
@@ -1527,20 +7463,24 @@ class TextEditorApp:
             find_next()
 
         def replace_all():
-            text = self.text_area.get("1.0", tk.END)
+            text = self.true_text()
             pattern = find_entry.get()
             replace_with = replace_entry.get()
 
             if not pattern:
                 return
 
-            if whole_word_var.get():
-                pattern = r"\b" + re.escape(pattern) + r"\b"
+            version = self.document.version
+            regex = build_search_pattern(pattern, case_var.get(), whole_word_var.get())
+            dialog.destroy()
+            self.run_task(regex.sub, lambda new_text: apply_replace(version, new_text), replace_with, text)
 
-            flags = 0 if case_var.get() else re.IGNORECASE
-            new_text = re.sub(pattern, replace_with, text, flags=flags)
+        def apply_replace(version, new_text):
+            if version != self.document.version:
+                self.update_status("Документ изменился во время замены, замена отменена")
+                return
             self.set_text(new_text)
-            dialog.destroy()
+            self.update_status("Замена выполнена")
 
         # Кнопки
         btn_frame = tk.Frame(dialog)
@@ -1553,29 +7493,23 @@ class TextEditorApp:
 
     def show_stats(self):
         """Показываем статистику текста"""
-        text = self.get_text()
+        self.run_task(text_statistics, self.display_stats, self.get_text())
+
+    def display_stats(self, counts):
+        """Окно со статистикой текста"""
         dialog = tk.Toplevel(self.root)
         dialog.title("Статистика текста")
         dialog.geometry("300x250")
 
-        # Подсчет статистики
-        chars = len(text)
-        chars_no_space = len(text.replace(" ", ""))
-        words = len(text.split())
-        lines = text.count('\n') + 1
-        digits = sum(c.isdigit() for c in text)
-        letters = sum(c.isalpha() for c in text)
-        special = chars - digits - letters - text.count(' ') - text.count('\n')
-
         # Отображение статистики
         stats = [
-            f"Символов: {chars}",
-            f"Символов (без пробелов): {chars_no_space}",
-            f"Слов: {words}",
-            f"Строк: {lines}",
-            f"Цифр: {digits}",
-            f"Букв: {letters}",
-            f"Спецсимволов: {special}"
+            f"Символов: {counts['chars']}",
+            f"Символов (без пробелов): {counts['chars_no_space']}",
+            f"Слов: {counts['words']}",
+            f"Строк: {counts['lines']}",
+            f"Цифр: {counts['digits']}",
+            f"Букв: {counts['letters']}",
+            f"Спецсимволов: {counts['special']}"
         ]
 
         for i, stat in enumerate(stats):
@@ -1584,11 +7518,7 @@ class TextEditorApp:
         # Частота символов
         tk.Label(dialog, text="\nЧастота символов:", font=("Arial", 9, "bold")).pack(anchor=tk.W, padx=20)
 
-        from collections import Counter
-        char_counter = Counter(text)
-        top_chars = char_counter.most_common(5)
-
-        for char, count in top_chars:
+        for char, count in counts['top_chars']:
             if char == '\n':
                 char = "\\n"
             elif char == ' ':
@@ -1597,89 +7527,255 @@ class TextEditorApp:
 
     def remove_emojis(self):
         """Удаляем смайлы и эмодзи из текста"""
-        text = self.get_text()
-
-        # Удаление эмодзи и смайлов
-        emoji_pattern = re.compile("["
-                                   u"\U0001F600-\U0001F64F"  # emoticons
-                                   u"\U0001F300-\U0001F5FF"  # symbols & pictographs
-                                   u"\U0001F680-\U0001F6FF"  # transport & map symbols
-                                   u"\U0001F1E0-\U0001F1FF"  # flags (iOS)
-                                   u"\U00002500-\U00002BEF"  # chinese char
-                                   u"\U00002702-\U000027B0"
-                                   u"\U00002702-\U000027B0"
-                                   u"\U000024C2-\U0001F251"
-                                   u"\U0001f926-\U0001f937"
-                                   u"\U00010000-\U0010ffff"
-                                   u"\u2640-\u2642"
-                                   u"\u2600-\u2B55"
-                                   u"\u200d"
-                                   u"\u23cf"
-                                   u"\u23e9"
-                                   u"\u231a"
-                                   u"\ufe0f"  # dingbats
-                                   u"\u3030"
-                                   "]+", flags=re.UNICODE)
-
-        # Удаляем классические текстовые смайлы
-        text_smiles = [":\)", ":D", ":\(=", ":P", ";\)", ":\|", ":\/", ":O", ":\*", ":'\("]
-        for smile in text_smiles:
-            text = re.sub(re.escape(smile), "", text)
-
-        # Удаляем эмодзи
-        clean_text = emoji_pattern.sub(r'', text)
-
-        self.set_text(clean_text)
+        self.set_text(remove_emojis_text(self.get_text()))
         self.update_status("Смайлы и эмодзи удалены")
 
     def generate_qrcode(self):
-        """Генерируем QR-код для текста"""
+        """Генерируем QR-код для текста (длинный текст разбивается на серию кодов)"""
         text = self.get_text()
         if not text:
             messagebox.showwarning("Предупреждение", "Нет текста для генерации QR-кода")
             self.update_status("Нет текста для QR-кода")
             return
 
-        try:
-            # Создаем QR-код
-            qr = qrcode.QRCode(
-                version=1,
-                error_correction=qrcode.constants.ERROR_CORRECT_L,
-                box_size=10,
-                border=4,
-            )
-            qr.add_data(text)
-            qr.make(fit=True)
-            img = qr.make_image(fill_color="black", back_color="white")
+        # Создаем диалоговое окно с галереей
+        dialog = tk.Toplevel(self.root)
+        dialog.title("QR-код текста")
+
+        # Параметры генерации
+        options_frame = tk.Frame(dialog)
+        options_frame.pack(padx=20, pady=5)
+
+        tk.Label(options_frame, text="Коррекция ошибок:").pack(side=tk.LEFT)
+        level_var = tk.StringVar(value=self.qr_error_level)
+        ttk.Combobox(
+            options_frame,
+            textvariable=level_var,
+            values=list(QRRenderer.ERROR_LEVELS),
+            width=3,
+            state="readonly"
+        ).pack(side=tk.LEFT, padx=5)
+
+        tk.Label(options_frame, text="Размер модуля:").pack(side=tk.LEFT, padx=(10, 0))
+        box_var = tk.IntVar(value=self.qr_box_size)
+        tk.Spinbox(options_frame, from_=1, to=20, textvariable=box_var, width=4).pack(side=tk.LEFT, padx=5)
+
+        # Изображение и навигация по серии
+        label = tk.Label(dialog)
+        label.pack(padx=20, pady=10)
+
+        nav_frame = tk.Frame(dialog)
+        nav_frame.pack()
+        page_var = tk.StringVar()
+        prev_btn = tk.Button(nav_frame, text="◀", width=3)
+        prev_btn.pack(side=tk.LEFT, padx=5)
+        tk.Label(nav_frame, textvariable=page_var, width=12).pack(side=tk.LEFT)
+        next_btn = tk.Button(nav_frame, text="▶", width=3)
+        next_btn.pack(side=tk.LEFT, padx=5)
+
+        state = {"chunks": [], "page": 0, "img": None}
+
+        def show_page():
+            """Рендерим (или берем из кэша) только текущую страницу серии"""
+            try:
+                chunk = state["chunks"][state["page"]]
+                img = self.qr_renderer.render(chunk, self.qr_error_level, self.qr_box_size)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось создать QR-код: {str(e)}", parent=dialog)
+                self.update_status(f"Ошибка генерации QR-кода: {str(e)}")
+                return
 
-            # Конвертируем в формат, который может отобразить Tkinter
-            img_tk = ImageTk.PhotoImage(img)
+            state["img"] = img
+            # Крупные коды уменьшаем только для показа, копируется полный размер
+            preview = img
+            if max(img.size) > 600:
+                preview = img.resize((600, 600), Image.NEAREST)
+            img_tk = ImageTk.PhotoImage(preview)
+            label.config(image=img_tk)
+            label.image = img_tk  # сохраняем ссылку
 
-            # Создаем диалоговое окно
-            dialog = tk.Toplevel(self.root)
-            dialog.title("QR-код текста")
+            total = len(state["chunks"])
+            page_var.set(f"{state['page'] + 1} из {total}")
+            prev_btn.config(state=tk.NORMAL if state["page"] > 0 else tk.DISABLED)
+            next_btn.config(state=tk.NORMAL if state["page"] < total - 1 else tk.DISABLED)
 
-            # Отображаем QR-код
-            label = tk.Label(dialog, image=img_tk)
-            label.image = img_tk  # сохраняем ссылку
-            label.pack(padx=20, pady=10)
+        def regenerate(event=None):
+            try:
+                box_size = int(box_var.get())
+            except (ValueError, tk.TclError):
+                box_size = self.qr_box_size
+            self.qr_error_level = level_var.get()
+            self.qr_box_size = max(1, min(20, box_size))
+            state["chunks"] = self.qr_renderer.split_text(text, self.qr_error_level)
+            state["page"] = 0
+            show_page()
+
+            total = len(state["chunks"])
+            if total > 1:
+                self.update_status(f"Текст разбит на {total} QR-кодов")
+            else:
+                self.update_status("QR-код сгенерирован")
 
-            # Кнопки
-            btn_frame = tk.Frame(dialog)
-            btn_frame.pack(pady=10)
+        def go(step):
+            state["page"] = max(0, min(len(state["chunks"]) - 1, state["page"] + step))
+            show_page()
 
-            tk.Button(btn_frame, text="Копировать", command=lambda: self.copy_qrcode(img)).pack(side=tk.LEFT, padx=10)
-            tk.Button(btn_frame, text="Закрыть", command=dialog.destroy).pack(side=tk.LEFT, padx=10)
+        prev_btn.config(command=lambda: go(-1))
+        next_btn.config(command=lambda: go(1))
 
-            self.update_status("QR-код сгенерирован")
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось создать QR-код: {str(e)}")
-            self.update_status(f"Ошибка генерации QR-кода: {str(e)}")
+        # Кнопки
+        btn_frame = tk.Frame(dialog)
+        btn_frame.pack(pady=10)
+
+        tk.Button(btn_frame, text="Обновить", command=regenerate).pack(side=tk.LEFT, padx=10)
+        tk.Button(btn_frame, text="Копировать", command=lambda: self.copy_qrcode(state["img"])).pack(
+            side=tk.LEFT, padx=10
+        )
+        tk.Button(btn_frame, text="Закрыть", command=dialog.destroy).pack(side=tk.LEFT, padx=10)
+
+        dialog.bind("<Left>", lambda e: go(-1))
+        dialog.bind("<Right>", lambda e: go(1))
+
+        regenerate()
+
+    def open_qr_bulk_export(self):
+        """Открываем окно массового экспорта QR-кодов (по строкам текста или CSV)"""
+        text = self.get_text()
+        if not text:
+            messagebox.showwarning("Предупреждение", "Нет текста для генерации QR-кодов")
+            self.update_status("Нет текста для QR-кодов")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Массовый экспорт QR-кодов")
+        dialog.geometry("520x360")
+        dialog.grab_set()
+
+        main_frame = ttk.Frame(dialog)
+        main_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=15)
+
+        # Источник элементов
+        ttk.Label(main_frame, text="Источник:").grid(row=0, column=0, sticky=tk.W, pady=3)
+        source_var = tk.StringVar(value="lines")
+        source_frame = ttk.Frame(main_frame)
+        source_frame.grid(row=0, column=1, columnspan=2, sticky=tk.W)
+        ttk.Radiobutton(source_frame, text="Строки текста", variable=source_var, value="lines").pack(side=tk.LEFT)
+        ttk.Radiobutton(source_frame, text="Строки CSV", variable=source_var, value="csv").pack(side=tk.LEFT, padx=10)
+
+        ttk.Label(main_frame, text="Столбец CSV:").grid(row=1, column=0, sticky=tk.W, pady=3)
+        column_var = tk.StringVar()
+        ttk.Entry(main_frame, textvariable=column_var, width=20).grid(row=1, column=1, sticky=tk.W)
+
+        # Формат и параметры
+        ttk.Label(main_frame, text="Формат:").grid(row=2, column=0, sticky=tk.W, pady=3)
+        format_var = tk.StringVar(value="png")
+        ttk.Combobox(main_frame, textvariable=format_var, values=["png", "svg"], width=6,
+                     state="readonly").grid(row=2, column=1, sticky=tk.W)
+
+        ttk.Label(main_frame, text="Шаблон имени:").grid(row=3, column=0, sticky=tk.W, pady=3)
+        template_var = tk.StringVar(value="qr_{n:04d}")
+        ttk.Entry(main_frame, textvariable=template_var, width=30).grid(row=3, column=1, sticky=tk.EW)
+        ttk.Label(main_frame, text="{n}, {text}, {hash}, столбцы CSV").grid(row=4, column=1, sticky=tk.W)
+
+        ttk.Label(main_frame, text="Папка:").grid(row=5, column=0, sticky=tk.W, pady=3)
+        folder_var = tk.StringVar(value=os.getcwd())
+        ttk.Entry(main_frame, textvariable=folder_var, width=30).grid(row=5, column=1, sticky=tk.EW)
+        ttk.Button(main_frame, text="Обзор...", command=lambda: self.browse_folder(folder_var)).grid(
+            row=5, column=2, padx=5
+        )
+
+        zip_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(main_frame, text="Упаковать в ZIP", variable=zip_var).grid(
+            row=6, column=1, sticky=tk.W, pady=3
+        )
+
+        # Прогресс
+        progress_bar = ttk.Progressbar(main_frame, mode="determinate")
+        progress_bar.grid(row=7, column=0, columnspan=3, sticky=tk.EW, pady=(10, 3))
+        progress_var = tk.StringVar(value="Готов к экспорту")
+        ttk.Label(main_frame, textvariable=progress_var).grid(row=8, column=0, columnspan=3)
+
+        main_frame.columnconfigure(1, weight=1)
+
+        def start_export():
+            folder = folder_var.get()
+            if not folder or not os.path.isdir(folder):
+                messagebox.showerror("Ошибка", "Пожалуйста, выберите папку назначения", parent=dialog)
+                return
+            try:
+                if source_var.get() == "csv":
+                    items = QRBulkExporter.items_from_csv(text, column_var.get())
+                else:
+                    items = QRBulkExporter.items_from_lines(text)
+            except Exception as e:
+                messagebox.showerror("Ошибка", f"Не удалось разобрать текст: {str(e)}", parent=dialog)
+                return
+            if not items:
+                messagebox.showwarning("Предупреждение", "Нет элементов для экспорта", parent=dialog)
+                return
+
+            progress = {"done": 0, "total": len(items), "rate": 0.0, "result": None, "error": None}
+
+            def on_progress(done, total, rate):
+                progress["done"] = done
+                progress["rate"] = rate
+
+            def worker():
+                try:
+                    progress["result"] = QRBulkExporter().export(
+                        items, folder,
+                        template=template_var.get(),
+                        fmt=format_var.get(),
+                        error_level=self.qr_error_level,
+                        box_size=self.qr_box_size,
+                        as_zip=zip_var.get(),
+                        progress_callback=on_progress
+                    )
+                except Exception as e:
+                    progress["error"] = e
+
+            def poll():
+                # Окно могли закрыть, экспорт при этом доработает в фоне
+                if not dialog.winfo_exists():
+                    return
+                if progress["error"] is not None:
+                    start_btn.config(state=tk.NORMAL)
+                    progress_var.set("Ошибка экспорта")
+                    messagebox.showerror("Ошибка", f"Не удалось экспортировать: {progress['error']}", parent=dialog)
+                    return
+
+                progress_bar["value"] = progress["done"]
+                progress_var.set(f"{progress['done']} из {progress['total']} ({progress['rate']:.1f} кодов/с)")
+                result = progress["result"]
+                if result is None:
+                    dialog.after(100, poll)
+                    return
+
+                start_btn.config(state=tk.NORMAL)
+                summary = (
+                    f"Экспортировано {result['count']} QR-кодов за {result['elapsed']:.2f} с "
+                    f"({result['per_sec']:.1f} кодов/с)"
+                )
+                progress_var.set(summary)
+                self.update_status(summary)
+                messagebox.showinfo("Успех", f"{summary}:\n{result['path']}", parent=dialog)
+
+            progress_bar["maximum"] = len(items)
+            progress_bar["value"] = 0
+            start_btn.config(state=tk.DISABLED)
+            threading.Thread(target=worker, daemon=True).start()
+            dialog.after(100, poll)
+
+        btn_frame = ttk.Frame(main_frame)
+        btn_frame.grid(row=9, column=0, columnspan=3, pady=10)
+        start_btn = ttk.Button(btn_frame, text="Экспортировать", command=start_export)
+        start_btn.pack(side=tk.LEFT, padx=10)
+        ttk.Button(btn_frame, text="Закрыть", command=dialog.destroy).pack(side=tk.LEFT, padx=10)
 
     def copy_qrcode(self, img):
         """Копируем QR-код в буфер обмена"""
         # Для Windows
-        if os.name == 'nt':
+        if os.name == 'nt' and win32clipboard:
             try:
                 # Конвертируем в BMP
                 output = BytesIO()
@@ -1705,13 +7801,115 @@ class TextEditorApp:
             except Exception as e:
                 self.update_status(f"Ошибка копирования: {str(e)}")
 
+    def open_diagnostics(self):
+        """Окно диагностики: время выполнения команд по операциям"""
+        window = tk.Toplevel(self.root)
+        window.title("Диагностика")
+        window.geometry("820x420")
+
+        columns = ("count", "p50", "p95", "max", "size", "read", "written", "errors")
+        headings = ("Вызовов", "p50, мс", "p95, мс", "max, мс", "Ср. размер", "Прочитано", "Записано", "Ошибок")
+        tree = ttk.Treeview(window, columns=columns)
+        tree.heading("#0", text="Операция")
+        tree.column("#0", width=200)
+        for column, heading in zip(columns, headings):
+            tree.heading(column, text=heading)
+            tree.column(column, width=70, anchor=tk.E)
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        summary_var = tk.StringVar()
+        tk.Label(window, textvariable=summary_var, anchor=tk.W, justify=tk.LEFT).pack(fill=tk.X, padx=10)
+
+        def refresh():
+            tree.delete(*tree.get_children())
+            for row in self.instrumentation.summary():
+                tree.insert("", tk.END, text=row["name"], values=(
+                    row["count"],
+                    f"{row['p50'] * 1000:.1f}",
+                    f"{row['p95'] * 1000:.1f}",
+                    f"{row['max'] * 1000:.1f}",
+                    f"{row['avg_size']:.0f}",
+                    row["read"],
+                    row["written"],
+                    row["errors"],
+                ))
+            latencies = sorted(self.hotkey_latencies)
+            hotkey = (f", горячая клавиша p50 {Instrumentation.percentile(latencies, 0.5):.0f} мс"
+                      if latencies else "")
+            unloaded = sum(tab.unloaded for tab in self.tabs)
+            writer = self.persistence.stats()
+            diffs = self.text_diff.stats()
+            translations = self.translation_cache.stats()
+            summary_var.set(f"Записей: {len(self.instrumentation.records)}{hotkey}, "
+                            f"вкладок: {len(self.tabs)} (выгружено: {unloaded})\n"
+                            f"Запись на диск: в очереди {writer['queued']}, записано {writer['writes']} "
+                            f"({writer['bytes']} байт), склеено {writer['coalesced']}, ошибок {writer['errors']}, "
+                            f"p50 {writer['p50'] * 1000:.1f} мс, p95 {writer['p95'] * 1000:.1f} мс\n"
+                            f"Сравнения: в кэше {diffs['cached']}, из кэша {diffs['hits']}, "
+                            f"посчитано {diffs['misses']}\n"
+                            f"Кэш переводов: предложений {translations['entries']}, "
+                            f"из кэша {translations['hits']}, отправлено {translations['misses']}")
+
+        def clear():
+            self.instrumentation.clear()
+            refresh()
+
+        enabled_var = tk.BooleanVar(value=self.instrumentation.enabled)
+
+        def toggle():
+            self.instrumentation.enabled = enabled_var.get()
+
+        button_frame = tk.Frame(window)
+        button_frame.pack(fill=tk.X, padx=10, pady=10)
+        tk.Checkbutton(button_frame, text="Замерять команды", variable=enabled_var,
+                       command=toggle).pack(side=tk.LEFT)
+        tk.Button(button_frame, text="Обновить", command=refresh).pack(side=tk.RIGHT, padx=5)
+        tk.Button(button_frame, text="Очистить", command=clear).pack(side=tk.RIGHT, padx=5)
+
+        refresh()
+
     # Вспомогательные методы
+    def document_size(self):
+        """Размер текущего документа в символах"""
+        return len(self.document)
+
     def update_status(self, message):
         """Обновляем статусную строку"""
         self.status_var.set(f"Статус: {message}")
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        sys.exit(run_batch_cli(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        sys.exit(run_bench_cli(sys.argv[2:]))
+
+    # --profile [файл]: профилируем всю сессию через cProfile
+    profile_path = None
+    if "--profile" in sys.argv:
+        position = sys.argv.index("--profile")
+        del sys.argv[position]
+        if position < len(sys.argv) and sys.argv[position].endswith(".prof"):
+            profile_path = sys.argv.pop(position)
+        else:
+            profile_path = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof"
+
+    message = SingleInstance.message_from_args(sys.argv[1:], sys.stdin)
+    instance = SingleInstance()
+    if not instance.acquire() and instance.send(message):
+        sys.exit(0)
+
     root = tk.Tk()
     app = TextEditorApp(root)
-    root.mainloop()
+    if instance.server:
+        instance.serve(lambda msg: app.call_in_ui(app.handle_instance_message, msg))
+    if message["action"] != "show":
+        app.handle_instance_message(message)
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.runcall(root.mainloop)
+        profiler.dump_stats(profile_path)
+        print(f"Профиль сохранен в {profile_path}")
+    else:
+        root.mainloop()
+    instance.close()
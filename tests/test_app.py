@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# app.py импортирует GUI-зависимости (pystray, keyboard, pycaw); без них тесты пропускаются
+app = pytest.importorskip("app")
+
+
+@pytest.fixture
+def calculator():
+    return app.DocumentCalculator(app.ExpressionEvaluator())
+
+
+def test_numbers_with_decimal_comma(calculator):
+    assert calculator.extract_numbers("3,5\n2,5\n-1,25") == ["3.5", "2.5", "-1.25"]
+
+
+def test_comma_separated_list_is_several_numbers(calculator):
+    assert calculator.extract_numbers("1,2,3") == ["1", "2", "3"]
+
+
+def test_aggregate_column_with_decimal_comma(calculator):
+    stats = calculator.aggregate("a;3,5;b\nc;4,5;d", column=2)
+    assert stats["count"] == 2
+    assert stats["sum"] == pytest.approx(8.0)
+    assert stats["median"] == pytest.approx(4.0)
+
+
+def test_split_sentences_keeps_text_and_punctuation_runs():
+    text = "Привет!!! Как дела?\n\nЭто... тест»  " + "!" * 5000 + "x"
+    segments = app.TranslationService.split_sentences(text)
+    assert "".join(segments) == text
+    assert segments[:3] == ["Привет!!!", " ", "Как дела?"]
+
+
+@pytest.fixture
+def stub_server():
+    server = app.StubTranslationServer()
+    url = server.start()
+    yield server, url
+    server.close()
+
+
+def test_translation_round_trip_through_stub_server(stub_server, tmp_path):
+    server, url = stub_server
+    writer = app.PersistenceWriter(coalesce_seconds=0)
+    cache = app.TranslationCache(writer, str(tmp_path / "cache.json"))
+    service = app.TranslationService(app.HttpTranslationBackend(url), cache)
+    try:
+        translated, stats = service.translate("Привет. Мир!\n42", "ru", "en")
+        assert translated == "[en] Привет. [en] Мир!\n42"
+        assert stats["sent"] == 2 and stats["cached"] == 0
+        assert server.segments == 2
+
+        # Повторный перевод берется из кэша, сервер не вызывается
+        requests = server.requests
+        translated, stats = service.translate("Привет. Мир!", "ru", "en")
+        assert translated == "[en] Привет. [en] Мир!"
+        assert stats["cached"] == 2 and stats["sent"] == 0
+        assert server.requests == requests
+    finally:
+        writer.close()
+
+
+def test_translation_backend_reports_unreachable_server():
+    backend = app.HttpTranslationBackend("http://127.0.0.1:9/translate", timeout=1)
+    with pytest.raises(app.TranslationError):
+        backend.translate(["Привет"], "ru", "en")
+
+
+@pytest.mark.parametrize("query", ["histroy", "hsitory", "hitsory"])
+def test_fuzzy_search_counts_adjacent_swap_as_one_error(query):
+    index = app.FuzzySearchIndex()
+    index.add("old", None, "some text with history inside")
+    index.add("new", None, "nothing relevant here")
+    results, complete = index.search(query)
+    assert complete
+    assert [(key, errors) for key, _, errors, _ in results] == [("old", 1)]